@@ -0,0 +1,136 @@
+'''
+Benchmark of the unscented filter against the EKF.
+
+Simulates a robot driving with aggressive turns (yaw rate up to `--max-yaw-rates` rad/s,
+changing every second) and rocking about roll and pitch, with noisy odometry, accelerometer
+and gyroscope measurements. Both filters get the same measurements.
+Reports position RMSE, tilt (roll/pitch) and yaw errors and time per step (predict and all updates).
+
+Usage:
+    python3 benchmark/unscented.py [--steps 300] [--dt 0.1] [--max-yaw-rates 0.5 1.5 3] [--alpha 0.3]
+'''
+import argparse
+import time
+
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+from state_estimation_25d.ekf import Filter, UnscentedFilter
+from state_estimation_25d.ekf import geometry
+from state_estimation_25d.ekf.filter import rot_vel_to_q
+
+
+def simulate(steps, dt, max_yaw_rate, rng):
+    '''
+    Returns ground truth positions [steps, 3], quaternions [steps, 4] (w, x, y, z)
+    and measurements for every step
+    '''
+    pos = np.zeros(3)
+    q = np.array([1., 0, 0, 0])
+    positions = np.zeros((steps, 3))
+    quats = np.zeros((steps, 4))
+    measurements = []
+    yaw_rate = 0.
+    for i in range(steps):
+        t = i * dt
+        if i % int(round(1 / dt)) == 0:
+            yaw_rate = rng.uniform(-max_yaw_rate, max_yaw_rate)
+        vel = 1. + 0.5 * np.sin(0.5 * t)
+        rot_vel = np.array([0.3 * np.sin(2 * t), 0.3 * np.cos(1.7 * t), yaw_rate])
+        pos = pos + geometry.quat_as_matrix(q)[:, 0] * vel * dt
+        q = geometry.quat_product(q, rot_vel_to_q(rot_vel, dt))
+        q = q / np.linalg.norm(q)
+        positions[i] = pos
+        quats[i] = q
+        acc = geometry.rotate_vector(np.array([0, 0, 9.8]), geometry.quat_inv(q))
+        measurements.append((
+            np.array([vel, yaw_rate]) + rng.normal(0, [0.05, 0.05]),
+            acc + rng.normal(0, 0.3, size=3),
+            np.array([yaw_rate]) + rng.normal(0, 0.01, size=1),
+        ))
+    return positions, quats, measurements
+
+
+def run(f, measurements, dt):
+    R_odom = np.diag([0.05**2, 0.05**2])
+    R_acc = np.eye(3) * 0.3**2
+    R_gyro = np.eye(1) * 0.01**2
+    positions = np.zeros((len(measurements), 3))
+    quats = np.zeros((len(measurements), 4))
+    start = time.perf_counter()
+    for i, (z_odom, z_acc, z_gyro) in enumerate(measurements):
+        f.predict(dt)
+        f.update_odom(z_odom, R_odom)
+        f.update_imu(z_acc, R_acc, None, z_gyro, R_gyro)
+        positions[i] = f.pos
+        quats[i] = geometry.chart_inv(np.ascontiguousarray(f.epsilon), f.q)
+    step_time = (time.perf_counter() - start) / len(measurements)
+    return positions, quats, step_time
+
+
+def attitude_errors(quats, gt_quats):
+    '''
+    Returns tilt errors (angle between estimated and true gravity directions)
+    and yaw errors in degrees. Quaternions are in (w, x, y, z) order
+    '''
+    est = Rotation.from_quat(quats[:, [1, 2, 3, 0]])
+    gt = Rotation.from_quat(gt_quats[:, [1, 2, 3, 0]])
+    up = np.array([0, 0, 1.])
+    cos_tilt = np.sum(est.inv().apply(up) * gt.inv().apply(up), axis=1)
+    tilt = np.degrees(np.arccos(np.clip(cos_tilt, -1, 1)))
+    yaw = est.as_euler('ZYX')[:, 0] - gt.as_euler('ZYX')[:, 0]
+    yaw = np.degrees(np.abs((yaw + np.pi) % (2 * np.pi) - np.pi))
+    return tilt, yaw
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--steps', type=int, default=300)
+    parser.add_argument('--dt', type=float, default=0.1)
+    parser.add_argument('--max-yaw-rates', type=float, nargs='+', default=[0.5, 1.5, 3.])
+    parser.add_argument('--seeds', type=int, default=20)
+    parser.add_argument('--alpha', type=float, default=0.3, help='spread of the UKF sigma points')
+    args = parser.parse_args()
+
+    filters = {
+        'ekf': lambda: Filter(args.dt, 1., 1.),
+        'ukf': lambda: UnscentedFilter(args.dt, 1., 1., alpha=args.alpha),
+    }
+    # Compile
+    _, _, measurements = simulate(10, args.dt, 1., np.random.default_rng(0))
+    for make_filter in filters.values():
+        run(make_filter(), measurements, args.dt)
+
+    for max_yaw_rate in args.max_yaw_rates:
+        print(
+            f'{"yaw rate":>8} {"filter":>6} {"pos RMSE, m":>12} {"tilt RMSE, deg":>15} {"tilt max, deg":>14} '
+            f'{"yaw RMSE, deg":>14} {"step, us":>9}'
+        )
+        for name, make_filter in filters.items():
+            pos_errors = []
+            tilt_errors = []
+            yaw_errors = []
+            step_times = []
+            for seed in range(args.seeds):
+                gt_pos, gt_quats, measurements = simulate(
+                    args.steps, args.dt, max_yaw_rate, np.random.default_rng(seed)
+                )
+                f = make_filter()
+                f.P = f.P * 0.01
+                positions, quats, step_time = run(f, measurements, args.dt)
+                pos_errors.append(np.linalg.norm(positions - gt_pos, axis=1))
+                tilt, yaw = attitude_errors(quats, gt_quats)
+                tilt_errors.append(tilt)
+                yaw_errors.append(yaw)
+                step_times.append(step_time)
+            pos_errors = np.concatenate(pos_errors)
+            tilt_errors = np.concatenate(tilt_errors)
+            yaw_errors = np.concatenate(yaw_errors)
+            print(
+                f'{max_yaw_rate:8.1f} {name:>6} {np.sqrt(np.mean(pos_errors**2)):12.3f} '
+                f'{np.sqrt(np.mean(tilt_errors**2)):15.3f} {tilt_errors.max():14.3f} {np.sqrt(np.mean(yaw_errors**2)):14.3f} {np.median(step_times) * 1e6:9.1f}'
+            )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,43 @@
 from setuptools import setup
+from setuptools.command.develop import develop
+from setuptools.command.install import install
 import os
+import subprocess
+import sys
 from glob import glob
 
+
+def with_warmup(command, module, source_install):
+    '''
+    `command` followed by `python -m <module>`, which compiles the numba kernels of the installed package
+    into its numba cache, so that the nodes only load them. colcon build runs `install`
+    (`develop` with --symlink-install, where the cache is written next to the sources).
+    Set SKIP_NUMBA_WARMUP=1 to skip it. A failed warm-up only prints a warning,
+    the kernels are then compiled when a node starts.
+    '''
+    class WarmupCommand(command):
+        def run(self):
+            super().run()
+            if os.environ.get('SKIP_NUMBA_WARMUP'):
+                return
+            path = os.path.dirname(os.path.abspath(__file__)) if source_install else self.install_lib
+            env = dict(os.environ)
+            env['PYTHONPATH'] = os.pathsep.join(filter(None, [path, env.get('PYTHONPATH')]))
+            try:
+                # -m imports from the working directory first
+                subprocess.check_call([sys.executable, '-m', module], env=env, cwd=path)
+            except (OSError, subprocess.CalledProcessError) as e:
+                print(f'warning: {module} failed ({e}), kernels will be compiled at node startup', file=sys.stderr)
+    return WarmupCommand
+
+
 package_name = 'state_estimation_25d'
+warmup_module = 'state_estimation_25d.ekf.warmup'
 
 setup(
     name=package_name,
     version='0.0.0',
-    packages=[package_name],
+    packages=[package_name, package_name + '.ekf'],
     data_files=[
     ('share/ament_index/resource_index/packages',
         ['resource/' + package_name]),
@@ -21,9 +51,16 @@ setup(
     description='TODO: Package description',
     license='TODO: License declaration',
     tests_require=['pytest'],
+    # Populate the numba cache at build time
+    cmdclass={
+        'install': with_warmup(install, warmup_module, source_install=False),
+        'develop': with_warmup(develop, warmup_module, source_install=True),
+    },
     entry_points={
         'console_scripts': [
-            'state_estimation_25d = state_estimation_25d.state_estimation_node:main'
+            'state_estimation_25d = state_estimation_25d.state_estimation_node:main',
+            'state_estimation_25d_fleet = state_estimation_25d.multi_robot_node:main',
+            'ekf_warmup = state_estimation_25d.ekf.warmup:main',
         ],
     },
 )
@@ -1,3 +1,4 @@
 from .filter import Filter
+from .unscented import UnscentedFilter
 
 __version__ = '0.0.0'
\ No newline at end of file
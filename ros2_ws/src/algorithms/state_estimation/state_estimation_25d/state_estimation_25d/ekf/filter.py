@@ -4,6 +4,12 @@ from numba import njit
 from scipy.spatial.transform import Rotation
 from filterpy.common import Q_discrete_white_noise
 
+from state_estimation_3d.smoother import FixedLagSmoother
+from state_estimation_3d.adaptive import InnovationNoiseEstimator, ProcessNoiseEstimator
+from state_estimation_3d.gating import ChiSquareGate
+from state_estimation_3d.messages import covariance_index, fill_covariance
+from state_estimation_3d.spacekf.filter import KALMAN_UPDATES
+
 from . import physics, geometry, measurement
 
 class Filter:
@@ -44,11 +50,30 @@ class Filter:
         Model noise covariance matrix
     transition_jac: function
         Jacobian of nonlinear transition function
+    update_mode: str
+        Covariance update used by measurement updates, one of `KALMAN_UPDATES` keys:
+        'standard' or 'joseph' (shared with SpaceKF12)
+    stamp: float
+        Time of the current state, s (sum of predict steps)
+    smoother: FixedLagSmoother or None
+        Fixed-lag RTS smoother over the last `smoother_lag` predict steps, see `smooth`
+    adaptive_window: int
+        If > 0, R of every update type ('odom', 'static_vec', 'gyro') and Q are adapted
+        by covariance matching over this number of updates / predict steps.
+        The R passed to an update is then only its initial value
+    noise_estimators: dict
+        Update name -> InnovationNoiseEstimator
+    process_noise_estimator: ProcessNoiseEstimator or None
+    gate: ChiSquareGate
+        Mahalanobis gating of all updates and the numbers of accepted and rejected measurements
+        per update name. Disabled if `gate_probability` is 0
     '''
     ACCEL_STD = 5.0
     GRAVITY = np.array([0, 0, 9.8])
     
-    def __init__(self, dt, vel_std, rot_vel_std):
+    def __init__(
+        self, dt, vel_std, rot_vel_std, update_mode='standard', smoother_lag=0, adaptive_window=0, gate_probability=0.,
+    ):
         self.dt = dt
         self.x = np.zeros(10)
         self.P = np.eye(10)
@@ -65,50 +90,121 @@ class Filter:
         )
 
         self.transition_jac = physics.transition_jac
+        self.update_mode = update_mode
+        self._kalman_update = KALMAN_UPDATES[update_mode]
+        self.stamp = 0.
+        self.smoother = FixedLagSmoother(10, smoother_lag, extra_dim=4) if smoother_lag > 0 else None
+        self.adaptive_window = adaptive_window
+        self.noise_estimators = {}
+        self.process_noise_estimator = None
+        if adaptive_window > 0:
+            self.process_noise_estimator = ProcessNoiseEstimator(self.Q, adaptive_window)
+            self._x_prior = self.x.copy()
+            self._q_scale = 1.
+        self.gate = ChiSquareGate(gate_probability)
     
-    def predict_by_nn_model(self, model, control):
+    def predict_by_nn_model(self, model, control, dt=None, stamp=None):
         """
         Kalman filter predict step
         @ parameters
-        model: 
+        model: rosbot_controller.motion_model.MotionModel
             Pretrained NN control model
+        dt: float
+            Time step. Default: self.dt
+        stamp: float
+            Time of the predicted state. Default: self.stamp + dt
         @ return 
         x_opt:
             State vector after predict step
         P_opt:
             Covariance matrix after predict step
         """
-        model_input = np.array([[self.v, self.w_yaw, control[0], control[1], self.dt]], 
-                                dtype=np.float32)
-        model_output = model(model_input)
+        dt = dt or self.dt
         # Predicted velocity control
-        self.v, self.w_yaw = float(model_output[0][0]), float(model_output[0][1])
-        self.predict()
+        v, w_yaw = model.predict(self.v, self.w_yaw, control[0], control[1], dt)
+        self.predict_by_velocities(v, w_yaw, dt, stamp)
+
+    def predict_by_velocities(self, v, w_yaw, dt=None, stamp=None):
+        """
+        Predict step after the velocities predicted by a control model,
+        e.g. by one batched NN call for several filters
+        """
+        self._finish_step()
+        self.v, self.w_yaw = v, w_yaw
+        self._predict(dt, stamp)
+        self._start_step(dt)
 
-    def predict(self):
+    def predict(self, dt=None, stamp=None):
+        """
+        Predict step with time step `dt` (default: self.dt) to the time `stamp` (default: self.stamp + dt).
+        The process noise is scaled linearly with dt / self.dt.
+        """
+        self._finish_step()
+        self._predict(dt, stamp)
+        self._start_step(dt)
+
+    def _finish_step(self):
+        # The smoother and the process noise estimator get the filtered state before the velocities
+        # are replaced by the control model and in the chart of its prior, i.e. before the manifold reset
+        if self.smoother is not None:
+            self.smoother.filtered(self.x, self.P)
+        if self.process_noise_estimator is not None:
+            self.process_noise_estimator.add(self.x - self._x_prior, self._q_scale)
+            self.Q = self.process_noise_estimator.Q
+
+    def _start_step(self, dt):
+        if self.process_noise_estimator is not None:
+            self._x_prior[:] = self.x
+            self._q_scale = (dt or self.dt) / self.dt
+
+    def _predict(self, dt=None, stamp=None):
+        dt = dt or self.dt
         self.reset_manifold()
-        F = self.transition_jac(self.v, self.rot_vel, self.q, self.dt)
-        self.predict_state()
-        self.P = F @ self.P @ F.T + self.Q
+        F = self.transition_jac(self.v, self.rot_vel, self.q, dt)
+        self.predict_state(dt)
+        self.P = F @ self.P @ F.T + self.Q * (dt / self.dt)
+        self.stamp = self.stamp + dt if stamp is None else stamp
+        if self.smoother is not None:
+            self.smoother.push(self.stamp, self.x, self.P, F, self.q)
 
-    def predict_state(self):
-        self.pos = self.predict_coords()
-        self.epsilon, self.q = self.predict_quaternion()
+    def smooth(self):
+        '''
+        Fixed-lag smoothed state `smoother_lag` predict steps behind the current one
 
-    def predict_coords(self):
+        Returns:
+        (stamp, x, P, q) or None if the smoother is disabled or has not collected enough steps.
+        Epsilon of the returned `x` is zero and `q` is the smoothed attitude.
+        '''
+        if self.smoother is None:
+            return None
+        result = self.smoother.smooth(self.x, self.P)
+        if result is None:
+            return None
+        stamp, x, P, q = result
+        x[4::2], q = geometry.reset_manifold(np.ascontiguousarray(x[4::2]), q)
+        return stamp, x, P, q
+
+    def predict_state(self, dt=None):
+        dt = dt or self.dt
+        self.pos = self.predict_coords(dt)
+        self.epsilon, self.q = self.predict_quaternion(dt)
+
+    def predict_coords(self, dt=None):
         """
         Predict robot coordinates in global frame
         """
+        dt = dt or self.dt
         odom_extrinsic = geometry.quat_as_matrix(self.q)
         velocity_local = np.array([self.v, 0, 0])
-        self.pos += odom_extrinsic @ velocity_local * self.dt
+        self.pos += odom_extrinsic @ velocity_local * dt
         return self.pos
     
-    def predict_quaternion(self):
+    def predict_quaternion(self, dt=None):
         """
         Predict robot orientation
         """
-        rot_q = rot_vel_to_q(self.rot_vel, self.dt)
+        dt = dt or self.dt
+        rot_q = rot_vel_to_q(self.rot_vel, dt)
         # Rotate the current attitude
         next_q_center = geometry.quat_product(self.q, rot_q)
         next_q_center = next_q_center / np.sqrt(np.sum(next_q_center**2))
@@ -135,7 +231,7 @@ class Filter:
         """
         z_prior, H = measurement.odometry(self.v, self.w_yaw)
         y = z - z_prior
-        self.x, self.P = kalman_update(self.x, self.P, H, R, y)
+        self._update('odom', H, R, y)
 
     def update_imu(self, 
                    z_acc, R_acc, acc_extrinsic,
@@ -160,7 +256,7 @@ class Filter:
         '''
         z_prior, H = measurement.static_vec(self.q, vec, extrinsic=extrinsic)
         y = z - z_prior
-        self.x, self.P = kalman_update(self.x, self.P, H, R, y)
+        self._update('static_vec', H, R, y)
 
     def update_gyro(self, z, R):
         '''
@@ -168,34 +264,47 @@ class Filter:
         '''
         z_prior, H = measurement.rot_vel_local(self.w_yaw)
         y = z - z_prior
-        self.x, self.P = kalman_update(self.x, self.P, H, R, y)
+        self._update('gyro', H, R, y)
+
+    def _update(self, name, H, R, y):
+        '''
+        Gated Kalman update. With `adaptive_window > 0`, R is replaced by the adapted covariance
+        of the update `name`. Rejected innovations are not used for the adaptation.
+        '''
+        estimator = None
+        if self.adaptive_window > 0:
+            estimator = self.noise_estimators.get(name)
+            if estimator is None:
+                estimator = InnovationNoiseEstimator(R, self.adaptive_window)
+                self.noise_estimators[name] = estimator
+            R = estimator.R
+            HPHt = H @ self.P @ H.T
+        gate = self.gate.threshold(y.shape[0])
+        self.x, self.P, d2 = self._kalman_update(self.x, self.P, H, R, y, None, gate)
+        accepted = d2 <= gate
+        if self.gate.enabled:
+            self.gate.record(name, accepted)
+        if estimator is not None and accepted:
+            estimator.add(y, HPHt)
 
-    def get_pose_covariance(self):
+    def get_pose_covariance(self, out=None):
         '''
         Returns 6x6 covariance matrix of pose in the form a list with length 36:
         (x, y, z, rotation about X axis, rotation about Y axis, rotation about Z axis)
+        If `out` is given (e.g. `msg.pose.covariance`), it is filled in place and returned instead.
         '''
-        indeces = [0, 1, 2, 4, 6, 8]
-        mat = self.P[indeces][:, indeces]
-        return list(mat.flatten())
+        if out is None:
+            return list(self.P.take(POSE_COVARIANCE_INDEX))
+        return fill_covariance(out, self.P, POSE_COVARIANCE_INDEX)
 
-    def get_twist_covariance(self):
+    def get_twist_covariance(self, out=None):
         '''
         Returns 6x6 covariance matrix of velocity in the form a list with length 36:
         (x, y, z, rotation about X axis, rotation about Y axis, rotation about Z axis)
+        If `out` is given (e.g. `msg.twist.covariance`), it is filled in place and returned instead.
         '''
-        rot_mat = geometry.quat_as_matrix(self.q)
-        P_v_local = np.array([[self.P[3][3], 0, 0],
-                        [0, 0, 0],
-                        [0, 0, 0]])
-        P_v_global = rot_mat @ P_v_local @ rot_mat.T
-        indeces = [5, 7, 9]
-        mat = self.P[indeces][:, indeces]
-        mat = scipy.linalg.block_diag(
-            P_v_global,
-            mat
-        )
-        return list(mat.flatten())
+        cov = fill_twist_covariance(np.empty(36) if out is None else out, self.P, self.q)
+        return list(cov) if out is None else out
 
     @property
     def pos(self):
@@ -232,7 +341,7 @@ class Filter:
     def epsilon(self, value):
         self.x[4::2] = value
 
-@njit
+@njit(cache=True)
 def rot_vel_to_q(rot_vel, delta_t):
     '''
     input:
@@ -249,10 +358,19 @@ def rot_vel_to_q(rot_vel, delta_t):
     rot_q[1:] = w_unit * np.sin(rot_angle_05)
     return rot_q
 
-@njit
-def kalman_update(x, P, H, R, y):
-    S = H @ P @ H.T + R
-    K = P @ H.T @ np.linalg.inv(S)
-    new_x = x + K @ y
-    new_P = (np.eye(x.shape[0]) - K @ H) @ P
-    return new_x, new_P
+POSE_COVARIANCE_INDEX = covariance_index([0, 1, 2, 4, 6, 8], 10)
+
+
+def fill_twist_covariance(out, P, q):
+    '''
+    Write the 6x6 twist covariance of the state covariance `P` at the attitude `q` into `out`
+    (e.g. `msg.twist.covariance`) and return it
+    '''
+    # Only v_parallel is uncertain: rot_mat @ diag(P_vv, 0, 0) @ rot_mat^T = P_vv * r r^T, r = rot_mat[:, 0]
+    rot_axis = geometry.quat_as_matrix(q)[:, 0]
+    mat = out.reshape(6, 6)
+    mat[:3, :3] = np.outer(rot_axis, rot_axis * P[3, 3])
+    mat[:3, 3:] = 0
+    mat[3:, :3] = 0
+    mat[3:, 3:] = P[5::2, 5::2]
+    return out
@@ -1,21 +1,21 @@
 import numpy as np
 from numba import njit
 
-@njit
+@njit(cache=True)
 def quat_product(q1, q2):
     res = np.empty(4)
     res[0] = q1[0] * q2[0] - np.dot(q1[1:], q2[1:])
     res[1:] = q1[0] * q2[1:] + q2[0] * q1[1:] + np.cross(q1[1:], q2[1:])
     return res
 
-@njit
+@njit(cache=True)
 def quat_inv(q):
     q_inv = np.empty_like(q)
     q_inv[0] = q[0]
     q_inv[1:] = -q[1:]
     return q_inv
 
-@njit
+@njit(cache=True)
 def chart_inv(epsilon, q0=None):
     '''
     Inverse of the phi function.
@@ -32,7 +32,19 @@ def chart_inv(epsilon, q0=None):
         q = delta
     return q
 
-@njit
+@njit(cache=True)
+def chart(q, q0):
+    '''
+    The phi function: Euclidian representation of the delta between `q` and the center `q0`.
+    Inverse of `chart_inv`.
+    '''
+    delta = quat_product(quat_inv(q0), q)
+    # q and -q are the same rotation
+    if delta[0] < 0:
+        delta = -delta
+    return 2 * delta[1:] / delta[0]
+
+@njit(cache=True)
 def rotate_vector(p, q):
     p_quat = np.empty(4)
     p_quat[0] = 0
@@ -42,7 +54,7 @@ def rotate_vector(p, q):
     res2 = quat_product(res1, q_inv)
     return res2[1:]
 
-@njit
+@njit(cache=True)
 def quat_as_matrix(q):
     '''
     Transforms a quaternion to a rotation matrix
@@ -59,13 +71,13 @@ def quat_as_matrix(q):
     mat[2, 2] = 1 - 2 * q[1]*q[1] - 2 * q[2] * q[2]
     return mat
 
-@njit
+@njit(cache=True)
 def reset_manifold(epsilon, q_center):
     next_center = chart_inv(epsilon, q_center)
     next_epsilon = np.zeros_like(epsilon)
     return next_epsilon, next_center
 
-@njit
+@njit(cache=True)
 def vector_to_pseudo_matrix(vec):
     mat = np.empty(shape=(3,3))
     mat[0, 0] = 0
@@ -3,7 +3,7 @@ from numba import njit
 
 from . import geometry, physics
 
-@njit
+@njit(cache=True)
 def odometry(vel, w_yaw):#, rot_vel, q_center, delta_t, extrinsic=None):
     '''
     measurement = (angle about x, angle about y, angle about z, translation x, translation y, translation z)
@@ -15,7 +15,7 @@ def odometry(vel, w_yaw):#, rot_vel, q_center, delta_t, extrinsic=None):
     H[1, 9] = 1
     return z_prior, H
 
-@njit
+@njit(cache=True)
 def static_vec(q_center, vec, extrinsic=None):
     # Rotate the vector backwards
     q_inv = geometry.quat_inv(q_center)
@@ -33,7 +33,7 @@ def static_vec(q_center, vec, extrinsic=None):
         H[:, 10 - 6::2] = vec_cross @ rot_extrinsic
     return z_prior, H
 
-@njit
+@njit(cache=True)
 def rot_vel_local(w_yaw):
     # Get rot_vel
     z_prior = w_yaw
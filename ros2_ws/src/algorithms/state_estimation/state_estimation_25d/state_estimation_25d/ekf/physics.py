@@ -3,7 +3,7 @@ from numba import njit
 
 from . import geometry
 
-@njit
+@njit(cache=True)
 def transition_jac(
     vel,
     rot_vel,
@@ -40,7 +40,7 @@ def transition_jac(
 
     return F
 
-@njit
+@njit(cache=True)
 def rot_vel_to_q(rot_vel, delta_t):
     '''
     input:
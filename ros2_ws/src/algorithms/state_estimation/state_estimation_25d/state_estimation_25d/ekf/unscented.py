@@ -0,0 +1,200 @@
+import numpy as np
+from numba import njit
+
+from . import geometry
+from .filter import Filter, rot_vel_to_q
+
+
+class UnscentedFilter(Filter):
+    '''
+    10-dimensional Unscented Kalman Filter on the same state and manifold as `Filter`
+
+    Instead of linearising the transition with `physics.transition_jac`, the predict step
+    propagates 2n+1 sigma points: every point is mapped to its own quaternion with
+    `geometry.chart_inv`, moved by the nonlinear transition and mapped back to the
+    neighborhood of the new center quaternion with `geometry.chart`.
+    The accelerometer update is unscented too. Odometry and gyroscope measurements are
+    linear in the state, so they use the same Kalman update as `Filter`.
+    All sigma points are processed by a single compiled kernel call.
+
+    As in the UKF on manifolds of Brossard, Barrau & Bonnabel (UKF-M, 2020), the mean is the
+    0-th sigma point moved by the noise-free model, and the other 2n points only give
+    the covariance about it. The weighted mean of the sigma points is not used: the model lets
+    roll and pitch rates drift freely, so their variance is large, and averaging the headings
+    of the sigma points shortens the predicted displacement (and the predicted gravity vector)
+    on every step.
+
+    The API is the same as of `Filter`, except for the smoother (there is no transition jacobian)
+    and the adaptive R of the unscented accelerometer update.
+    ----------------------------
+    Additional attributes:
+    alpha, kappa: float
+        Parameters of the scaled sigma points (van der Merwe): the points are
+        sqrt(n + lambda) standard deviations from the center, lambda = alpha^2 (n + kappa) - n
+    W: np.array
+        Covariance weights of the sigma points, 0 for the center
+    '''
+
+    def __init__(
+        self, dt, vel_std, rot_vel_std, update_mode='standard', alpha=0.3, kappa=0., adaptive_window=0,
+        gate_probability=0.,
+    ):
+        super().__init__(
+            dt, vel_std, rot_vel_std, update_mode=update_mode, adaptive_window=adaptive_window,
+            gate_probability=gate_probability,
+        )
+        self.alpha = alpha
+        self.kappa = kappa
+        self.W, self.lambda_ = sigma_weights(self.x.shape[0], alpha, kappa)
+
+    def _predict(self, dt=None, stamp=None):
+        dt = dt or self.dt
+        self.reset_manifold()
+        self.x, self.P, self.q = unscented_predict(
+            self.x, self.P, self.q, self.Q * (dt / self.dt), dt, self.W, self.lambda_
+        )
+        self.stamp = self.stamp + dt if stamp is None else stamp
+
+    def update_static_vec(self, z, R, vec, extrinsic=None):
+        '''
+        Update state by a measurement of some vector which should be constant in the world coordinates.
+        For example, magnetic field.
+        '''
+        if extrinsic is None:
+            rot_extrinsic = np.eye(3)
+        else:
+            rot_extrinsic = np.ascontiguousarray(extrinsic[:3, :3], dtype=np.float64)
+        gate = self.gate.threshold(3)
+        self.x, self.P, d2 = unscented_static_vec_update(
+            self.x, self.P, self.q, np.asarray(z, dtype=np.float64), np.asarray(R, dtype=np.float64),
+            np.asarray(vec, dtype=np.float64), rot_extrinsic, self.W, self.lambda_, gate,
+        )
+        if self.gate.enabled:
+            self.gate.record('static_vec', d2 <= gate)
+
+
+def sigma_weights(n, alpha, kappa):
+    '''
+    Covariance weights of the 2n+1 scaled sigma points about the center point
+
+    The center has no weight, so unlike the weights of the standard UKF
+    none of them is negative for small alpha.
+
+    Returns:
+    W (np.array): [2n+1] weights, 0 for the center and 1 / (2 (n + lambda)) for the others
+    lambda_ (float): scaling parameter
+    '''
+    lambda_ = alpha**2 * (n + kappa) - n
+    W = np.full(2 * n + 1, 0.5 / (n + lambda_))
+    W[0] = 0.
+    return W, lambda_
+
+
+@njit(cache=True)
+def sigma_points(x, P, lambda_):
+    '''
+    Returns [2n+1, n] sigma points: x, x + columns of sqrt((n + lambda) P), x - columns
+    '''
+    n = x.shape[0]
+    L = np.linalg.cholesky((n + lambda_) * 0.5 * (P + P.T))
+    sigmas = np.empty((2 * n + 1, n))
+    sigmas[0] = x
+    for i in range(n):
+        sigmas[1 + i] = x + L[:, i]
+        sigmas[1 + n + i] = x - L[:, i]
+    return sigmas
+
+
+@njit(cache=True)
+def center_covariance(points, W):
+    '''
+    Weighted covariance [m, m] of [2n+1, m] points about the 0-th (center) point
+    '''
+    diff = points - points[0]
+    return (diff.T * W) @ diff
+
+
+@njit(cache=True)
+def transition_sigma_points(sigmas, q_center, delta_t):
+    '''
+    Nonlinear transition of all sigma points
+
+    Every point is moved with its own attitude `chart_inv(e, q_center)`.
+    The new center is the attitude of the 0-th (center) point after the transition,
+    and new epsilons are taken in its neighborhood.
+
+    Returns:
+    new_sigmas (np.array): [2n+1, 10]
+    new_center (np.array): [4] quaternion
+    '''
+    m = sigmas.shape[0]
+    new_sigmas = np.empty_like(sigmas)
+    quats = np.empty((m, 4))
+    for i in range(m):
+        s = sigmas[i]
+        q = geometry.chart_inv(np.ascontiguousarray(s[4::2]), q_center)
+        rot_mat = geometry.quat_as_matrix(q)
+        # Coordinates: the robot moves along its local x axis
+        new_sigmas[i, :3] = s[:3] + rot_mat[:, 0] * s[3] * delta_t
+        new_sigmas[i, 3] = s[3]
+        new_sigmas[i, 5::2] = s[5::2]
+        # Attitude
+        q_next = geometry.quat_product(q, rot_vel_to_q(np.ascontiguousarray(s[5::2]), delta_t))
+        quats[i] = q_next / np.sqrt(np.sum(q_next**2))
+    new_center = quats[0].copy()
+    for i in range(m):
+        new_sigmas[i, 4::2] = geometry.chart(quats[i], new_center)
+    return new_sigmas, new_center
+
+
+@njit(cache=True)
+def unscented_predict(x, P, q_center, Q, delta_t, W, lambda_):
+    '''
+    Returns:
+    x, P, q_center after the predict step. x is the moved center point (its epsilon is zero)
+    '''
+    sigmas = sigma_points(x, P, lambda_)
+    new_sigmas, new_center = transition_sigma_points(sigmas, q_center, delta_t)
+    new_P = center_covariance(new_sigmas, W)
+    return new_sigmas[0].copy(), new_P + Q, new_center
+
+
+@njit(cache=True)
+def static_vec_sigma_points(sigmas, q_center, vec, rot_extrinsic):
+    '''
+    Measurement of a vector constant in the world coordinates for every sigma point: [2n+1, 3]
+    '''
+    m = sigmas.shape[0]
+    z = np.empty((m, 3))
+    for i in range(m):
+        q = geometry.chart_inv(np.ascontiguousarray(sigmas[i, 4::2]), q_center)
+        z[i] = rot_extrinsic @ geometry.rotate_vector(vec, geometry.quat_inv(q))
+    return z
+
+
+@njit(cache=True)
+def unscented_static_vec_update(x, P, q_center, z, R, vec, rot_extrinsic, W, lambda_, gate=np.inf):
+    '''
+    Unscented update by a vector measurement (see `measurement.static_vec`).
+    The predicted measurement is the one of the center point, as in the predict step
+
+    Returns:
+    x, P after the update and the squared Mahalanobis distance of the innovation.
+    If it exceeds `gate`, x and P are returned unchanged
+    '''
+    sigmas = sigma_points(x, P, lambda_)
+    z_sigmas = static_vec_sigma_points(sigmas, q_center, vec, rot_extrinsic)
+    z_prior = z_sigmas[0]
+    S = center_covariance(z_sigmas, W) + R
+    y = z - z_prior
+    d2 = y @ np.linalg.solve(S, y)
+    if d2 > gate:
+        return x, P, d2
+    # Cross covariance of the state and the measurement
+    P_xz = ((sigmas - x).T * W) @ (z_sigmas - z_prior)
+    # K = P_xz S^-1  <=>  K^T = S^-1 P_xz^T  (S is symmetric)
+    K = np.linalg.solve(S, P_xz.T).T
+    new_x = x + K @ y
+    new_P = P - K @ S @ K.T
+    new_P = 0.5 * (new_P + new_P.T)
+    return new_x, new_P, d2
@@ -0,0 +1,61 @@
+import time
+
+import numpy as np
+
+from .filter import Filter, KALMAN_UPDATES
+from .unscented import UnscentedFilter
+
+
+def warmup(update_modes=None, filter_classes=(Filter,)):
+    '''
+    Compile (or load from the numba cache) every kernel used by `Filter` (and `UnscentedFilter`)
+
+    Runs predict and all updates with the same argument types as the state estimation node,
+    with `extrinsic=None` and with a [3, 4] extrinsic. Gating, adaptive noise and
+    the fixed-lag smoother (not available in `UnscentedFilter`) are enabled, and the windows
+    are short enough to fill, so that the adapted covariances and the smoothed state are computed.
+    All kernels are declared with `cache=True`, so after the first run
+    the compiled code is stored on disk and later calls only load it.
+
+    Parameters
+    ----------
+        update_modes (list of str): covariance updates to compile. Default: all `KALMAN_UPDATES`
+        filter_classes (tuple): filters to compile
+
+    Returns
+    -------
+        float: seconds spent
+    '''
+    start = time.perf_counter()
+    update_modes = update_modes or list(KALMAN_UPDATES)
+    extrinsic = np.concatenate([np.eye(3), np.zeros([3, 1])], 1)
+    for filter_class in filter_classes:
+        for update_mode in update_modes:
+            kwargs = {} if filter_class is UnscentedFilter else {'smoother_lag': 1}
+            f = filter_class(
+                0.1, 1., 0.1, update_mode=update_mode, adaptive_window=2, gate_probability=0.999, **kwargs
+            )
+            f.predict()
+            for dt in [0.05, None]:
+                f.predict(dt)
+                f.update_odom(np.zeros(2), np.eye(2))
+                for extr in [None, extrinsic]:
+                    f.update_imu(np.array([0, 0, 9.8]), np.eye(3) * 0.1, extr, np.zeros(1), np.eye(1) * 0.01**2)
+            f.predict()
+            f.smooth()
+            f.get_pose_covariance()
+            f.get_twist_covariance()
+    return time.perf_counter() - start
+
+
+def main():
+    '''
+    Populate the numba cache. `colcon build` runs it when installing the package (see setup.py),
+    run it by hand if the build skipped it (SKIP_NUMBA_WARMUP=1):
+        ros2 run state_estimation_25d ekf_warmup
+    '''
+    print(f'ekf kernels compiled in {warmup(filter_classes=(Filter, UnscentedFilter)):.2f} s')
+
+
+if __name__ == '__main__':
+    main()
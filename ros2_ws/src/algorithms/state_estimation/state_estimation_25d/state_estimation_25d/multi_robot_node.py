@@ -0,0 +1,186 @@
+import numpy as np
+
+import rclpy
+from rosbot_controller.motion_model import get_motion_model
+from rclpy.node import Node
+from sensor_msgs.msg import Imu
+from nav_msgs.msg import Odometry
+from geometry_msgs.msg import Twist
+import tf2_ros
+
+from state_estimation_3d.extrinsics import ExtrinsicsCache
+from state_estimation_3d.messages import OdometryPublisher
+
+from .ekf import Filter
+from .ekf.geometry import quat_as_matrix
+from .ekf.warmup import warmup
+
+
+class RobotEstimator:
+    """
+    Filter of one robot hosted by MultiRobotStateEstimation
+    ------------------
+    Attributes:
+    namespace: str
+        Namespace of the robot topics and the prefix of its frames
+    filter: Filter
+        EKF of the robot
+    control: np.array
+        Last control [v, w] from <namespace>/cmd_vel
+    z_odom, R_odom:
+        Last odometry measurement and its covariance, None before the first message
+    z_acc_imu, R_acc_imu, z_rot_vel_imu, R_rot_vel_imu:
+        Last imu measurement and covariances, None before the first message
+    pose_publisher: OdometryPublisher
+        Publish filtered odometry to <namespace>/odom_filtered, the messages are reused
+    """
+    def __init__(self, node, namespace, dt, vel_std, rot_vel_std, gate_probability=0.):
+        self.namespace = namespace
+        self.filter = Filter(dt, vel_std, rot_vel_std, gate_probability=gate_probability)
+        self.control = np.zeros(2)
+        self.z_odom = None
+        self.R_odom = None
+        self.z_acc_imu = None
+        self.R_acc_imu = None
+        self.z_rot_vel_imu = None
+        self.R_rot_vel_imu = np.array([[0.01**2]])
+        node.create_subscription(Odometry, self.topic('odom_noised'), self.odometry_callback, 10)
+        node.create_subscription(Imu, self.topic('imu'), self.imu_callback, 10)
+        node.create_subscription(Twist, self.topic('cmd_vel'), self.control_callback, 15)
+        self.pose_publisher = OdometryPublisher(node, self.topic('odom_filtered'), 'map', self.frame('base_link'))
+
+    def topic(self, name):
+        return f'{self.namespace}/{name}' if self.namespace else name
+
+    def frame(self, name):
+        return self.topic(name)
+
+    def odometry_callback(self, msg):
+        self.z_odom = np.array([msg.twist.twist.linear.x, msg.twist.twist.angular.z])
+        self.R_odom = np.array([
+            [msg.twist.covariance[0], msg.twist.covariance[5]],
+            [msg.twist.covariance[30], msg.twist.covariance[35]],
+        ])
+
+    def imu_callback(self, msg):
+        self.z_rot_vel_imu = np.array([msg.angular_velocity.z])
+        self.z_acc_imu = np.array([
+            msg.linear_acceleration.x,
+            msg.linear_acceleration.y,
+            msg.linear_acceleration.z,
+        ])
+        self.R_acc_imu = np.eye(3) * 0.1
+
+    def control_callback(self, msg):
+        self.control = np.array([msg.linear.x, msg.angular.z])
+
+    def update(self, acc_extrinsic):
+        """
+        Update step with the last measurements
+        """
+        if self.z_odom is not None:
+            self.filter.update_odom(self.z_odom, self.R_odom)
+        if self.z_acc_imu is not None:
+            self.filter.update_imu(self.z_acc_imu, self.R_acc_imu, acc_extrinsic,
+                                   self.z_rot_vel_imu, self.R_rot_vel_imu)
+
+    def publish_pose(self, stamp):
+        """
+        Publish the filtered odometry and return the transform map -> <namespace>/base_link
+        """
+        f = self.filter
+        q = f.q
+        publisher = self.pose_publisher
+        publisher.set_pose(stamp, f.pos, (q[1], q[2], q[3], q[0]))
+        publisher.set_twist(f.v * quat_as_matrix(q)[0], f.rot_vel)
+        f.get_pose_covariance(out=publisher.pose_covariance)
+        f.get_twist_covariance(out=publisher.twist_covariance)
+        publisher.publish()
+        return publisher.fill_transform()
+
+
+class MultiRobotStateEstimation(Node):
+    """
+    ROS2 node which runs the 2.5D state estimation of a fleet in one process
+    ------------------
+    Every robot gets its own RobotEstimator with topics in its namespace:
+        <namespace>/odom_noised, <namespace>/imu, <namespace>/cmd_vel -> <namespace>/odom_filtered
+    and the transform map -> <namespace>/base_link.
+    The robots share the compiled kernels, the NN motion model and the tf listener.
+    All filters are stepped by one timer: the motion model is called once
+    with a batch of all robots, then every filter runs its predict and update steps.
+    ------------------
+    Parameters:
+    robots: list of str
+        Namespaces of the robots
+    period: float
+        Time step of the filters, s
+    vel_std, rot_vel_std: float
+        Process noise of the filters
+    model_path: str
+        Path or url of the NN control model
+    gate_probability: float
+        Probability of the chi-square gate of all updates, 0 disables gating
+    """
+    def __init__(self):
+        super().__init__('state_estimation_25d_fleet')
+        self.declare_parameter('robots', ['robot_0'])
+        self.declare_parameter('period', 0.1)
+        self.declare_parameter('vel_std', 1.0)
+        self.declare_parameter('rot_vel_std', 0.1)
+        self.declare_parameter('gate_probability', 0.999)
+        self.declare_parameter(
+            'model_path', 'http://192.168.194.51:8345/ml-control/gz-rosbot/new_model_dynamic_batch.onnx'
+        )
+        namespaces = self.get_parameter('robots').get_parameter_value().string_array_value
+        self.dt = self.get_parameter('period').get_parameter_value().double_value
+        vel_std = self.get_parameter('vel_std').get_parameter_value().double_value
+        rot_vel_std = self.get_parameter('rot_vel_std').get_parameter_value().double_value
+        model_path = self.get_parameter('model_path').get_parameter_value().string_value
+        gate_probability = self.get_parameter('gate_probability').get_parameter_value().double_value
+
+        self.model = get_motion_model(model_path)
+        self.robots = [
+            RobotEstimator(self, ns, self.dt, vel_std, rot_vel_std, gate_probability) for ns in namespaces
+        ]
+        # Rows [v, w, u_v, u_w, dt] of the batched motion model call
+        self.model_input = np.zeros([len(self.robots), 5])
+
+        self.tf2_broadcaster = tf2_ros.TransformBroadcaster(self)
+        self.tf_buffer = tf2_ros.Buffer()
+        self.tf_listener = tf2_ros.TransformListener(self.tf_buffer, self)
+        self.extrinsics = ExtrinsicsCache(self, self.tf_buffer)
+
+        # Kernels are compiled once for all robots
+        warmup_time = warmup(update_modes=[self.robots[0].filter.update_mode] if self.robots else None)
+        print(f'ekf warm-up: {warmup_time:.2f} s')
+        print(f'Estimating the state of {len(self.robots)} robots: {", ".join(namespaces)}')
+        self.create_timer(self.dt, self.step)
+
+    def step(self):
+        """
+        Kalman filter iteration of all robots
+        """
+        for i, robot in enumerate(self.robots):
+            self.model_input[i] = (robot.filter.v, robot.filter.w_yaw, robot.control[0], robot.control[1], self.dt)
+        velocities = self.model.predict_batch(self.model_input)
+
+        stamp = self.get_clock().now().to_msg()
+        transforms = []
+        for robot, (v, w_yaw) in zip(self.robots, velocities):
+            robot.filter.predict_by_velocities(v, w_yaw, self.dt)
+            robot.update(self.extrinsics.get(robot.frame('base_link'), robot.frame('base_link')))
+            transforms.append(robot.publish_pose(stamp))
+        self.tf2_broadcaster.sendTransform(transforms)
+
+
+def main(args=None):
+    rclpy.init(args=args)
+    node = MultiRobotStateEstimation()
+    rclpy.spin(node)
+    node.destroy_node()
+    rclpy.shutdown()
+
+
+if __name__ == '__main__':
+    main()
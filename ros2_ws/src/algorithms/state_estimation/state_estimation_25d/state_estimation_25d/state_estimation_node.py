@@ -1,17 +1,28 @@
+import threading
+
 import numpy as np
-from scipy.spatial.transform import Rotation
 
 import rclpy
-import nnio
+from rosbot_controller.motion_model import get_motion_model
 from rclpy.node import Node
+from rclpy.executors import MultiThreadedExecutor
+from rclpy.callback_groups import MutuallyExclusiveCallbackGroup
 from sensor_msgs.msg import Imu
 from nav_msgs.msg import Odometry
 from geometry_msgs.msg import Twist
+from diagnostic_msgs.msg import DiagnosticArray
 from cv_bridge import CvBridge
 import tf2_ros
 
-from .filter import Filter
-from .geometry import *
+from state_estimation_3d.extrinsics import ExtrinsicsCache
+from state_estimation_3d.adaptive import noise_diagnostics
+from state_estimation_3d.gating import gating_diagnostics
+from state_estimation_3d.messages import OdometryPublisher, fill_covariance
+
+from .ekf import Filter
+from .ekf.filter import POSE_COVARIANCE_INDEX, fill_twist_covariance
+from .ekf.geometry import *
+from .ekf.warmup import warmup
 
 class StateEstimation(Node):
     """
@@ -27,12 +38,16 @@ class StateEstimation(Node):
         Subscriber to imu
     cmd_vel_sub: ros::Subscriber
         Subscriber to controls from cmd_vel
-    pose_publisher: ros::Publisher
+    pose_publisher: OdometryPublisher
         Publish filtered odometry to /odom_filtered
+    smoothed_pose_publisher: OdometryPublisher
+        Publish fixed-lag smoothed odometry to /odom_filtered_smoothed
     tf2_broadcaster: ros::TransformBroadcaster
     tf2_buffer: 
     tf_listener:
         Variables for obtaining transforms between frames
+    extrinsics: ExtrinsicsCache
+        Static transforms between frames, looked up once
     model_path: str
         Path to file with NN control model
     model: ONNXModel
@@ -65,39 +80,74 @@ class StateEstimation(Node):
         Std for angular velocity noise
     filter: Filter2D
         EKF
+    event_driven: bool
+        If true, every measurement predicts the filter to its stamp and is fused at once
+    publish_period: float
+        Event-driven mode: period of the pose publisher, 0 means publishing after every measurement
+    filter_stamp: float
+        Event-driven mode: time of the filter state
+    smoother_lag: float
+        Lag of the fixed-lag smoother, s. 0 disables the smoothed output
+    event_rate: float
+        Event-driven mode: expected rate of predict steps (all sensor messages together), Hz.
+        The smoother keeps a number of steps, it is `smoother_lag` times this rate
+    adaptive_window: int
+        If > 0, R and Q are adapted online over this number of updates (see Filter)
+        and the adapted values are published to /diagnostics once a second
+    gate_probability: float
+        Probability of the chi-square gate of all updates (see Filter), 0 disables gating.
+        The numbers of accepted and rejected measurements are published to /diagnostics once a second
     """
     def __init__(self):
         super().__init__('state_estimation_25d')
 
+        self.declare_parameter('event_driven', False)
+        self.declare_parameter('publish_period', 0.0)
+        self.declare_parameter('smoother_lag', 0.5)
+        self.declare_parameter('event_rate', 100.0)
+        self.declare_parameter('adaptive_window', 0)
+        self.declare_parameter('gate_probability', 0.999)
+        self.event_driven = self.get_parameter('event_driven').get_parameter_value().bool_value
+        self.publish_period = self.get_parameter('publish_period').get_parameter_value().double_value
+        self.smoother_lag = self.get_parameter('smoother_lag').get_parameter_value().double_value
+        self.event_rate = self.get_parameter('event_rate').get_parameter_value().double_value
+        self.adaptive_window = self.get_parameter('adaptive_window').get_parameter_value().integer_value
+        self.gate_probability = self.get_parameter('gate_probability').get_parameter_value().double_value
+        self.sensor_group = MutuallyExclusiveCallbackGroup()
+        self.publish_group = MutuallyExclusiveCallbackGroup()
+        self.lock = threading.Lock()
+
         self.odom_sub = self.create_subscription(
             Odometry,
             'odom_noised',
             self.odometry_callback,
             10,
+            callback_group=self.sensor_group,
         )
         self.imu_sub = self.create_subscription(
             Imu,
             'imu',
             self.imu_callback,
             10,
+            callback_group=self.sensor_group,
         )
         self.cmd_vel_sub = self.create_subscription(
             Twist,
             'cmd_vel',
             self.control_callback,
             15,
-        )
-        self.pose_publisher = self.create_publisher(
-            Odometry,
-            'odom_filtered',
-            10,
+            callback_group=self.sensor_group,
         )
         self.tf2_broadcaster = tf2_ros.TransformBroadcaster(self)
+        # The Odometry and TransformStamped messages are allocated once and reused
+        self.pose_publisher = OdometryPublisher(self, 'odom_filtered', 'map', 'base_link', self.tf2_broadcaster)
+        self.smoothed_pose_publisher = OdometryPublisher(self, 'odom_filtered_smoothed', 'map', 'base_link')
         self.tf_buffer = tf2_ros.Buffer()
         self.tf_listener = tf2_ros.TransformListener(self.tf_buffer, self)
+        self.extrinsics = ExtrinsicsCache(self, self.tf_buffer)
 
         self.model_path = 'http://192.168.194.51:8345/ml-control/gz-rosbot/new_model_dynamic_batch.onnx'
-        self.model = nnio.ONNXModel(self.model_path)
+        self.model = get_motion_model(self.model_path)
 
         self.odom = None
         self.imu = None
@@ -112,13 +162,29 @@ class StateEstimation(Node):
         self.dt = 0.1
         self.vel_std = 1.0
         self.rot_vel_std = 0.1
+        # Time between predict steps, it converts the smoother lag to steps
+        step_period = 1 / self.event_rate if self.event_driven else self.dt
         self.filter = Filter(
             self.dt,
             self.vel_std,
             self.rot_vel_std,
+            smoother_lag=int(round(self.smoother_lag / step_period)),
+            adaptive_window=self.adaptive_window,
+            gate_probability=self.gate_probability,
         )
+        # Load compiled kernels from the numba cache (or compile them) before the first step
+        print(f'ekf warm-up: {warmup(update_modes=[self.filter.update_mode]):.2f} s')
+
+        self.filter_stamp = self.get_time()
+
+        if not self.event_driven:
+            self.create_timer(self.dt, self.step, callback_group=self.sensor_group)
+        elif self.publish_period > 0:
+            self.create_timer(self.publish_period, self.publish_callback, callback_group=self.publish_group)
 
-        self.create_timer(self.dt, self.step)
+        if self.adaptive_window > 0 or self.gate_probability > 0:
+            self.diagnostics_publisher = self.create_publisher(DiagnosticArray, '/diagnostics', 10)
+            self.create_timer(1.0, self.publish_diagnostics, callback_group=self.publish_group)
 
     def odometry_callback(self, msg):
         """
@@ -128,6 +194,11 @@ class StateEstimation(Node):
         """
         self.odom = msg
         self.set_odometry_measurement()
+        if self.event_driven:
+            with self.lock:
+                self.predict_to(self.stamp_to_sec(msg.header.stamp))
+                self.filter.update_odom(self.z_odom, self.R_odom)
+            self.publish_event()
     
     def imu_callback(self, msg):
         """
@@ -137,6 +208,13 @@ class StateEstimation(Node):
         """
         self.imu = msg
         self.set_imu_measurement()
+        if self.event_driven:
+            with self.lock:
+                self.predict_to(self.stamp_to_sec(msg.header.stamp))
+                self.get_imu_extrinsic()
+                self.filter.update_imu(self.z_acc_imu, self.R_acc_imu, self.imu_acc_extrinsic,
+                                       self.z_rot_vel_imu, self.R_rot_vel_imu)
+            self.publish_event()
     
     def control_callback(self, msg):
         """
@@ -150,21 +228,71 @@ class StateEstimation(Node):
         """
         Kalman filter iteration
         """
-        # Predict step
-        self.filter.predict_by_nn_model(self.model, self.control)
-        if self.odom is not None:
-            # Update odometry
-            self.filter.update_odom(self.z_odom, self.R_odom)
-        if self.imu is not None:
-            # Update imu
-            self.get_imu_extrinsic()
-            self.filter.update_imu(self.z_acc_imu, self.R_acc_imu, self.imu_acc_extrinsic,
-                                   self.z_rot_vel_imu, self.R_rot_vel_imu)
-        # Publish filtered pose
-        self.publish_pose()
+        # The publish group reads the filter concurrently
+        with self.lock:
+            # Predict step
+            self.filter.predict_by_nn_model(self.model, self.control, stamp=self.get_time())
+            if self.odom is not None:
+                # Update odometry
+                self.filter.update_odom(self.z_odom, self.R_odom)
+            if self.imu is not None:
+                # Update imu
+                self.get_imu_extrinsic()
+                self.filter.update_imu(self.z_acc_imu, self.R_acc_imu, self.imu_acc_extrinsic,
+                                       self.z_rot_vel_imu, self.R_rot_vel_imu)
+            # Publish filtered pose
+            self.publish_pose()
+
+    def predict_to(self, stamp):
+        """
+        Event-driven mode: predict the filter state up to `stamp` with a variable time step
+        @ parameters
+        stamp: float
+            Time in seconds
+        """
+        dt = stamp - self.filter_stamp
+        if dt > 0:
+            self.filter.predict_by_nn_model(self.model, self.control, dt, stamp)
+            self.filter_stamp = stamp
+
+    def publish_event(self):
+        """
+        Event-driven mode: publish the pose right after a measurement if there is no publisher timer
+        """
+        if self.publish_period <= 0:
+            self.publish_callback()
+
+    def publish_callback(self):
+        with self.lock:
+            self.publish_pose()
+
+    def publish_diagnostics(self):
+        """
+        Publish the adapted noise covariances and the gating counters of the filter
+        """
+        msg = DiagnosticArray()
+        msg.header.stamp = self.get_clock().now().to_msg()
+        with self.lock:
+            if self.adaptive_window > 0:
+                msg.status.append(noise_diagnostics(
+                    self.get_name(), self.filter.noise_estimators, self.filter.process_noise_estimator
+                ))
+            if self.filter.gate.enabled:
+                msg.status.append(gating_diagnostics(self.get_name(), self.filter.gate))
+        self.diagnostics_publisher.publish(msg)
+
+    def get_time(self):
+        """
+        Returns current ROS time in seconds
+        """
+        return self.stamp_to_sec(self.get_clock().now().to_msg())
+
+    @staticmethod
+    def stamp_to_sec(stamp):
+        return stamp.sec + stamp.nanosec * 1e-9
 
     def get_imu_extrinsic(self):
-        self.imu_acc_extrinsic = self.get_extrinsic('base_link', 'base_link')
+        self.imu_acc_extrinsic = self.extrinsics.get('base_link', 'base_link')
 
     def set_odometry_measurement(self):
         """
@@ -190,90 +318,53 @@ class StateEstimation(Node):
             self.imu.linear_acceleration.y,
             self.imu.linear_acceleration.z,
         ])
-        self.R_rot_vel_imu = np.array([0.01**2])
+        self.R_rot_vel_imu = np.array([[0.01**2]])
         self.R_acc_imu = np.array([
             [0.1, 0, 0],
             [0, 0.1, 0],
             [0, 0, 0.1]
         ])
     
-    def get_extrinsic(self, frame1, frame2):
-        '''
-        Parameters:
-        frame1 (str): tf frame
-        frame2 (str): tf frame
-
-        Returns:
-        np.array of shape [3, 4]: rotation-translation matrix between two tf frames.
-        '''
-        trans = self.tf_buffer.lookup_transform(frame1, frame2, self.get_clock().now())
-        tr = np.array([
-            [trans.transform.translation.x],
-            [trans.transform.translation.y],
-            [trans.transform.translation.z],
-        ])
-        rot_q = np.array([
-            trans.transform.rotation.x,
-            trans.transform.rotation.y,
-            trans.transform.rotation.z,
-            trans.transform.rotation.w,
-        ])
-        rot = Rotation.from_quat(rot_q).as_matrix()
-        extrinsic = np.concatenate([rot, tr], 1)
-        return extrinsic
-
     def publish_pose(self):
-        # Make odometry message
-        msg = Odometry()
-        msg.header.stamp = self.get_clock().now().to_msg()
-        msg.header.frame_id = 'map'
-        msg.child_frame_id = 'base_link'
-        # Position
-        msg.pose.pose.position.x = self.filter.pos[0]
-        msg.pose.pose.position.y = self.filter.pos[1]
-        msg.pose.pose.position.z = self.filter.pos[2]
-        # Angle
-        msg.pose.pose.orientation.w = self.filter.q[0]
-        msg.pose.pose.orientation.x = self.filter.q[1]
-        msg.pose.pose.orientation.y = self.filter.q[2]
-        msg.pose.pose.orientation.z = self.filter.q[3]
-        # Pose & angle covariance
-        msg.pose.covariance = self.filter.get_pose_covariance()
-        # Velocity
-        vel_local = np.array([self.filter.v, 0, 0])
-        rot_mat = quat_as_matrix(self.filter.q)
-        vel_global = rot_mat.T @ vel_local
-        msg.twist.twist.linear.x = vel_global[0]
-        msg.twist.twist.linear.y = vel_global[1]
-        msg.twist.twist.linear.z = vel_global[2]
-        # Angular velocity
-        msg.twist.twist.angular.x = self.filter.rot_vel[0]
-        msg.twist.twist.angular.y = self.filter.rot_vel[1]
-        msg.twist.twist.angular.z = self.filter.rot_vel[2]
-        # Vel & angvel covariance
-        msg.twist.covariance = self.filter.get_twist_covariance()
-        # Publish
-        self.pose_publisher.publish(msg)
+        # Pose (filter quaternion is w, x, y, z)
+        publisher = self.pose_publisher
+        q = self.filter.q
+        publisher.set_pose(self.get_clock().now().to_msg(), self.filter.pos, (q[1], q[2], q[3], q[0]))
+        # Velocity: rot_mat.T @ [v, 0, 0]
+        vel_global = self.filter.v * quat_as_matrix(q)[0]
+        publisher.set_twist(vel_global, self.filter.rot_vel)
+        # Covariances are written directly into the message arrays
+        self.filter.get_pose_covariance(out=publisher.pose_covariance)
+        self.filter.get_twist_covariance(out=publisher.twist_covariance)
+        # Publish the pose and broadcast the transform
+        publisher.publish()
+
+        self.publish_smoothed_pose()
 
-        # Broadcast tf2
-        t = tf2_ros.TransformStamped()
-        t.header = msg.header
-        t.child_frame_id = 'base_link'
-        t.transform.translation.x = self.filter.pos[0]
-        t.transform.translation.y = self.filter.pos[1]
-        t.transform.translation.z = self.filter.pos[2]
-        t.transform.rotation.w = self.filter.q[0]
-        t.transform.rotation.x = self.filter.q[1]
-        t.transform.rotation.y = self.filter.q[2]
-        t.transform.rotation.z = self.filter.q[3]
-        self.tf2_broadcaster.sendTransform(t)
+    def publish_smoothed_pose(self):
+        """
+        Publish the fixed-lag smoothed pose with the stamp of the smoothed filter step
+        """
+        smoothed = self.filter.smooth()
+        if smoothed is None:
+            return
+        stamp, x, P, q = smoothed
+        publisher = self.smoothed_pose_publisher
+        publisher.set_pose(rclpy.time.Time(nanoseconds=int(stamp * 1e9)).to_msg(), x[:3], (q[1], q[2], q[3], q[0]))
+        publisher.set_twist(x[3] * quat_as_matrix(q)[0], x[5::2])
+        fill_covariance(publisher.pose_covariance, P, POSE_COVARIANCE_INDEX)
+        fill_twist_covariance(publisher.twist_covariance, P, q)
+        publisher.publish()
 
 def main(args=None):
     print('Hi from state_estimation_25d.')
 
     rclpy.init(args=args)
     node = StateEstimation()
-    rclpy.spin(node)
+    # Sensor callbacks and the pose publisher run in separate callback groups
+    executor = MultiThreadedExecutor()
+    executor.add_node(node)
+    executor.spin()
 
     # Destroy the node explicitly
     # (optional - otherwise it will be done automatically
@@ -1,3 +1,5 @@
+from collections import deque
+
 import numpy as np
 from nav_msgs.msg import Odometry
 
@@ -40,3 +42,238 @@ class ErrorEstimator():
         self.ate_distance += np.sqrt(dst_sqr)
         self.ate_distance_sqr += dst_sqr
         self.num_points += 1
+
+
+class WindowStat():
+    """
+    Running sum of the last `size` values, updated in O(1) per value
+    """
+    def __init__(self, size):
+        self.values = np.zeros(size)
+        self.size = size
+        self.count = 0
+        self.sum = 0.
+
+    def add(self, value):
+        i = self.count % self.size
+        if self.count >= self.size:
+            self.sum -= self.values[i]
+        self.values[i] = value
+        self.sum += value
+        self.count += 1
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+
+class OnlineEvaluator():
+    """
+    Streaming accuracy of an estimated trajectory relative to ground truth
+    ---------------------------
+    Both streams are kept in ring buffers sorted by time. Every estimate is associated
+    with ground truth at the same stamp by interpolating between the two neighbouring
+    ground-truth samples (estimates newer than the last ground truth wait for it).
+    Associated pairs give:
+        ATE: position error, RMSE over all pairs and over the last `window` pairs
+        RPE: error of the relative motion over `rpe_delta` seconds (translation and rotation)
+        drift per meter: RPE translation error divided by the ground-truth path length of the segment
+    Stream positions are kept by cursors, so every sample costs O(1) (amortized).
+    Quaternions are in ROS order (x, y, z, w).
+    ---------------------------
+    Attributes:
+    ate_rmse: float
+    ate_window_rmse: float
+    rpe_trans_rmse: float
+        Over the last `window` RPE segments
+    rpe_rot_rmse: float
+        Over the last `window` RPE segments, radians
+    drift_per_meter: float
+        Over the last `window` RPE segments
+    distance: float
+        Ground-truth path length
+    num_points: int
+        Number of associated pairs
+    """
+    def __init__(self, capacity=2000, window=500, rpe_delta=1.0, max_gap=0.5):
+        self.capacity = capacity
+        self.rpe_delta = rpe_delta
+        self.max_gap = max_gap
+        # Ground truth: stamp, position, quaternion, path length from the start
+        self.gt_stamps = np.zeros(capacity)
+        self.gt_pos = np.zeros((capacity, 3))
+        self.gt_quat = np.zeros((capacity, 4))
+        self.gt_dist = np.zeros(capacity)
+        self.gt_start = 0
+        self.gt_end = 0
+        self.gt_cursor = 0
+        # Estimates waiting for newer ground truth
+        self.pending = deque(maxlen=capacity)
+        # Associated pairs
+        self.pair_stamps = np.zeros(capacity)
+        self.pair_gt_pos = np.zeros((capacity, 3))
+        self.pair_gt_quat = np.zeros((capacity, 4))
+        self.pair_est_pos = np.zeros((capacity, 3))
+        self.pair_est_quat = np.zeros((capacity, 4))
+        self.pair_dist = np.zeros(capacity)
+        self.pair_end = 0
+        self.rpe_cursor = 0
+        # Statistics
+        self.ate_sqr_sum = 0.
+        self.num_points = 0
+        self.ate_window = WindowStat(window)
+        self.rpe_trans_window = WindowStat(window)
+        self.rpe_rot_window = WindowStat(window)
+        self.drift_error_window = WindowStat(window)
+        self.drift_length_window = WindowStat(window)
+
+    def add_ground_truth(self, stamp, position, quaternion):
+        """Add a ground truth pose. Samples older than the newest one are ignored"""
+        if self.gt_end > self.gt_start and stamp <= self.gt_stamps[(self.gt_end - 1) % self.capacity]:
+            return
+        i = self.gt_end % self.capacity
+        if self.gt_end > self.gt_start:
+            prev = (self.gt_end - 1) % self.capacity
+            self.gt_dist[i] = self.gt_dist[prev] + np.linalg.norm(np.asarray(position) - self.gt_pos[prev])
+        else:
+            self.gt_dist[i] = 0.
+        self.gt_stamps[i] = stamp
+        self.gt_pos[i] = position
+        self.gt_quat[i] = quaternion
+        self.gt_end += 1
+        self.gt_start = max(self.gt_start, self.gt_end - self.capacity)
+        # Estimates which waited for this ground truth
+        while self.pending and self.pending[0][0] <= stamp:
+            self._associate(*self.pending.popleft())
+
+    def add_estimate(self, stamp, position, quaternion):
+        """Add an estimated pose. It is evaluated as soon as ground truth covers its stamp"""
+        if self.gt_end > self.gt_start and stamp <= self.gt_stamps[(self.gt_end - 1) % self.capacity]:
+            self._associate(stamp, np.array(position, dtype=float), np.array(quaternion, dtype=float))
+        else:
+            self.pending.append((stamp, np.array(position, dtype=float), np.array(quaternion, dtype=float)))
+
+    def _associate(self, stamp, est_pos, est_quat):
+        cap = self.capacity
+        if self.gt_end == self.gt_start or stamp < self.gt_stamps[self.gt_start % cap]:
+            return
+        # Move the cursor to the last ground truth sample not newer than `stamp`
+        self.gt_cursor = max(self.gt_cursor, self.gt_start)
+        if self.gt_stamps[self.gt_cursor % cap] > stamp:
+            # An estimate older than the previous one
+            self.gt_cursor = self.gt_start
+        while self.gt_cursor + 1 < self.gt_end and self.gt_stamps[(self.gt_cursor + 1) % cap] <= stamp:
+            self.gt_cursor += 1
+        i0 = self.gt_cursor % cap
+        if self.gt_cursor + 1 < self.gt_end:
+            i1 = (self.gt_cursor + 1) % cap
+            gap = self.gt_stamps[i1] - self.gt_stamps[i0]
+            if gap > self.max_gap:
+                return
+            a = (stamp - self.gt_stamps[i0]) / gap
+            gt_pos = (1 - a) * self.gt_pos[i0] + a * self.gt_pos[i1]
+            gt_quat = quat_nlerp(self.gt_quat[i0], self.gt_quat[i1], a)
+            gt_dist = (1 - a) * self.gt_dist[i0] + a * self.gt_dist[i1]
+        else:
+            gt_pos = self.gt_pos[i0]
+            gt_quat = self.gt_quat[i0]
+            gt_dist = self.gt_dist[i0]
+        self._add_pair(stamp, gt_pos, gt_quat, gt_dist, est_pos, est_quat)
+
+    def _add_pair(self, stamp, gt_pos, gt_quat, gt_dist, est_pos, est_quat):
+        cap = self.capacity
+        j = self.pair_end % cap
+        self.pair_stamps[j] = stamp
+        self.pair_gt_pos[j] = gt_pos
+        self.pair_gt_quat[j] = gt_quat
+        self.pair_est_pos[j] = est_pos
+        self.pair_est_quat[j] = est_quat
+        self.pair_dist[j] = gt_dist
+        self.pair_end += 1
+
+        # ATE
+        ate_sqr = np.sum((est_pos - gt_pos)**2)
+        self.ate_sqr_sum += ate_sqr
+        self.num_points += 1
+        self.ate_window.add(ate_sqr)
+
+        # RPE: the last pair at least `rpe_delta` older than this one
+        start = max(self.pair_end - cap, 0)
+        self.rpe_cursor = max(self.rpe_cursor, start)
+        while (self.rpe_cursor + 1 < self.pair_end
+               and self.pair_stamps[(self.rpe_cursor + 1) % cap] <= stamp - self.rpe_delta):
+            self.rpe_cursor += 1
+        i = self.rpe_cursor % cap
+        if self.rpe_cursor == self.pair_end - 1 or self.pair_stamps[i] > stamp - self.rpe_delta:
+            return
+        gt_delta_pos = quat_rotate_inv(self.pair_gt_quat[i], gt_pos - self.pair_gt_pos[i])
+        est_delta_pos = quat_rotate_inv(self.pair_est_quat[i], est_pos - self.pair_est_pos[i])
+        gt_delta_quat = quat_product(quat_conj(self.pair_gt_quat[i]), gt_quat)
+        est_delta_quat = quat_product(quat_conj(self.pair_est_quat[i]), est_quat)
+        trans_error = np.linalg.norm(est_delta_pos - gt_delta_pos)
+        rot_error = quat_angle(quat_product(quat_conj(gt_delta_quat), est_delta_quat))
+        self.rpe_trans_window.add(trans_error**2)
+        self.rpe_rot_window.add(rot_error**2)
+        self.drift_error_window.add(trans_error)
+        self.drift_length_window.add(gt_dist - self.pair_dist[i])
+
+    @property
+    def ate_rmse(self):
+        return np.sqrt(self.ate_sqr_sum / self.num_points) if self.num_points else np.nan
+
+    @property
+    def ate_window_rmse(self):
+        n = len(self.ate_window)
+        return np.sqrt(max(self.ate_window.sum, 0.) / n) if n else np.nan
+
+    @property
+    def rpe_trans_rmse(self):
+        n = len(self.rpe_trans_window)
+        return np.sqrt(max(self.rpe_trans_window.sum, 0.) / n) if n else np.nan
+
+    @property
+    def rpe_rot_rmse(self):
+        n = len(self.rpe_rot_window)
+        return np.sqrt(max(self.rpe_rot_window.sum, 0.) / n) if n else np.nan
+
+    @property
+    def drift_per_meter(self):
+        length = self.drift_length_window.sum
+        return self.drift_error_window.sum / length if length > 1e-6 else np.nan
+
+    @property
+    def distance(self):
+        if self.gt_end == self.gt_start:
+            return 0.
+        return self.gt_dist[(self.gt_end - 1) % self.capacity]
+
+
+"""Quaternion helpers, (x, y, z, w) order"""
+
+def quat_conj(q):
+    return np.array([-q[0], -q[1], -q[2], q[3]])
+
+def quat_product(q1, q2):
+    x1, y1, z1, w1 = q1
+    x2, y2, z2, w2 = q2
+    return np.array([
+        w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+        w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+        w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2,
+        w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2,
+    ])
+
+def quat_rotate_inv(q, v):
+    """Rotate vector v by the inverse of unit quaternion q"""
+    u = -q[:3]
+    t = 2 * np.cross(u, v)
+    return v + q[3] * t + np.cross(u, t)
+
+def quat_angle(q):
+    """Rotation angle of a unit quaternion, radians"""
+    return 2 * np.arctan2(np.linalg.norm(q[:3]), abs(q[3]))
+
+def quat_nlerp(q1, q2, a):
+    if np.dot(q1, q2) < 0:
+        q2 = -q2
+    q = (1 - a) * q1 + a * q2
+    return q / np.linalg.norm(q)
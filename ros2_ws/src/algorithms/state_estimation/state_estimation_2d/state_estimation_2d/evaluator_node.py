@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+import rclpy
+from rclpy.node import Node
+from nav_msgs.msg import Odometry
+from std_msgs.msg import Float64
+
+from state_estimation_2d.ate import OnlineEvaluator
+
+
+class EvaluatorNode(Node):
+    """
+    Online evaluation of a state estimator against ground truth
+    ------------------
+    Subscribes to two Odometry streams, associates them by header stamps
+    and publishes streaming metrics (see OnlineEvaluator) as Float64 topics:
+        evaluation/ate, evaluation/ate_window, evaluation/rpe_trans,
+        evaluation/rpe_rot (degrees), evaluation/drift_per_meter, evaluation/distance
+    ------------------
+    Parameters:
+    ground_truth_topic: str
+    estimate_topic: str
+    publish_period: float
+        Period of the metrics publisher, s
+    window: int
+        Number of samples in the sliding windows
+    rpe_delta: float
+        Time delta of RPE segments, s
+    max_gap: float
+        Ground truth samples further apart are not interpolated, s
+    buffer_size: int
+        Capacity of the ring buffers
+    """
+    def __init__(self):
+        super().__init__('evaluator')
+        self.declare_parameter('ground_truth_topic', '/odom')
+        self.declare_parameter('estimate_topic', '/odom_filtered')
+        self.declare_parameter('publish_period', 1.0)
+        self.declare_parameter('window', 500)
+        self.declare_parameter('rpe_delta', 1.0)
+        self.declare_parameter('max_gap', 0.5)
+        self.declare_parameter('buffer_size', 2000)
+        ground_truth_topic = self.get_parameter('ground_truth_topic').get_parameter_value().string_value
+        estimate_topic = self.get_parameter('estimate_topic').get_parameter_value().string_value
+        publish_period = self.get_parameter('publish_period').get_parameter_value().double_value
+
+        self.evaluator = OnlineEvaluator(
+            capacity=self.get_parameter('buffer_size').get_parameter_value().integer_value,
+            window=self.get_parameter('window').get_parameter_value().integer_value,
+            rpe_delta=self.get_parameter('rpe_delta').get_parameter_value().double_value,
+            max_gap=self.get_parameter('max_gap').get_parameter_value().double_value,
+        )
+
+        self.create_subscription(Odometry, ground_truth_topic, self.ground_truth_callback, 50)
+        self.create_subscription(Odometry, estimate_topic, self.estimate_callback, 50)
+        self.metric_publishers = {
+            name: self.create_publisher(Float64, 'evaluation/' + name, 10)
+            for name in ['ate', 'ate_window', 'rpe_trans', 'rpe_rot', 'drift_per_meter', 'distance']
+        }
+        self.create_timer(publish_period, self.publish_metrics)
+
+    def ground_truth_callback(self, msg):
+        self.evaluator.add_ground_truth(*self.odometry_to_pose(msg))
+
+    def estimate_callback(self, msg):
+        self.evaluator.add_estimate(*self.odometry_to_pose(msg))
+
+    def odometry_to_pose(self, msg):
+        """Returns stamp (s), position and quaternion (x, y, z, w) of an Odometry message"""
+        stamp = msg.header.stamp.sec + msg.header.stamp.nanosec * 1e-9
+        p = msg.pose.pose.position
+        q = msg.pose.pose.orientation
+        return stamp, (p.x, p.y, p.z), (q.x, q.y, q.z, q.w)
+
+    def metrics(self):
+        e = self.evaluator
+        return {
+            'ate': e.ate_rmse,
+            'ate_window': e.ate_window_rmse,
+            'rpe_trans': e.rpe_trans_rmse,
+            'rpe_rot': e.rpe_rot_rmse * 180 / 3.141592653589793,
+            'drift_per_meter': e.drift_per_meter,
+            'distance': e.distance,
+        }
+
+    def publish_metrics(self):
+        for name, value in self.metrics().items():
+            msg = Float64()
+            msg.data = float(value)
+            self.metric_publishers[name].publish(msg)
+
+
+def main():
+    rclpy.init()
+    node = EvaluatorNode()
+    try:
+        rclpy.spin(node)
+    except KeyboardInterrupt:
+        print('Evaluated poses:', node.evaluator.num_points)
+        for name, value in node.metrics().items():
+            print(f'{name}: {value:.4f}')
+    node.destroy_node()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,11 @@ import numpy as np
 from numpy.linalg import inv
 import math
 import scipy
+from numba import njit
 
+from state_estimation_3d.smoother import FixedLagSmoother
+from state_estimation_3d.adaptive import InnovationNoiseEstimator, ProcessNoiseEstimator
+from state_estimation_3d.gating import ChiSquareGate
 from state_estimation_2d.model import *
 from state_estimation_2d.measurement import *
 
@@ -55,10 +59,25 @@ class Filter2D:
         Previous angular velocity control
     eps_w: float
         Threshold for angular velocity
+    stamp: float
+        Time of the current state, s (sum of predict steps)
+    smoother: FixedLagSmoother or None
+        Fixed-lag RTS smoother over the last `smoother_lag` predict steps, see `smooth`
+    adaptive_window: int
+        If > 0, R of every update type and Q are adapted by covariance matching
+        over this number of updates / predict steps. The R passed to an update is then
+        only its initial value
+    noise_estimators: dict
+        Update name -> InnovationNoiseEstimator
+    process_noise_estimator: ProcessNoiseEstimator or None
+    gate: ChiSquareGate
+        Mahalanobis gating of all updates and the numbers of accepted and rejected measurements
+        per update name. Disabled if `gate_probability` is 0
     """
-    def __init__(self, x_init, P_init, dt, v_var, w_var):
-        self.x_opt = x_init
-        self.P_opt = P_init
+    def __init__(self, x_init, P_init, dt, v_var, w_var, smoother_lag=0, adaptive_window=0, gate_probability=0.):
+        # Compiled kernels change the state in place, so it is stored as contiguous float64 arrays
+        self.x_opt = np.ascontiguousarray(x_init, dtype=np.float64)
+        self.P_opt = np.ascontiguousarray(P_init, dtype=np.float64)
         self.dt = dt
         self.control = np.zeros(2)
         self.eps_w = 0.001
@@ -75,98 +94,168 @@ class Filter2D:
             Q_rot,
         )
 
-    def predict_by_nn_model(self, model, control):
+        # Work buffers of the compiled kernels, allocated once
+        self._F = np.eye(5)
+        self._FP = np.zeros((5, 5))
+        self._H = np.zeros((2, 5))
+        self._PHt = np.zeros((5, 2))
+        self._HP = np.zeros((2, 5))
+        self._y = np.zeros(2)
+        self._h = np.zeros(5)
+        self._Ph = np.zeros(5)
+        self._hP = np.zeros(5)
+
+        self.stamp = 0.
+        self.smoother = FixedLagSmoother(5, smoother_lag) if smoother_lag > 0 else None
+
+        self.adaptive_window = adaptive_window
+        self.noise_estimators = {}
+        self.process_noise_estimator = None
+        if adaptive_window > 0:
+            self.process_noise_estimator = ProcessNoiseEstimator(self.Q, adaptive_window)
+            self._x_prior = self.x_opt.copy()
+            self._q_scale = 1.
+        self.gate = ChiSquareGate(gate_probability)
+
+    def predict_by_nn_model(self, model, control, dt=None, stamp=None):
         """
         Kalman filter predict step
         @ parameters
-        model: 
+        model: rosbot_controller.motion_model.MotionModel
             Pretrained NN control model
+        dt: float
+            Time step. Default: self.dt
+        stamp: float
+            Time of the predicted state. Default: self.stamp + dt
         @ return 
         x_opt:
             State vector after predict step
         P_opt:
             Covariance matrix after predict step
         """
-        model_input = np.array([[self.v, self.w, control[0], control[1], self.dt]], 
-                                dtype=np.float32)
-        model_output = model(model_input)
+        dt = dt or self.dt
+        self._finish_step()
         # Predicted velocity control
-        self.v, self.w = float(model_output[0][0]), float(model_output[0][1])
-        self.predict()
+        self.v, self.w = model.predict(self.v, self.w, control[0], control[1], dt)
+        self._predict(dt, stamp)
 
-    def predict_by_naive_model(self, control):
+    def predict_by_naive_model(self, control, dt=None, stamp=None):
+        self._finish_step()
         self.v = control[0]
         self.w = control[1]
-        self.predict()
+        self._predict(dt, stamp)
 
-    def predict(self):
+    def predict(self, dt=None, stamp=None):
         """
         Kalman filter predict step equations using dynamic model
+        @ parameters
+        dt: float
+            Time step. Default: self.dt
+        stamp: float
+            Time of the predicted state. Default: self.stamp + dt
         """
+        self._finish_step()
+        self._predict(dt, stamp)
 
-        if abs(self.w) > self.eps_w:
-            rho = self.v / self.w
-
-            # step 1. Calc new robot position relative to its previous pose
-            x_r = rho * math.sin(self.w * self.dt)
-            y_r = rho * (1 - math.cos(self.w * self.dt))
-
-            # step 2. Transfrom this point to map fixed coordinate system taking into account
-            # current robot pose
-            self.pos[0] += x_r * math.cos(self.yaw) - y_r * math.sin(self.yaw)
-            self.pos[1] += x_r * math.sin(self.yaw) + y_r * math.cos(self.yaw)
-            self.yaw += self.w * self.dt
-        else:
-            self.pos[0] += self.v * self.dt * math.cos(self.yaw)
-            self.pos[1] += self.v * self.dt * math.sin(self.yaw)
-        
-        self.P_opt = self.predict_covariance()
-    
-    def predict_covariance(self):
-        """Computes covariance matrix after predict step"""
-        P_predict = np.zeros((5, 5))
-        F = transform_jacobian(self.x_opt, self.dt)
-        P_predict = F @ self.P_opt @ F.T + self.Q
+    def _finish_step(self):
+        # The smoother and the process noise estimator get the filtered state
+        # before the velocities are replaced by the control model
+        if self.smoother is not None:
+            self.smoother.filtered(self.x_opt, self.P_opt)
+        if self.process_noise_estimator is not None:
+            self.process_noise_estimator.add(self.x_opt - self._x_prior, self._q_scale)
+            self.Q = self.process_noise_estimator.Q
+
+    def _predict(self, dt=None, stamp=None):
+        dt = dt or self.dt
+        predict_kernel(self.x_opt, self.P_opt, self.Q, dt / self.dt, dt, self.eps_w, self._F, self._FP)
+        self.stamp = self.stamp + dt if stamp is None else stamp
+        if self.smoother is not None:
+            self.smoother.push(self.stamp, self.x_opt, self.P_opt, self._F)
+        if self.process_noise_estimator is not None:
+            self._x_prior[:] = self.x_opt
+            self._q_scale = dt / self.dt
+
+    def smooth(self):
+        """
+        Fixed-lag smoothed state `smoother_lag` predict steps behind the current one
+        @ return
+        (stamp, x, P) or None if the smoother is disabled or has not collected enough steps
+        """
+        if self.smoother is None:
+            return None
+        result = self.smoother.smooth(self.x_opt, self.P_opt)
+        if result is None:
+            return None
+        return result[:3]
+
+    def predict_covariance(self, dt=None):
+        """Computes covariance matrix after predict step. Process noise is scaled with dt / self.dt"""
+        dt = dt or self.dt
+        F = transform_jacobian(self.x_opt, dt)
+        P_predict = F @ self.P_opt @ F.T + self.Q * (dt / self.dt)
         return P_predict
 
     def update_odom(self, z_odom, R_odom):
         """ Update state vector using odometry measurements"""
-        H = get_jacobian_odom(self.x_opt)   
-        y = z_odom - H @ self.x_opt
-        G = H @ self.P_opt @ H.T + R_odom
-        K = self.P_opt @ H.T @ inv(G)
-        I = np.eye(5)
-        self.P_opt = (I - K @ H) @ self.P_opt
-        self.x_opt = self.x_opt + K @ y
+        R_odom = self._adapted_noise('odom', R_odom)
+        gate = self.gate.threshold(2)
+        d2 = update_odom_kernel(self.x_opt, self.P_opt, z_odom, R_odom, self._H, self._y, self._PHt, self._HP, gate)
+        if self._gated('odom', d2 <= gate):
+            self._add_innovation_2d('odom')
 
     def update_imu(self, z_imu, R_imu):
         """ Update state vector using imu measurements"""
-        H = get_jacobian_imu(self.x_opt) 
-        y = z_imu - imu(self.x_opt)
-        G = H @ self.P_opt @ H.T + R_imu
-        K = self.P_opt @ H.T @ inv(G)
-        I = np.eye(5)
-        self.P_opt = (I - K @ H) @ self.P_opt
-        self.x_opt = self.x_opt + K @ y
+        R_imu = self._adapted_noise('imu', R_imu)
+        gate = self.gate.threshold(2)
+        d2 = update_imu_kernel(self.x_opt, self.P_opt, z_imu, R_imu, self._H, self._y, self._PHt, self._HP, gate)
+        if self._gated('imu', d2 <= gate):
+            self._add_innovation_2d('imu')
 
     def update_imu_accel(self, z_accel, R_accel):
-        H = get_jacobian_accel(self.x_opt) 
-        y = z_accel - accel(self.x_opt)
-        G = H @ self.P_opt @ H.T + R_accel
-        K = self.P_opt @ H.T @ inv(G)
-        I = np.eye(5)
-        self.P_opt = (I - K @ H) @ self.P_opt
-        self.x_opt = self.x_opt + K @ y
-    
+        R_accel = self._adapted_noise('accel', R_accel)
+        gate = self.gate.threshold(1)
+        y, d2 = update_accel_kernel(
+            self.x_opt, self.P_opt, _scalar(z_accel), _scalar(R_accel), self._h, self._Ph, self._hP, gate
+        )
+        if self._gated('accel', d2 <= gate):
+            self._add_innovation_1d('accel', y)
+
     def update_imu_gyro(self, z_gyro, R_gyro):
-        H = get_jacobian_gyro(self.x_opt) 
-        y = z_gyro - accel(self.x_opt)
-        G = H @ self.P_opt @ H.T + R_gyro
-        K = self.P_opt @ H.T @ inv(G)
-        I = np.eye(5)
-        self.P_opt = (I - K @ H) @ self.P_opt
-        self.x_opt = self.x_opt + K @ y
-    
+        R_gyro = self._adapted_noise('gyro', R_gyro)
+        gate = self.gate.threshold(1)
+        y, d2 = update_gyro_kernel(
+            self.x_opt, self.P_opt, _scalar(z_gyro), _scalar(R_gyro), self._h, self._Ph, self._hP, gate
+        )
+        if self._gated('gyro', d2 <= gate):
+            self._add_innovation_1d('gyro', y)
+
+    def _gated(self, name, accepted):
+        """Count a gated update `name`. Returns `accepted`"""
+        if self.gate.enabled:
+            self.gate.record(name, accepted)
+        return accepted
+
+    def _adapted_noise(self, name, R):
+        """Adapted covariance of the update `name`. R is its initial value"""
+        if self.adaptive_window <= 0:
+            return R
+        estimator = self.noise_estimators.get(name)
+        if estimator is None:
+            estimator = InnovationNoiseEstimator(R, self.adaptive_window)
+            self.noise_estimators[name] = estimator
+        return estimator.R.reshape(np.shape(R))
+
+    def _add_innovation_2d(self, name):
+        # After the kernel, _PHt holds P H^T of the prior covariance.
+        # Innovations rejected by the gate are not added
+        if self.adaptive_window > 0:
+            self.noise_estimators[name].add(self._y, self._H @ self._PHt)
+
+    def _add_innovation_1d(self, name, y):
+        if self.adaptive_window > 0:
+            self.noise_estimators[name].add(y, self._h @ self._Ph)
+
     @property
     def v(self):
         return self.x_opt[2]
@@ -194,3 +283,166 @@ class Filter2D:
     @yaw.setter
     def yaw(self, value):
         self.x_opt[3] = value
+
+
+def _scalar(value):
+    """Value of a 1-element array, numpy scalar or number as python float"""
+    return float(value.item()) if hasattr(value, 'item') else float(value)
+
+
+"""
+Compiled kernels. They change x and P in place and use only the preallocated work buffers.
+"""
+
+@njit(cache=True)
+def predict_kernel(x, P, Q, q_scale, dt, eps_w, F, FP):
+    """
+    Predict step: moves the robot along an arc (or a line if the angular velocity is small),
+    then P = F @ P @ F.T + Q * q_scale with the jacobian F at the new state
+    """
+    v = x[2]
+    w = x[4]
+    if abs(w) > eps_w:
+        rho = v / w
+
+        # step 1. Calc new robot position relative to its previous pose
+        x_r = rho * math.sin(w * dt)
+        y_r = rho * (1 - math.cos(w * dt))
+
+        # step 2. Transfrom this point to map fixed coordinate system taking into account
+        # current robot pose
+        x[0] += x_r * math.cos(x[3]) - y_r * math.sin(x[3])
+        x[1] += x_r * math.sin(x[3]) + y_r * math.cos(x[3])
+        x[3] += w * dt
+    else:
+        x[0] += v * dt * math.cos(x[3])
+        x[1] += v * dt * math.sin(x[3])
+
+    # Non-constant elements of the jacobian (see model.transform_jacobian)
+    F[0, 2] = math.cos(x[3]) * dt
+    F[0, 3] = -x[2] * math.sin(x[3]) * dt
+    F[1, 2] = math.sin(x[3]) * dt
+    F[1, 3] = x[2] * math.cos(x[3]) * dt
+    F[3, 4] = dt
+
+    for i in range(5):
+        for j in range(5):
+            acc = 0.
+            for k in range(5):
+                acc += F[i, k] * P[k, j]
+            FP[i, j] = acc
+    for i in range(5):
+        for j in range(5):
+            acc = 0.
+            for k in range(5):
+                acc += FP[i, k] * F[j, k]
+            P[i, j] = acc + Q[i, j] * q_scale
+
+
+@njit(cache=True)
+def update_1d(x, P, H, R, y, PHt, HP, gate=np.inf):
+    """
+    Kalman update with a single measurement row H [5]: the innovation covariance is a scalar.
+    Returns the squared Mahalanobis distance of the innovation, the update is skipped if it exceeds `gate`
+    """
+    for i in range(5):
+        PHt[i] = 0.
+        HP[i] = 0.
+        for k in range(5):
+            PHt[i] += P[i, k] * H[k]
+            HP[i] += H[k] * P[k, i]
+    G = R
+    for k in range(5):
+        G += H[k] * PHt[k]
+    d2 = y * y / G
+    if d2 > gate:
+        return d2
+    for i in range(5):
+        K = PHt[i] / G
+        x[i] += K * y
+        for j in range(5):
+            P[i, j] -= K * HP[j]
+    return d2
+
+
+@njit(cache=True)
+def update_2d(x, P, H, R, y, PHt, HP, gate=np.inf):
+    """
+    Kalman update with two measurement rows H [2, 5]: the innovation covariance is inverted in closed form.
+    Returns the squared Mahalanobis distance of the innovation, the update is skipped if it exceeds `gate`
+    """
+    for i in range(5):
+        for m in range(2):
+            PHt[i, m] = 0.
+            HP[m, i] = 0.
+            for k in range(5):
+                PHt[i, m] += P[i, k] * H[m, k]
+                HP[m, i] += H[m, k] * P[k, i]
+    g00 = R[0, 0]
+    g01 = R[0, 1]
+    g10 = R[1, 0]
+    g11 = R[1, 1]
+    for k in range(5):
+        g00 += H[0, k] * PHt[k, 0]
+        g01 += H[0, k] * PHt[k, 1]
+        g10 += H[1, k] * PHt[k, 0]
+        g11 += H[1, k] * PHt[k, 1]
+    det = g00 * g11 - g01 * g10
+    i00 = g11 / det
+    i01 = -g01 / det
+    i10 = -g10 / det
+    i11 = g00 / det
+    d2 = y[0] * (i00 * y[0] + i01 * y[1]) + y[1] * (i10 * y[0] + i11 * y[1])
+    if d2 > gate:
+        return d2
+    for i in range(5):
+        k0 = PHt[i, 0] * i00 + PHt[i, 1] * i10
+        k1 = PHt[i, 0] * i01 + PHt[i, 1] * i11
+        x[i] += k0 * y[0] + k1 * y[1]
+        for j in range(5):
+            P[i, j] -= k0 * HP[0, j] + k1 * HP[1, j]
+    return d2
+
+
+@njit(cache=True)
+def update_odom_kernel(x, P, z, R, H, y, PHt, HP, gate=np.inf):
+    """Odometry: z = [V_parallel, yaw_vel] (see measurement.get_jacobian_odom). Returns the Mahalanobis distance"""
+    H[:] = 0.
+    H[0, 2] = 1.
+    H[1, 4] = 1.
+    y[0] = z[0] - x[2]
+    y[1] = z[1] - x[4]
+    return update_2d(x, P, H, R, y, PHt, HP, gate)
+
+
+@njit(cache=True)
+def update_imu_kernel(x, P, z, R, H, y, PHt, HP, gate=np.inf):
+    """IMU: z = [a_normal, yaw_vel] (see measurement.get_jacobian_imu). Returns the Mahalanobis distance"""
+    H[:] = 0.
+    H[0, 2] = x[4]
+    H[0, 4] = x[2]
+    H[1, 4] = 1.
+    y[0] = z[0] - x[2] * x[4]
+    y[1] = z[1] - x[4]
+    return update_2d(x, P, H, R, y, PHt, HP, gate)
+
+
+@njit(cache=True)
+def update_accel_kernel(x, P, z, R, H, PHt, HP, gate=np.inf):
+    """Accelerometer: z = a_normal (see measurement.get_jacobian_accel). Returns the innovation and its Mahalanobis distance"""
+    H[:] = 0.
+    H[2] = x[4]
+    H[4] = x[2]
+    y = z - x[2] * x[4]
+    d2 = update_1d(x, P, H, R, y, PHt, HP, gate)
+    return y, d2
+
+
+@njit(cache=True)
+def update_gyro_kernel(x, P, z, R, H, PHt, HP, gate=np.inf):
+    """Gyroscope: z = yaw_vel (see measurement.get_jacobian_gyro). Returns the innovation and its Mahalanobis distance"""
+    H[:] = 0.
+    H[4] = 1.
+    y = z - x[4]
+    d2 = update_1d(x, P, H, R, y, PHt, HP, gate)
+    return y, d2
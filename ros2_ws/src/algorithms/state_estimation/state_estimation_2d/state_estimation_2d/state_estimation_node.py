@@ -1,20 +1,28 @@
 #!/usr/bin/env python
 # license removed for brevity
+import threading
+
 import rclpy
 from rclpy.node import Node
+from rclpy.executors import MultiThreadedExecutor
+from rclpy.callback_groups import MutuallyExclusiveCallbackGroup
 import cv2
 from geometry_msgs.msg import Twist
 from sensor_msgs.msg import Imu
 from nav_msgs.msg import Odometry
+from diagnostic_msgs.msg import DiagnosticArray
 import numpy as np
 from filterpy.common import Q_discrete_white_noise
-from scipy.spatial.transform import Rotation as R
 import tf2_ros
-from argparse import Namespace
 
 from state_estimation_2d.filter import *
 from state_estimation_2d.ate import *
-import nnio
+from state_estimation_2d.warmup import warmup
+from state_estimation_3d.extrinsics import ExtrinsicsCache
+from state_estimation_3d.adaptive import noise_diagnostics
+from state_estimation_3d.gating import gating_diagnostics
+from state_estimation_3d.messages import yaw_to_quaternion, covariance_index
+from rosbot_controller.motion_model import get_motion_model
 
 """
 State vector:
@@ -50,12 +58,19 @@ class StateEstimation2D(Node):
         Subscriber to controls from cmd_vel
     pose_pub: ros::Publisher
         Publish filtered odometry to /odom_filtered
+    smoothed_pose_pub: ros::Publisher
+        Publish fixed-lag smoothed odometry to /odom_filtered_smoothed
     odom_noised: Odometry
         Noised odometry from odom_noiser node
     odom_gt: Odometry
         Ground truth odometry
     odom_filtered: Odometry
         Kalman filtered odometry
+    odom_smoothed: Odometry
+        Fixed-lag smoothed odometry
+    odom_transform: TransformStamped
+        Transform odom -> base_link of the filtered odometry
+    The published messages are allocated once and reused, only the changed fields are written
     got_measurements: bool
         Flag that is true when got first measurement 
     model_path: str
@@ -78,38 +93,86 @@ class StateEstimation2D(Node):
         Object for ate metrics evaluation
     predict_timer: ros::Timer
         Timer for update function
+    event_driven: bool
+        If true, every measurement predicts the filter to its stamp and is fused at once
+    publish_period: float
+        Event-driven mode: period of the pose publisher, 0 means publishing after every measurement
+    filter_stamp: float
+        Event-driven mode: time of the filter state
+    smoother_lag: float
+        Lag of the fixed-lag smoother, s. 0 disables the smoothed output
+    event_rate: float
+        Event-driven mode: expected rate of predict steps (all sensor messages together), Hz.
+        The smoother keeps a number of steps, it is `smoother_lag` times this rate
+    adaptive_window: int
+        If > 0, R_odom, R_accel, R_gyro and Q are only initial values: they are adapted online
+        over this number of updates (see Filter2D) and published to /diagnostics once a second
+    gate_probability: float
+        Probability of the chi-square gate of all updates (see Filter2D), 0 disables gating.
+        The numbers of accepted and rejected measurements are published to /diagnostics once a second
     """
     def __init__(self):
         super().__init__('state_estimation_2d')
+        # Stepping mode
+        self.declare_parameter('event_driven', False)
+        self.declare_parameter('publish_period', 0.0)
+        self.declare_parameter('smoother_lag', 0.5)
+        self.declare_parameter('event_rate', 100.0)
+        self.declare_parameter('adaptive_window', 0)
+        self.declare_parameter('gate_probability', 0.999)
+        self.event_driven = self.get_parameter('event_driven').get_parameter_value().bool_value
+        self.publish_period = self.get_parameter('publish_period').get_parameter_value().double_value
+        self.smoother_lag = self.get_parameter('smoother_lag').get_parameter_value().double_value
+        self.event_rate = self.get_parameter('event_rate').get_parameter_value().double_value
+        self.adaptive_window = self.get_parameter('adaptive_window').get_parameter_value().integer_value
+        self.gate_probability = self.get_parameter('gate_probability').get_parameter_value().double_value
+        self.sensor_group = MutuallyExclusiveCallbackGroup()
+        self.publish_group = MutuallyExclusiveCallbackGroup()
+        self.lock = threading.Lock()
         # ROS Subscribers
         self.odom_sub = self.create_subscription(
             Twist,
             'velocity',
             self.odometry_callback,
-            10)
+            10,
+            callback_group=self.sensor_group)
         self.cmd_vel_sub = self.create_subscription(
             Twist,
             'cmd_vel',
             self.control_callback,
-            15)
+            15,
+            callback_group=self.sensor_group)
         self.imu_accel_sub = self.create_subscription(
             Imu,
             '/camera/accel/sample',
             self.imu_accel_callback,
-            15)
+            15,
+            callback_group=self.sensor_group)
         self.imu_gyro_sub = self.create_subscription(
             Imu,
             '/camera/gyro/sample',
             self.imu_gyro_callback,
-            15)
+            15,
+            callback_group=self.sensor_group)
         self.pose_pub = self.create_publisher(Odometry, '/odom_filtered', 10)
+        self.smoothed_pose_pub = self.create_publisher(Odometry, '/odom_filtered_smoothed', 10)
         self.tf2_broadcaster = tf2_ros.TransformBroadcaster(self)
         self.tf_buffer = tf2_ros.Buffer()
         self.tf_listener = tf2_ros.TransformListener(self.tf_buffer, self)
+        self.extrinsics = ExtrinsicsCache(self, self.tf_buffer)
         # ROS variables
         self.odom_noised = Odometry()
         self.odom_gt = Odometry()
         self.odom_filtered = Odometry()
+        self.odom_smoothed = Odometry()
+        self.odom_transform = tf2_ros.TransformStamped()
+        for msg in [self.odom_filtered, self.odom_smoothed, self.odom_transform]:
+            msg.header.frame_id = 'odom'
+            msg.child_frame_id = 'base_link'
+        # Constant variances of z, roll and pitch
+        self.odom_filtered.pose.covariance[14] = 0.1
+        self.odom_filtered.pose.covariance[21] = 0.01
+        self.odom_filtered.pose.covariance[28] = 0.01
         self.got_measurements = 0
         self.control = np.zeros(2)
         self.z_odom = np.zeros(2)
@@ -119,13 +182,15 @@ class StateEstimation2D(Node):
         self.rot_extrinsic = None
         # Upload NN control model
         self.model_path = 'http://192.168.194.51:8345/ml-control/gz-rosbot/new_model_dynamic_batch.onnx'
-        self.model = nnio.ONNXModel(self.model_path)
+        self.model = get_motion_model(self.model_path)
         # Filter parameters
         self.dt = 0.1
         self.R_odom = np.array([[0.5, 0],
                                 [0, 0.1]])
         self.R_accel = np.array([[200]])
         self.R_gyro = np.array([[200]])
+        # Time between predict steps, it converts the smoother lag to steps
+        step_period = 1 / self.event_rate if self.event_driven else self.dt
         
         self.filter = Filter2D(
             x_init=np.zeros(5), 
@@ -133,17 +198,38 @@ class StateEstimation2D(Node):
             dt=self.dt,
             v_var=0.25,
             w_var=0.01,
+            smoother_lag=int(round(self.smoother_lag / step_period)),
+            adaptive_window=self.adaptive_window,
+            gate_probability=self.gate_probability,
         )
+        # Load compiled kernels from the numba cache (or compile them) before the first step
+        print(f'filter2d warm-up: {warmup():.2f} s')
         self.distance = 0
         self.x_prev = 0
         self.y_prev = 0
         self.odom_gt_prev = Odometry()
         self.ate = ErrorEstimator()
+        self.filter_stamp = self.get_time()
         # Timer for update function
-        self.predict_timer = self.create_timer(
-            self.dt,
-            self.step_filter
-        )
+        if not self.event_driven:
+            self.predict_timer = self.create_timer(
+                self.dt,
+                self.step_filter,
+                callback_group=self.sensor_group
+            )
+        elif self.publish_period > 0:
+            self.publish_timer = self.create_timer(
+                self.publish_period,
+                self.publish_callback,
+                callback_group=self.publish_group
+            )
+        if self.adaptive_window > 0 or self.gate_probability > 0:
+            self.diagnostics_pub = self.create_publisher(DiagnosticArray, '/diagnostics', 10)
+            self.diagnostics_timer = self.create_timer(
+                1.0,
+                self.publish_diagnostics,
+                callback_group=self.publish_group
+            )
     
     def control_callback(self, msg):
         """
@@ -162,6 +248,12 @@ class StateEstimation2D(Node):
         self.odom_noised = msg
         self.z_odom = self.odometry_to_vector(msg)
         self.got_measurements = 1
+        if self.event_driven:
+            # Twist has no header, so the measurement is stamped with the arrival time
+            with self.lock:
+                self.predict_to(self.get_time())
+                self.filter.update_odom(self.z_odom, self.R_odom)
+            self.publish_event()
 
     def odometry_to_vector(self, odom):
         """
@@ -182,13 +274,20 @@ class StateEstimation2D(Node):
                                             self.imu_accel.linear_acceleration.y,
                                             self.imu_accel.linear_acceleration.z])
             self.z_accel = accel[1]
+            if self.event_driven and self.got_measurements:
+                with self.lock:
+                    self.predict_to(self.stamp_to_sec(msg.header.stamp))
+                    self.filter.update_imu_accel(self.z_accel, self.R_accel)
+                self.publish_event()
     
     def imu_gyro_callback(self, msg):
         # print(self.imu_extrinsic)
-        if self.imu_extrinsic is None:
+        # Cached until a new static transform arrives
+        extrinsic = self.extrinsics.get("camera_gyro_optical_frame", "base_link")
+        if extrinsic is None:
             print("Finding imu extrinsics")
-            self.imu_extrinsic = self.get_extrinsic("camera_gyro_optical_frame", "base_link")
-        if self.imu_extrinsic is not None and self.rot_extrinsic is None:
+        elif extrinsic is not self.imu_extrinsic:
+            self.imu_extrinsic = extrinsic
             self.rot_extrinsic = np.ascontiguousarray(self.imu_extrinsic[:3,:3])
         self.imu_gyro = msg
         if self.rot_extrinsic is not None:
@@ -196,16 +295,24 @@ class StateEstimation2D(Node):
                                             self.imu_gyro.angular_velocity.y,
                                             self.imu_gyro.angular_velocity.z])
             self.z_gyro = gyro[2]
+            if self.event_driven and self.got_measurements:
+                with self.lock:
+                    self.predict_to(self.stamp_to_sec(msg.header.stamp))
+                    self.filter.update_imu_gyro(self.z_gyro, self.R_gyro)
+                self.publish_event()
     
     def step_filter(self):
         """
         Kalman filter iteration
         Theory: https://homes.cs.washington.edu/~todorov/courses/cseP590/readings/tutorialEKF.pdf
         """
-        if self.got_measurements:
+        if not self.got_measurements:
+            return
+        # The publish group reads the filter concurrently
+        with self.lock:
             # Predict step
             # self.filter.predict_by_nn_model(self.model, self.control)
-            self.filter.predict_by_naive_model(self.control)
+            self.filter.predict_by_naive_model(self.control, stamp=self.get_time())
             # Measurement update step
             self.filter.update_odom(self.z_odom, self.R_odom)
             # if self.z_gyro is not None:
@@ -216,43 +323,59 @@ class StateEstimation2D(Node):
             # Transfer vectors to odometry messages
             self.state_to_odometry(self.filter.x_opt, self.filter.P_opt)
             self.pose_pub.publish(self.odom_filtered)
+            self.publish_smoothed_pose()
 
-    def get_extrinsic(self, frame1, frame2):
-        '''
-        Parameters:
-        frame1 (str): tf frame
-        frame2 (str): tf frame
+    def predict_to(self, stamp):
+        """
+        Event-driven mode: predict the filter state up to `stamp` with a variable time step
+        @ parameters
+        stamp: float
+            Time in seconds
+        """
+        dt = stamp - self.filter_stamp
+        if dt > 0:
+            self.filter.predict_by_naive_model(self.control, dt, stamp)
+            self.filter_stamp = stamp
 
-        Returns:
-        np.array of shape [3, 4]: rotation-translation matrix between two tf frames.
-        '''
-        extrinsic = None
-        try:
-            # t = self.get_clock().now()
-            # rclpy.spin_once(self)
-            t = Namespace(seconds=0, nanoseconds=0)
-            trans = self.tf_buffer.lookup_transform(frame1, frame2, t, rclpy.duration.Duration(seconds=0.5))
-            # print(f"Got transform! {frame1} -> {frame2}")
-            # break
-            tr = np.array([
-                [trans.transform.translation.x],
-                [trans.transform.translation.y],
-                [trans.transform.translation.z],
-            ])
-            rot_q = np.array([
-                trans.transform.rotation.x,
-                trans.transform.rotation.y,
-                trans.transform.rotation.z,
-                trans.transform.rotation.w,
-            ])
-            rot = R.from_quat(rot_q).as_matrix()
-            extrinsic = np.concatenate([rot, tr], 1)
-        except tf2_ros.LookupException:
-            # rclpy.spin_once(self)
-            print(f"Retrying to get transform {frame1} -> {frame2}", self.get_clock().now())
-        
-        return extrinsic
+    def publish_event(self):
+        """
+        Event-driven mode: publish the pose right after a measurement if there is no publisher timer
+        """
+        if self.publish_period <= 0:
+            self.publish_callback()
+
+    def publish_callback(self):
+        if not self.got_measurements:
+            return
+        with self.lock:
+            self.state_to_odometry(self.filter.x_opt, self.filter.P_opt)
+            self.pose_pub.publish(self.odom_filtered)
+            self.publish_smoothed_pose()
 
+    def publish_diagnostics(self):
+        """
+        Publish the adapted noise covariances and the gating counters of the filter
+        """
+        msg = DiagnosticArray()
+        msg.header.stamp = self.get_clock().now().to_msg()
+        with self.lock:
+            if self.adaptive_window > 0:
+                msg.status.append(noise_diagnostics(
+                    self.get_name(), self.filter.noise_estimators, self.filter.process_noise_estimator
+                ))
+            if self.filter.gate.enabled:
+                msg.status.append(gating_diagnostics(self.get_name(), self.filter.gate))
+        self.diagnostics_pub.publish(msg)
+
+    def get_time(self):
+        """
+        Returns current ROS time in seconds
+        """
+        return self.stamp_to_sec(self.get_clock().now().to_msg())
+
+    @staticmethod
+    def stamp_to_sec(stamp):
+        return stamp.sec + stamp.nanosec * 1e-9
 
     def state_to_odometry(self, x, P):
         """
@@ -263,16 +386,12 @@ class StateEstimation2D(Node):
         P: np.array
             Covariance matrix
         """
-        self.odom_filtered.header.frame_id = 'odom'
         self.odom_filtered.header.stamp = self.get_clock().now().to_msg()
-        # self.odom_filtered.header.seq = 0
-        self.odom_filtered.child_frame_id = 'base_link'
         self.odom_filtered.pose.pose.position.x = x[0]
         self.odom_filtered.pose.pose.position.y = x[1]
         self.odom_filtered.pose.pose.position.z = 0.0
-        # Transfer yaw angle from euler to quaternion
-        r = R.from_euler('z', x[3], degrees=False)
-        q = r.as_quat()
+        # Transfer yaw angle to quaternion
+        q = yaw_to_quaternion(x[3])
         self.odom_filtered.pose.pose.orientation.x = q[0]
         self.odom_filtered.pose.pose.orientation.y = q[1]
         self.odom_filtered.pose.pose.orientation.z = q[2]
@@ -284,11 +403,11 @@ class StateEstimation2D(Node):
         self.odom_filtered.twist.twist.angular.y = self.odom_noised.angular.y
         self.odom_filtered.twist.twist.angular.z = x[4]
         # Fill the odometry message covariance matrix with computed KF covariance
+        self.pose_covariance_to_vector(P, self.odom_filtered.pose.covariance)
+        self.twist_covariance_to_vector(P, self.odom_filtered.twist.covariance)
 
-        t = tf2_ros.TransformStamped()
-        t.header.frame_id = 'odom'
+        t = self.odom_transform
         t.header.stamp = self.odom_filtered.header.stamp
-        t.child_frame_id = 'base_link'
         t.transform.translation.x = x[0]
         t.transform.translation.y = x[1]
         t.transform.translation.z = 0.0
@@ -298,49 +417,71 @@ class StateEstimation2D(Node):
         t.transform.rotation.w = q[3]
         self.tf2_broadcaster.sendTransform(t)
 
-    def pose_covariance_to_vector(self, P):
+    def publish_smoothed_pose(self):
+        """
+        Publish the fixed-lag smoothed pose with the stamp of the smoothed filter step
+        """
+        smoothed = self.filter.smooth()
+        if smoothed is None:
+            return
+        stamp, x, P = smoothed
+        self.odom_smoothed.header.stamp = rclpy.time.Time(nanoseconds=int(stamp * 1e9)).to_msg()
+        self.odom_smoothed.pose.pose.position.x = x[0]
+        self.odom_smoothed.pose.pose.position.y = x[1]
+        self.odom_smoothed.pose.pose.position.z = 0.0
+        q = yaw_to_quaternion(x[3])
+        self.odom_smoothed.pose.pose.orientation.x = q[0]
+        self.odom_smoothed.pose.pose.orientation.y = q[1]
+        self.odom_smoothed.pose.pose.orientation.z = q[2]
+        self.odom_smoothed.pose.pose.orientation.w = q[3]
+        self.odom_smoothed.twist.twist.linear.x = x[2]
+        self.odom_smoothed.twist.twist.angular.z = x[4]
+        self.pose_covariance_to_vector(P, self.odom_smoothed.pose.covariance)
+        self.twist_covariance_to_vector(P, self.odom_smoothed.twist.covariance)
+        self.smoothed_pose_pub.publish(self.odom_smoothed)
+
+    def pose_covariance_to_vector(self, P, cov_vector):
         """
         Transfer filter computed pose covariance matrix to vector
         http://docs.ros.org/en/noetic/api/geometry_msgs/html/msg/PoseWithCovariance.html
         @ parameters
         P: np.array
             Covariance matrix
+        cov_vector: np.array
+            Covariance field of a message, (x, y, yaw) elements are written in place
         """
-        cov_vector = self.odom_noised.pose.covariance
-        cov_vector[14] = 0.1
-        cov_vector[21] = 0.01
-        cov_vector[28] = 0.01
-        cov_vector[0] = P[0,0]
-        cov_vector[1] = P[0,1]
-        cov_vector[5] = P[0,3]
-        cov_vector[6] = P[1,0]
-        cov_vector[7] = P[1,1]
-        cov_vector[11] = P[1,3]
-        cov_vector[30] = P[3,0]
-        cov_vector[31] = P[3,1]
-        cov_vector[35] = P[3,3]
+        cov_vector[POSE_COVARIANCE_DST] = P.take(POSE_COVARIANCE_SRC)
         return cov_vector
-    
-    def twist_covariance_to_vector(self, P):
+
+    def twist_covariance_to_vector(self, P, cov_vector):
         """
         Transfer filter computed twist covariance matrix to vector
         http://docs.ros.org/en/noetic/api/geometry_msgs/html/msg/TwistWithCovariance.html
         @ parameters
         P: np.array
             Covariance matrix
+        cov_vector: np.array
+            Covariance field of a message, (V_parallel, yaw_vel) elements are written in place
         """
-        cov_vector = self.odom_noised.twist.covariance
-        cov_vector[0] = P[2,2]
-        cov_vector[5] = P[2,4]
-        cov_vector[30] = P[4,2]
-        cov_vector[35] = P[4,4]
+        cov_vector[TWIST_COVARIANCE_DST] = P.take(TWIST_COVARIANCE_SRC)
         return cov_vector
 
+
+# (x, y, yaw) and (V_parallel, yaw_vel) blocks of the state covariance in the 6x6 message covariances
+POSE_COVARIANCE_SRC = covariance_index([0, 1, 3], 5)
+POSE_COVARIANCE_DST = covariance_index([0, 1, 5], 6)
+TWIST_COVARIANCE_SRC = covariance_index([2, 4], 5)
+TWIST_COVARIANCE_DST = covariance_index([0, 5], 6)
+
+
 def main():
     rclpy.init()
     state_estimator = StateEstimation2D()
+    # Sensor callbacks and the pose publisher run in separate callback groups
+    executor = MultiThreadedExecutor()
+    executor.add_node(state_estimator)
     try:
-        rclpy.spin(state_estimator)
+        executor.spin()
     except KeyboardInterrupt:
         ate, std = state_estimator.ate.evaluate_ate()
         print('ATE:', ate)
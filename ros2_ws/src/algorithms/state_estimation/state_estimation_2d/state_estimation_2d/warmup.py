@@ -0,0 +1,51 @@
+import time
+
+import numpy as np
+
+from .filter import Filter2D
+
+
+def warmup():
+    '''
+    Compile (or load from the numba cache) every kernel used by `Filter2D`
+
+    Runs the predict step (on an arc and on a line), all updates, the fixed-lag smoother
+    and the adaptive noise with the same argument types as the state estimation node.
+    Gating, adaptive noise and the smoother are enabled and their windows are short enough
+    to fill, so that the gated updates, the adapted covariances and the smoothed state are computed.
+    All kernels are declared with `cache=True`, so after the first run
+    the compiled code is stored on disk and later calls only load it.
+
+    Returns
+    -------
+        float: seconds spent
+    '''
+    start = time.perf_counter()
+    f = Filter2D(
+        x_init=np.zeros(5), P_init=np.eye(5) * 0.01, dt=0.1, v_var=0.25, w_var=0.01,
+        smoother_lag=1, adaptive_window=2, gate_probability=0.999,
+    )
+    R_odom = np.array([[0.5, 0], [0, 0.1]])
+    for control in [np.array([0.5, 0.5]), np.zeros(2), np.array([0.5, 0.5])]:
+        f.predict_by_naive_model(control)
+        f.update_odom(np.zeros(2), R_odom)
+        f.update_imu(np.zeros(2), R_odom)
+        f.update_imu_accel(np.zeros(1), np.array([[200]]))
+        f.update_imu_gyro(0., np.array([[200]]))
+    f.predict(0.05)
+    f.smooth()
+    f.predict_covariance()
+    return time.perf_counter() - start
+
+
+def main():
+    '''
+    Populate the numba cache. `colcon build` runs it when installing the package (see setup.py),
+    run it by hand if the build skipped it (SKIP_NUMBA_WARMUP=1):
+        ros2 run state_estimation_2d filter2d_warmup
+    '''
+    print(f'filter2d kernels compiled in {warmup():.2f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+'''
+Benchmark of the optical flow measurement model.
+
+Compares `flow_odom12` (batched) and `flow_odom12_parallel` (batched, prange over points)
+with `flow_odom12_loop` (one `_flow_odom12_single` call per point) for 30 to 3000 points,
+with and without extrinsic, and checks that all of them give the same z_prior and H.
+
+Usage:
+    python3 benchmark/flow_odom12.py
+'''
+import time
+
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+from state_estimation_3d.spacekf.measurent import flow_odom12, flow_odom12_parallel, flow_odom12_loop
+
+
+def make_problem(n_points, with_extrinsic, rng):
+    vel = rng.normal(size=3)
+    rot_vel = rng.normal(size=3)
+    q = Rotation.random(random_state=1).as_quat()
+    delta_t = 0.1
+    depths = rng.uniform(0.5, 5, size=n_points)
+    pixels = rng.integers(0, 128, size=(n_points, 2))
+    camera_matrix = np.array([
+        [100., 0, 64],
+        [0, 100, 64],
+        [0, 0, 1],
+    ])
+    camera_matrix_inv = np.linalg.inv(camera_matrix)
+    if with_extrinsic:
+        extrinsic = np.concatenate([Rotation.random(random_state=2).as_matrix(), rng.normal(size=(3, 1))], 1)
+    else:
+        extrinsic = None
+    return vel, rot_vel, q, delta_t, depths, pixels, camera_matrix, camera_matrix_inv, extrinsic
+
+
+def time_function(function, args, repeats):
+    # Compile
+    function(*args)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function(*args)
+    return (time.perf_counter() - start) / repeats * 1e6
+
+
+def main():
+    rng = np.random.default_rng(0)
+    print(f'{"points":>6} {"extr":>5} {"loop us":>10} {"batch us":>10} {"prange us":>10} {"speedup":>8} {"max error":>10}')
+    for with_extrinsic in [False, True]:
+        for n_points in [30, 100, 300, 1000, 3000]:
+            args = make_problem(n_points, with_extrinsic, rng)
+            repeats = max(10, 30000 // n_points)
+            z_loop, H_loop = flow_odom12_loop(*args)
+            error = 0
+            for function in [flow_odom12, flow_odom12_parallel]:
+                z, H = function(*args)
+                error = max(error, np.abs(z - z_loop).max(), np.abs(H - H_loop).max())
+            us_loop = time_function(flow_odom12_loop, args, repeats)
+            us_batch = time_function(flow_odom12, args, repeats)
+            us_parallel = time_function(flow_odom12_parallel, args, repeats)
+            print(
+                f'{n_points:>6} {str(with_extrinsic):>5} {us_loop:>10.1f} {us_batch:>10.1f} {us_parallel:>10.1f}'
+                f' {us_loop / us_batch:>8.1f} {error:>10.2e}'
+            )
+
+
+if __name__ == '__main__':
+    main()
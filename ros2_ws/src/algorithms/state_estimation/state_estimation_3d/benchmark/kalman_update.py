@@ -0,0 +1,142 @@
+'''
+Micro-benchmark of the Kalman update kernels.
+
+Compares time per update and numerical drift of `kalman_update` (standard form),
+`kalman_update_joseph` and `kalman_update_sqrt` (square-root filter, carries a factor of P)
+on 12-D (SpaceKF12) and 10-D (state_estimation_25d Filter) states with 3 to 90 measurement rows.
+Also compares `kalman_update` with `kalman_update_diag` (diagonal R, as in OdoFlow)
+for 30 to 1000 flow points.
+
+Drift is measured on the ill-conditioned example of Bierman (1977): two nearly parallel,
+nearly perfect scalar measurements (rows of ones, the second one perturbed by delta, R = delta^2)
+and a predict P + 1e-3 I, repeated 100 times. The relative error of P is computed against
+the Joseph form run in extended precision (np.longdouble), together with the asymmetry of P
+and its smallest eigenvalue (the exact one is above 1e-3).
+
+Usage:
+    python3 benchmark/kalman_update.py
+'''
+import time
+
+import numpy as np
+
+from state_estimation_3d.spacekf.filter import (
+    KALMAN_UPDATES, kalman_update, kalman_update_diag, kalman_update_sqrt, sqrt_predict,
+)
+
+
+def make_problem(n, m, rng):
+    A = rng.normal(size=(n, n))
+    P = A @ A.T + np.eye(n)
+    H = rng.normal(size=(m, n))
+    R = np.eye(m) * 0.1
+    x = rng.normal(size=n)
+    y = rng.normal(size=m)
+    return x, P, H, R, y
+
+
+def time_update(update, x, P, H, R, y, repeats):
+    # Compile
+    update(x, P, H, R, y)
+    start = time.perf_counter()
+    for _ in range(repeats):
+        update(x, P, H, R, y)
+    return (time.perf_counter() - start) / repeats * 1e9
+
+
+def joseph_longdouble(P, h, r):
+    S = (h @ P @ h.T)[0, 0] + r
+    K = P @ h.T / S
+    I_KH = np.eye(P.shape[0], dtype=P.dtype) - K @ h
+    return I_KH @ P @ I_KH.T + K @ K.T * r
+
+
+def bierman_problem(n, delta, steps, update, predict, P0, dtype=float):
+    '''
+    Runs `steps` cycles of the Bierman example. update(P, h, r), predict(P) -> new P
+    '''
+    P = P0
+    H = np.ones((2, n), dtype=dtype)
+    H[1, -1] += delta
+    for _ in range(steps):
+        for i in range(2):
+            P = update(P, H[i:i + 1], delta**2)
+        P = predict(P)
+    return P
+
+
+def drift(mode, n, delta, steps=100):
+    '''
+    Returns (relative error of P, max |P - P^T|, min eigenvalue of P) after `steps` cycles
+    of the Bierman example, inf if the update failed
+    '''
+    Q = np.eye(n) * 1e-3
+    reference = bierman_problem(
+        n, delta, steps, joseph_longdouble, lambda P: P + Q.astype(np.longdouble),
+        np.eye(n, dtype=np.longdouble), np.longdouble,
+    ).astype(float)
+    x, y = np.zeros(n), np.zeros(1)
+    try:
+        if mode == 'sqrt':
+            L = bierman_problem(
+                n, delta, steps,
+                lambda L, h, r: kalman_update_sqrt(x, L, h, np.array([[np.sqrt(r)]]), y)[1],
+                lambda L: sqrt_predict(np.eye(n), L, np.sqrt(Q)),
+                np.eye(n),
+            )
+            P = L @ L.T
+        else:
+            P = bierman_problem(
+                n, delta, steps,
+                lambda P, h, r: KALMAN_UPDATES[mode](x, P, h, np.array([[r]]), y)[1],
+                lambda P: P + Q,
+                np.eye(n),
+            )
+    except np.linalg.LinAlgError:
+        return np.inf, np.inf, -np.inf
+    error = np.abs(P - reference).max() / np.abs(reference).max()
+    asymmetry = np.abs(P - P.T).max()
+    min_eig = np.linalg.eigvalsh(0.5 * (P + P.T)).min()
+    return error, asymmetry, min_eig
+
+
+def main():
+    rng = np.random.default_rng(0)
+    modes = list(KALMAN_UPDATES) + ['sqrt']
+    print(f'{"n":>3} {"m":>3} {"mode":>9} {"ns/update":>12}')
+    for n in [12, 10]:
+        for m in [3, 6, 15, 30, 60, 90]:
+            x, P, H, R, y = make_problem(n, m, rng)
+            repeats = max(20, 20000 // m)
+            for mode in modes:
+                if mode == 'sqrt':
+                    # SpaceKF12 carries the factor of P, R is diagonal
+                    ns = time_update(kalman_update_sqrt, x, np.linalg.cholesky(P), H, np.sqrt(R), y, repeats)
+                else:
+                    ns = time_update(KALMAN_UPDATES[mode], x, P, H, R, y, repeats)
+                print(f'{n:>3} {m:>3} {mode:>9} {ns:>12.0f}')
+
+    print()
+    print(f'{"n":>3} {"delta":>6} {"mode":>9} {"rel. error":>12} {"asymmetry":>12} {"min eig":>12}')
+    for n in [12, 10]:
+        for delta in [1e-6, 1e-7, 3e-8, 1e-8]:
+            for mode in modes:
+                error, asymmetry, min_eig = drift(mode, n, delta)
+                print(f'{n:>3} {delta:>6.0e} {mode:>9} {error:>12.2e} {asymmetry:>12.2e} {min_eig:>12.2e}')
+
+    print()
+    print(f'{"points":>6} {"rows":>5} {"standard ns":>12} {"diag ns":>12} {"max |dx|":>12}')
+    for points in [30, 100, 300, 1000]:
+        m = 3 * points
+        x, P, H, _, y = make_problem(12, m, rng)
+        R_diag = rng.uniform(0.05, 0.5, size=m)
+        R = np.diag(R_diag)
+        repeats = max(5, 3000 // points)
+        ns_standard = time_update(kalman_update, x, P, H, R, y, repeats)
+        ns_diag = time_update(kalman_update_diag, x, P, H, R_diag, y, repeats)
+        dx = np.abs(kalman_update(x, P, H, R, y)[0] - kalman_update_diag(x, P, H, R_diag, y)[0]).max()
+        print(f'{points:>6} {m:>5} {ns_standard:>12.0f} {ns_diag:>12.0f} {dx:>12.2e}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,133 @@
+'''
+Micro-benchmark of the pose publish path of the state estimation nodes.
+
+Compares, per published pose, the old path (new Odometry and TransformStamped every step,
+yaw -> quaternion with scipy Rotation, covariances built as `list(mat.flatten())`)
+with `OdometryPublisher` (messages allocated once, covariances written in place
+by `fill_covariance`, `yaw_to_quaternion`). Both paths really publish the Odometry
+and broadcast the transform, so serialization is included. Only message construction
+is timed separately, and the time of one SpaceKF12 step is given for scale.
+
+Requires a sourced ROS 2 environment.
+
+Usage:
+    python3 benchmark/publish.py [--repeats 5000]
+'''
+import argparse
+import time
+
+import numpy as np
+import rclpy
+import tf2_ros
+from nav_msgs.msg import Odometry
+from scipy.spatial.transform import Rotation
+
+from state_estimation_3d.messages import OdometryPublisher, yaw_to_quaternion
+from state_estimation_3d.spacekf import SpaceKF12
+
+
+def old_pose(filt, yaw, stamp):
+    '''
+    Odometry and transform built as in the nodes before `OdometryPublisher`.
+    The orientation is a rotation by `yaw`, as in the 2D node
+    '''
+    msg = Odometry()
+    msg.header.stamp = stamp
+    msg.header.frame_id = 'map'
+    msg.child_frame_id = 'base_link'
+    msg.pose.pose.position.x = filt.pos[0]
+    msg.pose.pose.position.y = filt.pos[1]
+    msg.pose.pose.position.z = filt.pos[2]
+    q = Rotation.from_euler('z', yaw).as_quat()
+    msg.pose.pose.orientation.x = q[0]
+    msg.pose.pose.orientation.y = q[1]
+    msg.pose.pose.orientation.z = q[2]
+    msg.pose.pose.orientation.w = q[3]
+    indeces = [0, 1, 2, 6, 7, 8]
+    msg.pose.covariance = list(filt.P[indeces][:, indeces].flatten())
+    msg.twist.twist.linear.x = filt.vel[0]
+    msg.twist.twist.linear.y = filt.vel[1]
+    msg.twist.twist.linear.z = filt.vel[2]
+    msg.twist.twist.angular.x = filt.rot_vel[0]
+    msg.twist.twist.angular.y = filt.rot_vel[1]
+    msg.twist.twist.angular.z = filt.rot_vel[2]
+    indeces = [3, 4, 5, 9, 10, 11]
+    msg.twist.covariance = list(filt.P[indeces][:, indeces].flatten())
+
+    t = tf2_ros.TransformStamped()
+    t.header = msg.header
+    t.child_frame_id = 'base_link'
+    t.transform.translation.x = filt.pos[0]
+    t.transform.translation.y = filt.pos[1]
+    t.transform.translation.z = filt.pos[2]
+    t.transform.rotation.x = q[0]
+    t.transform.rotation.y = q[1]
+    t.transform.rotation.z = q[2]
+    t.transform.rotation.w = q[3]
+    return msg, t
+
+
+def new_pose(filt, yaw, stamp, publisher):
+    '''
+    The same pose written into the reused messages of `publisher`
+    '''
+    publisher.set_pose(stamp, filt.pos, yaw_to_quaternion(yaw))
+    publisher.set_twist(filt.vel, filt.rot_vel)
+    filt.get_pose_covariance(out=publisher.pose_covariance)
+    filt.get_twist_covariance(out=publisher.twist_covariance)
+    return publisher.msg, publisher.fill_transform()
+
+
+def time_per_call(function, repeats):
+    function()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    return (time.perf_counter() - start) / repeats * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeats', type=int, default=5000)
+    args = parser.parse_args()
+
+    rclpy.init()
+    node = rclpy.create_node('publish_benchmark')
+    broadcaster = tf2_ros.TransformBroadcaster(node)
+    old_publisher = node.create_publisher(Odometry, 'publish_benchmark/old', 10)
+    new_publisher = OdometryPublisher(node, 'publish_benchmark/new', 'map', 'base_link', broadcaster)
+
+    filt = SpaceKF12(dt=0.01, velocity_std=1., rot_vel_std=1.)
+    filt.x[:] = np.random.default_rng(0).normal(size=12)
+    yaw = 0.3
+    stamp = node.get_clock().now().to_msg()
+
+    def old_publish():
+        msg, t = old_pose(filt, yaw, stamp)
+        old_publisher.publish(msg)
+        broadcaster.sendTransform(t)
+
+    def new_publish():
+        new_pose(filt, yaw, stamp, new_publisher)
+        new_publisher.publish()
+
+    def filter_step():
+        filt.predict()
+        filt.update_rot_vel(np.zeros(3), np.eye(3))
+
+    results = [
+        ('filter step (predict + gyro update)', time_per_call(filter_step, args.repeats)),
+        ('old: build Odometry + transform', time_per_call(lambda: old_pose(filt, yaw, stamp), args.repeats)),
+        ('new: fill reused messages', time_per_call(lambda: new_pose(filt, yaw, stamp, new_publisher), args.repeats)),
+        ('old: build + publish + broadcast', time_per_call(old_publish, args.repeats)),
+        ('new: fill + publish + broadcast', time_per_call(new_publish, args.repeats)),
+    ]
+    for name, us in results:
+        print(f'{name:>40}: {us:8.1f} us')
+
+    node.destroy_node()
+    rclpy.shutdown()
+
+
+if __name__ == '__main__':
+    main()
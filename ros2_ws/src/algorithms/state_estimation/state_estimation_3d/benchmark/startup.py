@@ -0,0 +1,65 @@
+'''
+Startup benchmark of SpaceKF12.
+
+Measures, in a fresh interpreter, the time to import the filter, to run `warmup`
+and to do the first predict + IMU + flow step, with an empty numba cache (cold start)
+and with the cache populated by `warmup` (what a node sees after `spacekf_warmup`).
+Without the warm-up the whole compile time is spent in the first filter step instead.
+
+Usage:
+    python3 benchmark/startup.py
+'''
+import os
+import subprocess
+import sys
+import tempfile
+
+
+CHILD = '''
+import time
+start = time.perf_counter()
+import numpy as np
+from state_estimation_3d.spacekf import SpaceKF12
+from state_estimation_3d.spacekf.warmup import warmup
+t_import = time.perf_counter() - start
+
+t_warmup = warmup(update_modes=['standard']) if WARMUP else 0.
+
+camera_matrix = np.array([[100., 0, 64], [0, 100, 64], [0, 0, 1]])
+start = time.perf_counter()
+f = SpaceKF12(dt=0.1, velocity_std=1., rot_vel_std=1.)
+f.predict()
+f.update_acc(np.array([0, 0, 9.8]), np.eye(3), extrinsic=np.eye(3, 4))
+f.update_flow(
+    np.zeros([30, 3], dtype=np.float32), 0.1, np.ones(30, dtype=np.float32), np.full([30, 2], 64),
+    np.ones(90), camera_matrix, np.linalg.inv(camera_matrix), extrinsic=np.eye(3, 4),
+)
+t_step = time.perf_counter() - start
+print(t_import, t_warmup, t_step)
+'''
+
+
+def run(cache_dir, warmup):
+    env = dict(os.environ, NUMBA_CACHE_DIR=cache_dir)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = root + os.pathsep + env.get('PYTHONPATH', '')
+    code = CHILD.replace('WARMUP', str(warmup))
+    out = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True, check=True)
+    return [float(t) for t in out.stdout.split()[-3:]]
+
+
+def main():
+    print(f'{"run":>22} {"import s":>9} {"warmup s":>9} {"1st step s":>11}')
+    with tempfile.TemporaryDirectory() as empty_dir, tempfile.TemporaryDirectory() as cache_dir:
+        for name, run_dir, warmup in [
+            ('cold, no warmup', empty_dir, False),
+            ('cold, warmup', cache_dir, True),
+            ('cached, warmup', cache_dir, True),
+            ('cached, no warmup', cache_dir, False),
+        ]:
+            t_import, t_warmup, t_step = run(run_dir, warmup)
+            print(f'{name:>22} {t_import:>9.2f} {t_warmup:>9.2f} {t_step:>11.3f}')
+
+
+if __name__ == '__main__':
+    main()
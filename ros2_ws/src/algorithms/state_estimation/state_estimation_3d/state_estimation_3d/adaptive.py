@@ -0,0 +1,192 @@
+import numpy as np
+from numba import njit
+
+
+class InnovationNoiseEstimator:
+    '''
+    Adaptive measurement noise by innovation covariance matching
+
+    Keeps running sums of the innovation outer products `y y^T` and of the predicted
+    measurement covariances `H P H^T` over a sliding window of `window` updates:
+        C = 1/N sum y y^T
+        R = C - 1/N sum H P H^T
+    The oldest terms are subtracted from the sums, so `add` costs O(m^2) for m measurement rows.
+
+    Until the window is full, `R` is the initial value. The estimate is kept positive definite:
+    its diagonal is clamped to [min_scale, max_scale] times the initial diagonal, its correlations
+    to `max_correlation`, and the correlations of every row are shrunk so that their absolute sum
+    is at most `max_correlation` (see `clamped_mean`), which keeps `add` O(m^2).
+    '''
+
+    def __init__(self, R, window=100, min_scale=1e-2, max_scale=100., max_correlation=0.9):
+        '''
+        R (np.array): [m, m] initial covariance
+        window (int): number of updates in the sliding window
+        min_scale, max_scale (float): bounds of the adapted variances relative to the initial ones
+        max_correlation (float): bound of the adapted correlations
+        '''
+        self.R0 = np.atleast_2d(np.array(R, dtype=np.float64))
+        m = self.R0.shape[0]
+        self.window = window
+        self.min_var = np.diag(self.R0) * min_scale
+        self.max_var = np.diag(self.R0) * max_scale
+        self.max_correlation = max_correlation
+        self.mask = np.ones([m, m], dtype=np.bool_)
+        self.terms = np.zeros([window, m, m])
+        self.terms_sum = np.zeros([m, m])
+        self.count = 0
+        self.index = 0
+        self._R = self.R0.copy()
+
+    def add(self, y, HPHt):
+        '''
+        y (np.array): [m] innovation of an update
+        HPHt (np.array): [m, m] covariance of the predicted measurement (before the update)
+        '''
+        y = np.reshape(np.asarray(y, dtype=np.float64), -1)
+        HPHt = np.reshape(np.asarray(HPHt, dtype=np.float64), self.terms_sum.shape)
+        replace_term(self.terms, self.terms_sum, self.index, y, y, HPHt)
+        self.index = (self.index + 1) % self.window
+        self.count = min(self.count + 1, self.window)
+        if self.count == self.window:
+            clamped_mean(
+                self.terms_sum, self.window, self.mask, self.min_var, self.max_var, self.max_correlation, self._R
+            )
+
+    @property
+    def R(self):
+        return self._R
+
+    @property
+    def ready(self):
+        return self.count == self.window
+
+
+class ProcessNoiseEstimator:
+    '''
+    Adaptive process noise by covariance matching of the state corrections
+
+    `dx` is the sum of all measurement corrections `K y` applied between two predict steps.
+    Over a sliding window of N steps, Q = 1/N sum dx dx^T (Mohamed & Schwarz, 1999),
+    normalised to the nominal time step. Only the elements which are non-zero in the initial Q
+    are adapted, so that the structure of the process model is kept.
+    The cost of `add` is O(n^2).
+    '''
+
+    def __init__(self, Q, window=100, min_scale=1e-2, max_scale=100.):
+        '''
+        Q (np.array): [n, n] initial process noise covariance
+        window (int): number of predict steps in the sliding window
+        min_scale, max_scale (float): bounds of the adapted variances relative to the initial ones
+        '''
+        self.Q0 = np.array(Q, dtype=np.float64)
+        n = self.Q0.shape[0]
+        self.mask = self.Q0 != 0
+        self.window = window
+        self.min_var = np.diag(self.Q0) * min_scale
+        self.max_var = np.diag(self.Q0) * max_scale
+        self.terms = np.zeros([window, n, n])
+        self.terms_sum = np.zeros([n, n])
+        self._zeros = np.zeros([n, n])
+        self.count = 0
+        self.index = 0
+        self._Q = self.Q0.copy()
+
+    def add(self, dx, dt_scale=1.):
+        '''
+        dx (np.array): [n] total correction of the state since the last predict step
+        dt_scale (float): length of the last predict step relative to the nominal one
+        '''
+        replace_term(self.terms, self.terms_sum, self.index, dx, dx / dt_scale, self._zeros)
+        self.index = (self.index + 1) % self.window
+        self.count = min(self.count + 1, self.window)
+        if self.count == self.window:
+            clamped_mean(self.terms_sum, self.window, self.mask, self.min_var, self.max_var, 1., self._Q)
+
+    @property
+    def Q(self):
+        return self._Q
+
+    @property
+    def ready(self):
+        return self.count == self.window
+
+
+@njit(cache=True)
+def replace_term(terms, terms_sum, index, a, b, c):
+    '''
+    terms[index] = a b^T - c, keeping terms_sum equal to the sum of all terms
+    '''
+    m = terms_sum.shape[0]
+    for i in range(m):
+        for j in range(m):
+            term = a[i] * b[j] - c[i, j]
+            terms_sum[i, j] += term - terms[index, i, j]
+            terms[index, i, j] = term
+
+
+@njit(cache=True)
+def clamped_mean(terms_sum, count, mask, min_var, max_var, max_correlation, out):
+    '''
+    out = terms_sum / count, symmetrised, restricted to `mask`, with the variances clipped
+    to [min_var, max_var] and the correlations to `max_correlation`
+
+    Clipping the correlations one by one is enough for 2x2 matrices only, e.g. three variables
+    with all correlations -0.9 give eigenvalues (-0.8, 1.9, 1.9). So the correlations of the rows
+    whose absolute sum r_i exceeds `max_correlation` are then scaled: the (i, j) one by min(s_i, s_j),
+    s_i = min(1, max_correlation / r_i). By the Gershgorin circle theorem the smallest eigenvalue
+    of the correlation matrix is then at least 1 - max_correlation. The cost is O(m^2),
+    unlike an eigen-decomposition; the bound is conservative only for rows with large sums.
+    This keeps the mask and the variances.
+    '''
+    m = terms_sum.shape[0]
+    for i in range(m):
+        var = terms_sum[i, i] / count if mask[i, i] else 0.
+        out[i, i] = min(max(var, min_var[i]), max_var[i])
+    for i in range(m):
+        for j in range(i + 1, m):
+            value = 0.
+            if mask[i, j]:
+                value = 0.5 * (terms_sum[i, j] + terms_sum[j, i]) / count
+                bound = max_correlation * np.sqrt(out[i, i] * out[j, j])
+                value = min(max(value, -bound), bound)
+            out[i, j] = value
+            out[j, i] = value
+
+    # Row scales of the correlations: s_i = min(1, max_correlation / sum_j |out_ij| / (std_i std_j))
+    std = np.sqrt(np.diag(out))
+    row_scale = np.ones(m)
+    for i in range(m):
+        if std[i] == 0:
+            continue
+        row_sum = 0.
+        for j in range(m):
+            if j != i and std[j] > 0:
+                row_sum += abs(out[i, j]) / (std[i] * std[j])
+        if row_sum > max_correlation:
+            row_scale[i] = max_correlation / row_sum
+    for i in range(m):
+        for j in range(i + 1, m):
+            scale = min(row_scale[i], row_scale[j])
+            out[i, j] *= scale
+            out[j, i] *= scale
+
+
+def noise_diagnostics(name, noise_estimators, process_noise_estimator=None):
+    '''
+    diagnostic_msgs/DiagnosticStatus with the adapted covariances of a filter:
+    `R_<update name>` and `Q` as flattened lists, and the number of samples in their windows
+    '''
+    from diagnostic_msgs.msg import DiagnosticStatus, KeyValue
+
+    status = DiagnosticStatus()
+    status.name = name
+    status.message = 'adaptive noise'
+    estimators = [('R_' + key, e, e.R) for key, e in sorted(noise_estimators.items())]
+    if process_noise_estimator is not None:
+        estimators.append(('Q', process_noise_estimator, process_noise_estimator.Q))
+    for key, estimator, value in estimators:
+        status.values.append(KeyValue(key=key, value=str([float(v) for v in value.flatten()])))
+        status.values.append(KeyValue(key=key + '_samples', value=str(estimator.count)))
+    status.level = DiagnosticStatus.OK if all(e.ready for _, e, _ in estimators) else DiagnosticStatus.WARN
+    return status
@@ -1,17 +1,25 @@
+import threading
+
 import cv2
 import nnio
 import numpy as np
-from scipy.spatial.transform import Rotation
-from argparse import Namespace
 
 import rclpy
 from rclpy.node import Node
+from rclpy.executors import MultiThreadedExecutor
+from rclpy.callback_groups import MutuallyExclusiveCallbackGroup
 from sensor_msgs.msg import Image, Imu, CameraInfo
-from nav_msgs.msg import Odometry
+from diagnostic_msgs.msg import DiagnosticArray
 from cv_bridge import CvBridge
 import tf2_ros
 
 from .spacekf import SpaceKF12
+from .spacekf.filter import POSE_COVARIANCE_INDEX, TWIST_COVARIANCE_INDEX
+from .spacekf.preintegration import ImuPreintegration
+from .spacekf.warmup import warmup
+from .extrinsics import ExtrinsicsCache
+from .gating import gating_diagnostics
+from .messages import OdometryPublisher, fill_covariance
 from perception_msgs.msg import OdoFlow
 from optical_flow.stereo_camera import StereoCamera
 
@@ -28,26 +36,52 @@ class EKFNode(Node):
         self.declare_parameter('period', 0.1)
         self.declare_parameter('vel_std', 1.0)
         self.declare_parameter('rot_vel_std', 1.0)
+        # Time kept to fuse delayed measurements at their true time, s
+        self.declare_parameter('history_length', 2.0)
+        # Event-driven mode: every measurement predicts the filter to its stamp and is fused at once
+        self.declare_parameter('event_driven', False)
+        # Event-driven mode: expected rate of predict steps (IMU and flow messages together), Hz.
+        # The history and the smoother keep a number of steps, it is their length in time times this rate
+        self.declare_parameter('event_rate', 100.0)
+        # Event-driven mode: period of the pose publisher. 0 means publishing after every measurement
+        self.declare_parameter('publish_period', 0.0)
+        # Lag of the fixed-lag smoother, s. The smoothed pose is published to pose_ekf_smoothed. 0 disables it
+        self.declare_parameter('smoother_lag', 0.5)
+        # Probability of the chi-square gate of all updates, 0 disables gating.
+        # Counters of accepted and rejected measurements are published to /diagnostics once a second
+        self.declare_parameter('gate_probability', 0.999)
 
         # Kalman filter parameters
         vel_std = self.get_parameter('vel_std').get_parameter_value().double_value
         rot_vel_std = self.get_parameter('rot_vel_std').get_parameter_value().double_value
+        history_length = self.get_parameter('history_length').get_parameter_value().double_value
+        smoother_lag = self.get_parameter('smoother_lag').get_parameter_value().double_value
+        gate_probability = self.get_parameter('gate_probability').get_parameter_value().double_value
 
         # Get camera parameters
         self.stereo = None
 
+        # Filter is stepped by sensor callbacks, pose may be published from a separate thread
+        self.event_driven = self.get_parameter('event_driven').get_parameter_value().bool_value
+        self.publish_period = self.get_parameter('publish_period').get_parameter_value().double_value
+        self.sensor_group = MutuallyExclusiveCallbackGroup()
+        self.publish_group = MutuallyExclusiveCallbackGroup()
+        self.lock = threading.Lock()
+
         # Subscribe to sensor topics
         self.create_subscription(
             OdoFlow,
             'odom_flow',
             self.odometry_callback,
             10,
+            callback_group=self.sensor_group,
         )
         self.create_subscription(
             Imu,
             'imu',
             self.imu_callback,
             10,
+            callback_group=self.sensor_group,
         )
         self.create_subscription(
             CameraInfo,
@@ -56,31 +90,53 @@ class EKFNode(Node):
             10,
         )
 
-        # Publisher
-        self.pose_publisher = self.create_publisher(
-            Odometry,
-            'pose_ekf',
-            10,
-        )
+        # Publisher. The Odometry and TransformStamped messages are allocated once and reused
+        self.pose_publisher = OdometryPublisher(self, 'pose_ekf', 'map', 'base_link', self.tf2_broadcaster)
+        self.smoothed_pose_publisher = OdometryPublisher(self, 'pose_ekf_smoothed', 'map', 'base_link')
 
         # Create timer
         self.period = self.get_parameter('period').get_parameter_value().double_value
-        self.create_timer(self.period, self.step)
+        event_rate = self.get_parameter('event_rate').get_parameter_value().double_value
+        # Time between predict steps, it converts the history and the smoother lag to steps
+        step_period = 1 / event_rate if self.event_driven else self.period
+        if not self.event_driven:
+            self.create_timer(self.period, self.step, callback_group=self.sensor_group)
+        elif self.publish_period > 0:
+            self.create_timer(self.publish_period, self.publish_callback, callback_group=self.publish_group)
 
         # Create Kalman filter
-        self.tracker = SpaceKF12(dt=self.period, velocity_std=vel_std, rot_vel_std=rot_vel_std)
+        self.tracker = SpaceKF12(
+            dt=self.period, velocity_std=vel_std, rot_vel_std=rot_vel_std,
+            history_size=max(int(np.ceil(history_length / step_period)), 1),
+            smoother_lag=int(round(smoother_lag / step_period)), gate_probability=gate_probability,
+        )
         self.tracker.P = self.tracker.P * 0.01
+        # Load compiled kernels from the numba cache (or compile them) before the first step
+        print(f'spacekf warm-up: {warmup(update_modes=[self.tracker.update_mode]):.2f} s')
+        self.tracker.stamp = self.get_time()
+
+        if self.tracker.gate.enabled:
+            self.diagnostics_publisher = self.create_publisher(DiagnosticArray, '/diagnostics', 10)
+            self.create_timer(1.0, self.publish_diagnostics, callback_group=self.publish_group)
 
         # Buffers for measurements
-        self.imu_buffer = None
-        self.imu_count = 0
+        self.imu_buffer = ImuPreintegration()
+        self.imu_frame = None
         self.odom_buffer = None
 
         # TF listener
         self.tf_buffer = tf2_ros.Buffer(rclpy.duration.Duration(seconds=1))
         self.tf_listener = tf2_ros.TransformListener(self.tf_buffer, self)
+        self.extrinsics = ExtrinsicsCache(self, self.tf_buffer)
 
     def odometry_callback(self, msg):
+        if self.event_driven:
+            # Older flow is fused at its stamp by the state history
+            with self.lock:
+                self.predict_to(msg.header.stamp.sec + msg.header.stamp.nanosec * 1e-9)
+                self.update_odom_flow(msg)
+            self.publish_event()
+            return
         self.odom_buffer = msg
 
     def imu_callback(self, msg):
@@ -88,53 +144,71 @@ class EKFNode(Node):
             # print('Wrong imu frame:', msg.header.frame_id)
             return
 
-        if self.imu_buffer is None:
-            self.imu_buffer = msg
-            self.imu_count = 1
-        else:
-            self.imu_buffer.angular_velocity.x += msg.angular_velocity.x
-            self.imu_buffer.angular_velocity.y += msg.angular_velocity.y
-            self.imu_buffer.angular_velocity.z += msg.angular_velocity.z
-            self.imu_buffer.linear_acceleration.x += msg.linear_acceleration.x
-            self.imu_buffer.linear_acceleration.y += msg.linear_acceleration.y
-            self.imu_buffer.linear_acceleration.z += msg.linear_acceleration.z
-            self.imu_count += 1
+        stamp = msg.header.stamp.sec + msg.header.stamp.nanosec * 1e-9
+        self.imu_frame = msg.header.frame_id
+        self.imu_buffer.add(
+            stamp,
+            (msg.angular_velocity.x, msg.angular_velocity.y, msg.angular_velocity.z),
+            (msg.linear_acceleration.x, msg.linear_acceleration.y, msg.linear_acceleration.z),
+            np.array(msg.angular_velocity_covariance).reshape([3, 3]),
+            np.array(msg.linear_acceleration_covariance).reshape([3, 3]),
+        )
+
+        if self.event_driven:
+            with self.lock:
+                self.predict_to(stamp)
+                self.update_imu()
+            self.publish_event()
 
     def step(self):
         '''
         EKF predict and update step
         '''
-        # Predict
-        self.tracker.predict()
-        # Update
-        if self.imu_buffer is not None:
-            self.update_imu(self.imu_buffer)
-            self.imu_buffer = None
-        if self.odom_buffer is not None:
-            self.update_odom_flow(self.odom_buffer)
-            self.odom_buffer = None
-        # Publish
-        self.publish_pose()
-
-    def update_imu(self, msg):
+        # The publish group reads the filter concurrently
+        with self.lock:
+            # Predict
+            self.tracker.predict(stamp=self.get_time())
+            # Update
+            if self.imu_buffer.count > 0:
+                self.update_imu()
+            if self.odom_buffer is not None:
+                self.update_odom_flow(self.odom_buffer)
+                self.odom_buffer = None
+            # Publish
+            self.publish_pose()
+
+    def predict_to(self, stamp):
         '''
-        Update filter state using IMU message
+        Event-driven mode: predict the filter state up to `stamp` (seconds) with a variable time step
+        '''
+        dt = stamp - self.tracker.stamp
+        if dt > 0:
+            self.tracker.predict(dt=dt, stamp=stamp)
+
+    def publish_event(self):
+        '''
+        Event-driven mode: publish the pose right after a measurement if there is no publisher timer
+        '''
+        if self.publish_period <= 0:
+            self.publish_callback()
+
+    def publish_callback(self):
+        with self.lock:
+            self.publish_pose()
+
+    def update_imu(self):
+        '''
+        Update filter state using IMU samples preintegrated since the last update
         '''
 
         # Make KF-compatible measurements
-        rot_vel = np.empty(3)
-        rot_vel[0] = msg.angular_velocity.x / self.imu_count
-        rot_vel[1] = msg.angular_velocity.y / self.imu_count
-        rot_vel[2] = msg.angular_velocity.z / self.imu_count
-        rot_vel_R = np.array(msg.angular_velocity_covariance).reshape([3, 3])
-        acc = np.empty(3)
-        acc[0] = msg.linear_acceleration.x / self.imu_count
-        acc[1] = msg.linear_acceleration.y / self.imu_count
-        acc[2] = msg.linear_acceleration.z / self.imu_count
-        acc_R = np.array(msg.linear_acceleration_covariance).reshape([3, 3])
+        rot_vel, rot_vel_R, acc, acc_R = self.imu_buffer.integrate()
 
         # Get extrinsics from tf
-        extrinsic = self.get_extrinsic(msg.header.frame_id, 'base_link')
+        extrinsic = self.extrinsics.get(self.imu_frame, 'base_link')
+        if extrinsic is None:
+            print(f'waiting for transform {self.imu_frame} -> base_link...')
+            return
 
         # Update
         print(acc)
@@ -151,19 +225,23 @@ class EKFNode(Node):
 
         z = np.vstack([msg.flow_x, msg.flow_y, msg.delta_depth]).transpose() # [N, 3]
         pixels = np.vstack([msg.x, msg.y]).transpose() # [N, 2]
-        R = np.diag(msg.covariance_diag)
+        R = np.array(msg.covariance_diag, dtype=float) # diagonal of the [3N, 3N] covariance
 
         # Get extrinsics from tf
-        extrinsic = self.get_extrinsic(msg.header.frame_id, 'base_link')
+        extrinsic = self.extrinsics.get(msg.header.frame_id, 'base_link')
+        if extrinsic is None:
+            print(f'waiting for transform {msg.header.frame_id} -> base_link...')
+            return
 
         # Compute time delay
         msg_time = msg.header.stamp.sec + msg.header.stamp.nanosec * 1e-9
-        ros_stamp = self.get_clock().now().seconds_nanoseconds()
-        ros_time = ros_stamp[0] + ros_stamp[1] * 1e-9
-        delay = ros_time - msg_time
+        delay = self.get_time() - msg_time
         print('odom delay:', delay)
 
-        self.tracker.update_flow(
+        # Apply the measurement at its true time
+        self.tracker.update_at(
+            msg_time,
+            'update_flow',
             z,
             msg.delta_t,
             msg.depth,
@@ -172,87 +250,52 @@ class EKFNode(Node):
             self.stereo.M1,
             self.stereo.M1_inv,
             extrinsic=extrinsic,
-            delay=delay*0,
         )
 
-    def get_extrinsic(self, frame1, frame2):
+    def get_time(self):
         '''
-        Parameters:
-        frame1 (str): tf frame
-        frame2 (str): tf frame
-
-        Returns:
-        np.array of shape [3, 4]: rotation-translation matrix between two tf frames.
+        Returns current ROS time in seconds
         '''
-        while True:
-            try:
-                # t = self.get_clock().now()
-                # rclpy.spin_once(self)
-                t = Namespace(seconds=0, nanoseconds=0)
-                trans = self.tf_buffer.lookup_transform(frame1, frame2, t, rclpy.duration.Duration(seconds=10))
-                # print(f"Got transform! {frame1} -> {frame2}")
-                break
-            except tf2_ros.LookupException:
-                # rclpy.spin_once(self)
-                print(f"Retrying to get transform {frame1} -> {frame2}", self.get_clock().now())
-
-        tr = np.array([
-            [trans.transform.translation.x],
-            [trans.transform.translation.y],
-            [trans.transform.translation.z],
-        ])
-        rot_q = np.array([
-            trans.transform.rotation.x,
-            trans.transform.rotation.y,
-            trans.transform.rotation.z,
-            trans.transform.rotation.w,
-        ])
-        rot = Rotation.from_quat(rot_q).as_matrix()
-        extrinsic = np.concatenate([rot, tr], 1)
-        return extrinsic
+        ros_stamp = self.get_clock().now().seconds_nanoseconds()
+        return ros_stamp[0] + ros_stamp[1] * 1e-9
 
     def publish_pose(self):
-        # Make odometry message
-        msg = Odometry()
+        # Pose (quaternion q is x, y, z, w) and velocities
+        publisher = self.pose_publisher
+        publisher.set_pose(self.get_clock().now().to_msg(), self.tracker.pos, self.tracker.q)
+        publisher.set_twist(self.tracker.vel, self.tracker.rot_vel)
+        # Covariances are written directly into the message arrays
+        self.tracker.get_pose_covariance(out=publisher.pose_covariance)
+        self.tracker.get_twist_covariance(out=publisher.twist_covariance)
+        # Publish the pose and broadcast the transform
+        publisher.publish()
+
+        self.publish_smoothed_pose()
+
+    def publish_smoothed_pose(self):
+        '''
+        Publish the fixed-lag smoothed pose with the stamp of the smoothed filter step
+        '''
+        smoothed = self.tracker.smooth()
+        if smoothed is None:
+            return
+        stamp, x, P, q = smoothed
+        publisher = self.smoothed_pose_publisher
+        publisher.set_pose(rclpy.time.Time(nanoseconds=int(stamp * 1e9)).to_msg(), x[:3], q)
+        publisher.set_twist(x[3:6], x[9:])
+        fill_covariance(publisher.pose_covariance, P, POSE_COVARIANCE_INDEX)
+        fill_covariance(publisher.twist_covariance, P, TWIST_COVARIANCE_INDEX)
+        publisher.publish()
+
+    def publish_diagnostics(self):
+        '''
+        Publish the numbers of measurements accepted and rejected by the chi-square gate
+        '''
+        msg = DiagnosticArray()
         msg.header.stamp = self.get_clock().now().to_msg()
-        msg.header.frame_id = 'map'
-        msg.child_frame_id = 'base_link'
-        # Position
-        msg.pose.pose.position.x = self.tracker.pos[0]
-        msg.pose.pose.position.y = self.tracker.pos[1]
-        msg.pose.pose.position.z = self.tracker.pos[2]
-        # Angle
-        msg.pose.pose.orientation.x = self.tracker.q[0]
-        msg.pose.pose.orientation.y = self.tracker.q[1]
-        msg.pose.pose.orientation.z = self.tracker.q[2]
-        msg.pose.pose.orientation.w = self.tracker.q[3]
-        # Pose & angle covariance
-        msg.pose.covariance = self.tracker.get_pose_covariance()
-        # Velocity
-        msg.twist.twist.linear.x = self.tracker.vel[0]
-        msg.twist.twist.linear.y = self.tracker.vel[1]
-        msg.twist.twist.linear.z = self.tracker.vel[2]
-        # Angular velocity
-        msg.twist.twist.angular.x = self.tracker.rot_vel[0]
-        msg.twist.twist.angular.y = self.tracker.rot_vel[1]
-        msg.twist.twist.angular.z = self.tracker.rot_vel[2]
-        # Vel & angvel covariance
-        msg.twist.covariance = self.tracker.get_twist_covariance()
-        # Publish
-        self.pose_publisher.publish(msg)
-
-        # Broadcast tf2
-        t = tf2_ros.TransformStamped()
-        t.header = msg.header
-        t.child_frame_id = 'base_link'
-        t.transform.translation.x = self.tracker.pos[0]
-        t.transform.translation.y = self.tracker.pos[1]
-        t.transform.translation.z = self.tracker.pos[2]
-        t.transform.rotation.x = self.tracker.q[0]
-        t.transform.rotation.y = self.tracker.q[1]
-        t.transform.rotation.z = self.tracker.q[2]
-        t.transform.rotation.w = self.tracker.q[3]
-        self.tf2_broadcaster.sendTransform(t)
+        with self.lock:
+            msg.status.append(gating_diagnostics(self.get_name(), self.tracker.gate))
+        self.diagnostics_publisher.publish(msg)
 
     def calibration_callback(self, msg):
         if self.stereo is None:
@@ -274,7 +317,10 @@ def main(args=None):
 
     node = EKFNode()
 
-    rclpy.spin(node)
+    # Sensor callbacks and the pose publisher run in separate callback groups
+    executor = MultiThreadedExecutor()
+    executor.add_node(node)
+    executor.spin()
 
     # Destroy the node explicitly
     # (optional - otherwise it will be done automatically
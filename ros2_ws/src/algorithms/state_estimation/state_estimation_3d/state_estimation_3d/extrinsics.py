@@ -0,0 +1,118 @@
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+import rclpy
+from rclpy.qos import QoSProfile, DurabilityPolicy, HistoryPolicy
+from tf2_msgs.msg import TFMessage
+import tf2_ros
+
+
+class ExtrinsicsCache:
+    '''
+    Cache of static extrinsics between tf frames
+
+    Frame pairs are looked up in the tf buffer and returned as contiguous [3, 4]
+    rotation-translation matrices. Only the pairs connected by transforms from `/tf_static`
+    are cached: the static parent of every frame is recorded from the subscription, and a pair
+    is static if both frames reach a common frame through static parents. Any other pair
+    (e.g. a camera mounted on a joint published on /tf) is looked up again on every call.
+    The cache is cleared when a new static transform arrives.
+    Lookups never wait: if a transform is not known yet, `get` returns None
+    and the caller should skip the measurement.
+    '''
+
+    def __init__(self, node, tf_buffer):
+        '''
+        node (rclpy.node.Node): node which subscribes to `/tf_static`
+        tf_buffer (tf2_ros.Buffer): buffer used for the lookups
+        '''
+        self.tf_buffer = tf_buffer
+        self.extrinsics = {}
+        # Child frame -> parent frame of the transforms received on /tf_static
+        self.static_parents = {}
+        qos = QoSProfile(
+            depth=100,
+            durability=DurabilityPolicy.TRANSIENT_LOCAL,
+            history=HistoryPolicy.KEEP_LAST,
+        )
+        node.create_subscription(TFMessage, '/tf_static', self.tf_static_callback, qos)
+
+    def tf_static_callback(self, msg):
+        # Put transforms into the buffer before clearing the cache,
+        # so that the next lookup can not find the old ones
+        for transform in msg.transforms:
+            self.tf_buffer.set_transform_static(transform, 'extrinsics_cache')
+            self.static_parents[transform.child_frame_id] = transform.header.frame_id
+        self.extrinsics.clear()
+
+    def is_static(self, frame1, frame2):
+        '''
+        True if the transform between two frames is composed of static transforms only
+        '''
+        ancestors = set(self.static_chain(frame2))
+        return any(frame in ancestors for frame in self.static_chain(frame1))
+
+    def static_chain(self, frame):
+        '''
+        The frame followed by its static parent, grandparent and so on
+        '''
+        chain = [frame]
+        while chain[-1] in self.static_parents and len(chain) <= len(self.static_parents):
+            chain.append(self.static_parents[chain[-1]])
+        return chain
+
+    def get(self, frame1, frame2):
+        '''
+        Parameters:
+        frame1 (str): tf frame
+        frame2 (str): tf frame
+
+        Returns:
+        np.array of shape [3, 4]: rotation-translation matrix between two tf frames
+        or None if the transform is not available yet.
+        The latest transform for dynamic pairs, see `is_static`.
+        '''
+        key = (frame1, frame2)
+        extrinsic = self.extrinsics.get(key)
+        if extrinsic is None:
+            extrinsic = self.lookup(frame1, frame2)
+            if extrinsic is not None and self.is_static(frame1, frame2):
+                self.extrinsics[key] = extrinsic
+        return extrinsic
+
+    def lookup(self, frame1, frame2):
+        '''
+        Non-blocking lookup of the latest transform between two frames
+        '''
+        if frame1 == frame2:
+            return np.ascontiguousarray(np.eye(3, 4))
+        try:
+            trans = self.tf_buffer.lookup_transform(frame1, frame2, rclpy.time.Time())
+        except (tf2_ros.LookupException, tf2_ros.ConnectivityException, tf2_ros.ExtrapolationException):
+            return None
+
+        return transform_to_extrinsic(trans.transform)
+
+
+def transform_to_extrinsic(transform):
+    '''
+    Parameters:
+    transform (geometry_msgs.msg.Transform): transform between two tf frames
+
+    Returns:
+    np.array of shape [3, 4]: contiguous rotation-translation matrix
+    '''
+    tr = np.array([
+        [transform.translation.x],
+        [transform.translation.y],
+        [transform.translation.z],
+    ])
+    rot_q = np.array([
+        transform.rotation.x,
+        transform.rotation.y,
+        transform.rotation.z,
+        transform.rotation.w,
+    ])
+    rot = Rotation.from_quat(rot_q).as_matrix()
+    extrinsic = np.concatenate([rot, tr], 1)
+    return np.ascontiguousarray(extrinsic)
@@ -0,0 +1,76 @@
+import numpy as np
+from scipy.stats import chi2
+
+
+class ChiSquareGate:
+    '''
+    Mahalanobis (chi-square) gating of measurement updates
+
+    A measurement with m rows is rejected if its squared Mahalanobis distance
+    d^2 = y^T S^-1 y exceeds the `probability` quantile of the chi-square distribution
+    with m degrees of freedom. Kalman update kernels take the threshold as `gate`
+    and compute d^2 from the S they already have.
+
+    `accepted` and `rejected` count the gated measurements per update name.
+    '''
+
+    def __init__(self, probability=0.999):
+        '''
+        probability (float): probability of accepting a measurement which fits the model.
+            0 disables gating (the threshold is infinite)
+        '''
+        self.probability = probability
+        self._thresholds = {}
+        self.accepted = {}
+        self.rejected = {}
+
+    @property
+    def enabled(self):
+        return self.probability > 0
+
+    def threshold(self, m):
+        '''
+        Gate of a measurement with `m` rows
+        '''
+        if not self.enabled:
+            return np.inf
+        threshold = self._thresholds.get(m)
+        if threshold is None:
+            threshold = float(chi2.ppf(self.probability, m))
+            self._thresholds[m] = threshold
+        return threshold
+
+    def record(self, name, accepted):
+        '''
+        Count a gated measurement of the update `name`
+        '''
+        self.count(name, int(accepted), int(not accepted))
+
+    def count(self, name, accepted, rejected):
+        '''
+        Count `accepted` and `rejected` items (e.g. points of a flow measurement) of the update `name`
+        '''
+        self.accepted[name] = self.accepted.get(name, 0) + accepted
+        self.rejected[name] = self.rejected.get(name, 0) + rejected
+
+    def rejection_rate(self, name):
+        total = self.accepted.get(name, 0) + self.rejected.get(name, 0)
+        return self.rejected.get(name, 0) / total if total else 0.
+
+
+def gating_diagnostics(name, gate):
+    '''
+    diagnostic_msgs/DiagnosticStatus with the numbers of accepted and rejected measurements of every update
+    '''
+    from diagnostic_msgs.msg import DiagnosticStatus, KeyValue
+
+    status = DiagnosticStatus()
+    status.name = name
+    status.message = 'chi-square gating, p = {}'.format(gate.probability)
+    status.level = DiagnosticStatus.OK
+    for key in sorted(gate.accepted):
+        status.values.append(KeyValue(key=key + '_accepted', value=str(gate.accepted[key])))
+        status.values.append(KeyValue(key=key + '_rejected', value=str(gate.rejected[key])))
+        if gate.rejection_rate(key) > 0.5:
+            status.level = DiagnosticStatus.WARN
+    return status
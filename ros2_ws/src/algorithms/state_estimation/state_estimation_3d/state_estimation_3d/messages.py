@@ -0,0 +1,115 @@
+import math
+
+import numpy as np
+
+
+def yaw_to_quaternion(yaw):
+    '''
+    Quaternion (x, y, z, w) of a rotation by `yaw` about the z axis
+    '''
+    half = 0.5 * yaw
+    return 0., 0., math.sin(half), math.cos(half)
+
+
+def covariance_index(indices, dim):
+    '''
+    Flat indices of the submatrix P[indices][:, indices] of a [dim, dim] matrix P,
+    row by row. Used with `fill_covariance` to extract the submatrix without temporaries.
+    '''
+    indices = np.asarray(indices)
+    return (indices[:, None] * dim + indices[None, :]).flatten()
+
+
+def fill_covariance(out, P, index):
+    '''
+    Write the elements `index` (see `covariance_index`) of the flattened P into `out`
+
+    out (np.array): e.g. `covariance` field of a PoseWithCovariance message, which is
+        a float64 array in rclpy messages. It is filled in place, no list or array is created
+    '''
+    np.take(P, index, out=out)
+    return out
+
+
+class OdometryPublisher:
+    '''
+    Publisher of nav_msgs/Odometry with the matching transform
+
+    The Odometry and TransformStamped messages are created once and reused:
+    every `publish` only writes the changed fields. rclpy serializes a message
+    inside `publish`, so the same object can be filled again right after.
+    Covariances are written directly into the message arrays, see `fill_covariance`.
+    '''
+
+    def __init__(self, node, topic, frame_id, child_frame_id, tf2_broadcaster=None, qos=10):
+        '''
+        node (rclpy.node.Node): node which owns the publisher
+        topic (str): Odometry topic
+        frame_id, child_frame_id (str): frames of the pose and of the transform
+        tf2_broadcaster (tf2_ros.TransformBroadcaster or None): broadcaster of the transform.
+            None disables the transform
+        '''
+        from nav_msgs.msg import Odometry
+        from geometry_msgs.msg import TransformStamped
+
+        self.publisher = node.create_publisher(Odometry, topic, qos)
+        self.tf2_broadcaster = tf2_broadcaster
+        self.msg = Odometry()
+        self.msg.header.frame_id = frame_id
+        self.msg.child_frame_id = child_frame_id
+        self.transform = TransformStamped()
+        self.transform.header.frame_id = frame_id
+        self.transform.child_frame_id = child_frame_id
+
+    def set_pose(self, stamp, position, orientation):
+        '''
+        stamp (builtin_interfaces/Time)
+        position: (x, y, z)
+        orientation: quaternion (x, y, z, w)
+        '''
+        msg = self.msg
+        msg.header.stamp = stamp
+        p = msg.pose.pose.position
+        p.x, p.y, p.z = float(position[0]), float(position[1]), float(position[2])
+        q = msg.pose.pose.orientation
+        q.x, q.y, q.z, q.w = float(orientation[0]), float(orientation[1]), float(orientation[2]), float(orientation[3])
+
+    def set_twist(self, linear, angular):
+        '''
+        linear, angular: (x, y, z) velocities
+        '''
+        t = self.msg.twist.twist
+        t.linear.x, t.linear.y, t.linear.z = float(linear[0]), float(linear[1]), float(linear[2])
+        t.angular.x, t.angular.y, t.angular.z = float(angular[0]), float(angular[1]), float(angular[2])
+
+    @property
+    def pose_covariance(self):
+        return self.msg.pose.covariance
+
+    @property
+    def twist_covariance(self):
+        return self.msg.twist.covariance
+
+    def publish(self):
+        '''
+        Publish the message and broadcast the transform with the same stamp and pose.
+        '''
+        msg = self.msg
+        self.publisher.publish(msg)
+        if self.tf2_broadcaster is not None:
+            self.tf2_broadcaster.sendTransform(self.fill_transform())
+
+    def fill_transform(self):
+        '''
+        Copy the stamp and the pose of the message into the reused transform and return it
+        '''
+        msg = self.msg
+        t = self.transform
+        t.header.stamp = msg.header.stamp
+        p = msg.pose.pose.position
+        tr = t.transform.translation
+        tr.x, tr.y, tr.z = p.x, p.y, p.z
+        q = msg.pose.pose.orientation
+        r = t.transform.rotation
+        r.x, r.y, r.z, r.w = q.x, q.y, q.z, q.w
+        return t
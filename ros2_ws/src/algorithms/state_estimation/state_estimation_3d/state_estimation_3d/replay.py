@@ -0,0 +1,470 @@
+'''
+Offline replay of recorded sequences through SpaceKF12
+
+Reads IMU, OdoFlow, camera info and ground-truth pose either from an HDF5 file
+written by `rosbag_to_hdf5 ekf_data_recorder` or from a rosbag2 directory,
+steps the filter the same way `EKFNode` does (fixed period, preintegrated IMU,
+flow fused at its stamp) without any executor and as fast as the CPU allows,
+and reports ATE/RPE together with the time per predict and update.
+Several sequences are processed in parallel by a process pool.
+
+Usage:
+    ros2 run state_estimation_3d replay seq1.hdf5 seq2.hdf5 bag_dir --workers 4
+'''
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.spatial.transform import Rotation, Slerp
+
+from .spacekf import SpaceKF12
+from .spacekf.filter import UPDATE_MODES
+from .spacekf.preintegration import ImuPreintegration
+from .spacekf.warmup import warmup
+from optical_flow.stereo_camera import StereoCamera
+
+
+def load_hdf5(path):
+    '''
+    Read a sequence recorded by `ekf_data_recorder`
+
+    Returns:
+    dict: sequence in the format of `make_sequence`
+    '''
+    import h5py
+
+    with h5py.File(path, 'r') as f:
+        data = {key: f[key][()] for key in f.keys()}
+
+    lengths = data['flow_lengths']
+    splits = np.cumsum(lengths)[:-1]
+    flow = []
+    for i, (pixel_x, pixel_y, depth, flow_x, flow_y, delta_depth, cov) in enumerate(zip(
+        np.split(data['flow_pixel_x'], splits),
+        np.split(data['flow_pixel_y'], splits),
+        np.split(data['flow_depth'], splits),
+        np.split(data['flow_x'], splits),
+        np.split(data['flow_y'], splits),
+        np.split(data['flow_delta_depth'], splits),
+        np.split(data['flow_covariance_diag'], 3 * splits),
+    )):
+        flow.append(make_flow(
+            data['flow_stamp'][i], data['flow_delta_t'][i],
+            pixel_x, pixel_y, depth, flow_x, flow_y, delta_depth, cov,
+        ))
+
+    camera = None
+    if 'camera_k' in data:
+        height, width = data['camera_size']
+        camera = make_camera(data['camera_k'], data['camera_p'], data['camera_r'], height, width)
+
+    return make_sequence(
+        imu=(data['imu_stamp'], data['imu_gyro'], data['imu_acc'], data['imu_gyro_cov'], data['imu_acc_cov']),
+        flow=flow,
+        ground_truth=(data['pose_stamp'], data['position'], data['rotation']),
+        camera=camera,
+        imu_extrinsic=data.get('imu_extrinsic'),
+        flow_extrinsic=data.get('flow_extrinsic'),
+    )
+
+
+def load_rosbag(path, imu_topic='imu', flow_topic='odom_flow',
+                camera_info_topic='rectified_camera_info', pose_topic='pose'):
+    '''
+    Read a sequence from a rosbag2 directory. Static extrinsics are taken from `/tf_static`.
+    Ground truth may be `PoseStamped` or `Odometry`.
+
+    Returns:
+    dict: sequence in the format of `make_sequence`
+    '''
+    import rosbag2_py
+    import tf2_ros
+    from rclpy.serialization import deserialize_message
+    from rclpy.time import Time
+    from rosidl_runtime_py.utilities import get_message
+    from .extrinsics import transform_to_extrinsic
+
+    reader = rosbag2_py.SequentialReader()
+    reader.open(
+        rosbag2_py.StorageOptions(uri=path, storage_id='sqlite3'),
+        rosbag2_py.ConverterOptions(input_serialization_format='cdr', output_serialization_format='cdr'),
+    )
+    types = {topic.name: get_message(topic.type) for topic in reader.get_all_topics_and_types()}
+    topics = ['/' + t.lstrip('/') for t in [imu_topic, flow_topic, camera_info_topic, pose_topic]]
+    imu_topic, flow_topic, camera_info_topic, pose_topic = topics
+
+    tf_buffer = tf2_ros.Buffer()
+    imu = []
+    imu_frame = None
+    flow = []
+    flow_frame = None
+    ground_truth = []
+    camera = None
+    while reader.has_next():
+        topic, raw, _ = reader.read_next()
+        if topic not in topics and topic != '/tf_static':
+            continue
+        msg = deserialize_message(raw, types[topic])
+        if topic == '/tf_static':
+            for transform in msg.transforms:
+                tf_buffer.set_transform_static(transform, 'replay')
+            continue
+        stamp = msg.header.stamp.sec + msg.header.stamp.nanosec * 1e-9
+        if topic == imu_topic:
+            imu_frame = msg.header.frame_id
+            imu.append((
+                stamp,
+                [msg.angular_velocity.x, msg.angular_velocity.y, msg.angular_velocity.z],
+                [msg.linear_acceleration.x, msg.linear_acceleration.y, msg.linear_acceleration.z],
+                np.array(msg.angular_velocity_covariance).reshape([3, 3]),
+                np.array(msg.linear_acceleration_covariance).reshape([3, 3]),
+            ))
+        elif topic == flow_topic:
+            flow_frame = msg.header.frame_id
+            flow.append(make_flow(
+                stamp, msg.delta_t, msg.x, msg.y, msg.depth,
+                msg.flow_x, msg.flow_y, msg.delta_depth, msg.covariance_diag,
+            ))
+        elif topic == camera_info_topic:
+            if camera is None:
+                camera = make_camera(msg.k, msg.p, msg.r, msg.height, msg.width)
+        else:
+            pose = msg.pose.pose if hasattr(msg.pose, 'pose') else msg.pose
+            ground_truth.append((
+                stamp,
+                [pose.position.x, pose.position.y, pose.position.z],
+                [pose.orientation.x, pose.orientation.y, pose.orientation.z, pose.orientation.w],
+            ))
+
+    def lookup(frame):
+        if frame is None:
+            return None
+        try:
+            trans = tf_buffer.lookup_transform(frame, 'base_link', Time())
+        except (tf2_ros.LookupException, tf2_ros.ConnectivityException, tf2_ros.ExtrapolationException):
+            return None
+        return transform_to_extrinsic(trans.transform)
+
+    return make_sequence(
+        imu=[np.array(column) for column in zip(*imu)] if imu else None,
+        flow=flow,
+        ground_truth=[np.array(column) for column in zip(*ground_truth)] if ground_truth else None,
+        camera=camera,
+        imu_extrinsic=lookup(imu_frame),
+        flow_extrinsic=lookup(flow_frame),
+    )
+
+
+def make_flow(stamp, delta_t, pixel_x, pixel_y, depth, flow_x, flow_y, delta_depth, covariance_diag):
+    '''
+    Returns:
+    dict: OdoFlow message converted to the arguments of `SpaceKF12.update_flow`
+    '''
+    return {
+        'stamp': float(stamp),
+        'delta_t': float(delta_t),
+        'z': np.vstack([flow_x, flow_y, delta_depth]).transpose(), # [N, 3]
+        'depth': np.asarray(depth, dtype=float),
+        'pixels': np.vstack([pixel_x, pixel_y]).transpose(), # [N, 2]
+        'R': np.asarray(covariance_diag, dtype=float), # diagonal of the [3N, 3N] covariance
+    }
+
+
+def make_camera(k, p, r, height, width):
+    '''
+    Same camera as in `EKFNode.calibration_callback`
+    '''
+    M1 = np.array(k).reshape([3, 3])
+    T = [p[3] / k[0], p[7] / k[0], p[11] / k[0]]
+    R = np.array(r).reshape([3, 3])
+    stereo = StereoCamera(M1=M1, M2=M1, R=R, T=T, image_h=int(height), image_w=int(width))
+    stereo.change_dimensions_(128, 128)
+    return stereo
+
+
+def make_sequence(imu, flow, ground_truth, camera, imu_extrinsic, flow_extrinsic):
+    '''
+    Parameters:
+    imu (tuple): stamps [N], gyro [N, 3], acc [N, 3], gyro covariances [N, 3, 3], acc covariances [N, 3, 3]
+    flow (list of dict): flow messages from `make_flow`
+    ground_truth (tuple): stamps [M], positions [M, 3], quaternions [M, 4] in [x, y, z, w] order
+    camera (StereoCamera): rectified camera or None
+    imu_extrinsic (np.array): [3, 4] transform from imu frame to base_link or None
+    flow_extrinsic (np.array): [3, 4] transform from camera frame to base_link or None
+
+    Returns:
+    dict: sequence sorted by stamps
+    '''
+    if imu is not None:
+        order = np.argsort(imu[0], kind='stable')
+        imu = tuple(np.asarray(column)[order] for column in imu)
+    if ground_truth is not None:
+        order = np.argsort(ground_truth[0], kind='stable')
+        ground_truth = tuple(np.asarray(column, dtype=float)[order] for column in ground_truth)
+    flow = sorted(flow, key=lambda msg: msg['stamp'])
+    return {
+        'imu': imu,
+        'flow': flow,
+        'ground_truth': ground_truth,
+        'camera': camera,
+        'imu_extrinsic': None if imu_extrinsic is None else np.ascontiguousarray(imu_extrinsic),
+        'flow_extrinsic': None if flow_extrinsic is None else np.ascontiguousarray(flow_extrinsic),
+    }
+
+
+def load_sequence(path):
+    if os.path.isdir(path):
+        return load_rosbag(path)
+    return load_hdf5(path)
+
+
+def run_sequence(sequence, period=0.1, vel_std=1.0, rot_vel_std=1.0, history_size=20, update_mode='standard'):
+    '''
+    Step SpaceKF12 through a sequence with a fixed period, as the timer of `EKFNode` does
+
+    IMU samples with stamps up to the current step are preintegrated and fused by `update_acc`,
+    flow messages are fused at their own stamps by `update_at`.
+
+    Returns:
+    dict:
+        'stamp', 'position' [K, 3], 'rotation' [K, 4]: filter pose after every step,
+        'predict_time', 'imu_time', 'flow_time': seconds per call,
+        'steps', 'imu_updates', 'flow_updates': number of calls
+    '''
+    imu = sequence['imu']
+    flow = sequence['flow']
+    camera = sequence['camera']
+    stamps = np.array([msg['stamp'] for msg in flow])
+    if imu is not None:
+        stamps = np.concatenate([stamps, imu[0]])
+    if len(stamps) == 0:
+        raise ValueError('sequence has no measurements')
+    start, end = stamps.min(), stamps.max()
+
+    tracker = SpaceKF12(
+        dt=period, velocity_std=vel_std, rot_vel_std=rot_vel_std,
+        update_mode=update_mode, history_size=history_size,
+    )
+    tracker.P = tracker.P * 0.01
+    tracker.stamp = start
+    imu_buffer = ImuPreintegration()
+
+    n_steps = int(np.floor((end - start) / period))
+    est_stamps = np.zeros(n_steps)
+    est_positions = np.zeros([n_steps, 3])
+    est_rotations = np.zeros([n_steps, 4])
+    predict_time = imu_time = flow_time = 0.
+    imu_updates = flow_updates = 0
+    i_imu = 0
+    i_flow = 0
+    n_imu = 0 if imu is None else len(imu[0])
+    for step in range(n_steps):
+        stamp = start + (step + 1) * period
+
+        # Predict
+        t = time.perf_counter()
+        tracker.predict(stamp=stamp)
+        predict_time += time.perf_counter() - t
+
+        # Update by IMU
+        while i_imu < n_imu and imu[0][i_imu] <= stamp:
+            imu_buffer.add(imu[0][i_imu], imu[1][i_imu], imu[2][i_imu], imu[3][i_imu], imu[4][i_imu])
+            i_imu += 1
+        if imu_buffer.count > 0 and sequence['imu_extrinsic'] is not None:
+            t = time.perf_counter()
+            rot_vel, rot_vel_R, acc, acc_R = imu_buffer.integrate()
+            tracker.update_acc(acc, acc_R, extrinsic=sequence['imu_extrinsic'])
+            imu_time += time.perf_counter() - t
+            imu_updates += 1
+
+        # Update by flow
+        while i_flow < len(flow) and flow[i_flow]['stamp'] <= stamp:
+            msg = flow[i_flow]
+            i_flow += 1
+            if camera is None or sequence['flow_extrinsic'] is None:
+                continue
+            t = time.perf_counter()
+            tracker.update_at(
+                msg['stamp'],
+                'update_flow',
+                msg['z'],
+                msg['delta_t'],
+                msg['depth'],
+                msg['pixels'],
+                msg['R'],
+                camera.M1,
+                camera.M1_inv,
+                extrinsic=sequence['flow_extrinsic'],
+            )
+            flow_time += time.perf_counter() - t
+            flow_updates += 1
+
+        est_stamps[step] = stamp
+        est_positions[step] = tracker.pos
+        est_rotations[step] = tracker.q
+
+    return {
+        'stamp': est_stamps,
+        'position': est_positions,
+        'rotation': est_rotations,
+        'predict_time': predict_time / max(n_steps, 1),
+        'imu_time': imu_time / max(imu_updates, 1),
+        'flow_time': flow_time / max(flow_updates, 1),
+        'steps': n_steps,
+        'imu_updates': imu_updates,
+        'flow_updates': flow_updates,
+    }
+
+
+def align(src, dst):
+    '''
+    Rigid alignment (Kabsch/Umeyama without scale) of two point sets
+
+    Parameters:
+    src (np.array): [N, 3] points
+    dst (np.array): [N, 3] points
+
+    Returns:
+    rot (np.array): [3, 3] rotation
+    tr (np.array): [3] translation, such that `dst ~ src @ rot.T + tr`
+    '''
+    src_mean = src.mean(0)
+    dst_mean = dst.mean(0)
+    cov = (dst - dst_mean).T @ (src - src_mean)
+    U, _, Vt = np.linalg.svd(cov)
+    S = np.eye(3)
+    S[2, 2] = np.sign(np.linalg.det(U) * np.linalg.det(Vt))
+    rot = U @ S @ Vt
+    tr = dst_mean - rot @ src_mean
+    return rot, tr
+
+
+def interpolate_poses(stamps, positions, rotations, query):
+    '''
+    Linear interpolation of positions and slerp of rotations at `query` stamps.
+    `query` must be inside [stamps[0], stamps[-1]].
+    '''
+    position = np.stack([np.interp(query, stamps, positions[:, i]) for i in range(3)], 1)
+    rotation = Slerp(stamps, Rotation.from_quat(rotations))(query)
+    return position, rotation
+
+
+def evaluate(estimate, ground_truth, rpe_delta=1.0):
+    '''
+    Absolute trajectory error after rigid alignment and relative pose error over `rpe_delta` seconds
+
+    Parameters:
+    estimate (dict): output of `run_sequence`
+    ground_truth (tuple): stamps [M], positions [M, 3], quaternions [M, 4]
+
+    Returns:
+    dict: 'ate' (m, RMSE), 'rpe_trans' (m, RMSE), 'rpe_rot' (deg, RMSE)
+    '''
+    nan = {'ate': np.nan, 'rpe_trans': np.nan, 'rpe_rot': np.nan}
+    if ground_truth is None or len(estimate['stamp']) < 2:
+        return nan
+    gt_stamps, gt_positions, gt_rotations = ground_truth
+    mask = (gt_stamps >= estimate['stamp'][0]) & (gt_stamps <= estimate['stamp'][-1])
+    if mask.sum() < 3:
+        return nan
+    stamps = gt_stamps[mask]
+    gt_pos = gt_positions[mask]
+    gt_rot = Rotation.from_quat(gt_rotations[mask])
+    est_pos, est_rot = interpolate_poses(estimate['stamp'], estimate['position'], estimate['rotation'], stamps)
+
+    # ATE
+    rot, tr = align(est_pos, gt_pos)
+    est_pos = est_pos @ rot.T + tr
+    est_rot = Rotation.from_matrix(rot) * est_rot
+    ate = np.sqrt(np.mean(np.sum((est_pos - gt_pos)**2, 1)))
+
+    # RPE: compare relative motions between the stamps `rpe_delta` seconds apart
+    j = np.searchsorted(stamps, stamps + rpe_delta)
+    i = np.nonzero(j < len(stamps))[0]
+    j = j[i]
+    if len(i) == 0:
+        return {'ate': ate, 'rpe_trans': np.nan, 'rpe_rot': np.nan}
+    gt_delta_rot = gt_rot[i].inv() * gt_rot[j]
+    gt_delta_pos = gt_rot[i].inv().apply(gt_pos[j] - gt_pos[i])
+    est_delta_rot = est_rot[i].inv() * est_rot[j]
+    est_delta_pos = est_rot[i].inv().apply(est_pos[j] - est_pos[i])
+    rpe_trans = np.sqrt(np.mean(np.sum((est_delta_pos - gt_delta_pos)**2, 1)))
+    rpe_rot = np.sqrt(np.mean((gt_delta_rot.inv() * est_delta_rot).magnitude()**2))
+    return {'ate': ate, 'rpe_trans': rpe_trans, 'rpe_rot': np.degrees(rpe_rot)}
+
+
+def replay_file(path, period=0.1, vel_std=1.0, rot_vel_std=1.0, history_size=20,
+                update_mode='standard', rpe_delta=1.0):
+    '''
+    Load, run and evaluate a single sequence. Runs in a worker process.
+    '''
+    # Compiled kernels are loaded from the numba cache, so that the first step is not timed with the compilation
+    warmup(update_modes=[update_mode])
+    sequence = load_sequence(path)
+    start = time.perf_counter()
+    estimate = run_sequence(
+        sequence, period=period, vel_std=vel_std, rot_vel_std=rot_vel_std,
+        history_size=history_size, update_mode=update_mode,
+    )
+    run_time = time.perf_counter() - start
+    result = evaluate(estimate, sequence['ground_truth'], rpe_delta=rpe_delta)
+    result.update({
+        'path': path,
+        'duration': estimate['steps'] * period,
+        'run_time': run_time,
+        'predict_time': estimate['predict_time'],
+        'imu_time': estimate['imu_time'],
+        'flow_time': estimate['flow_time'],
+    })
+    return result
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Replay recorded sequences through SpaceKF12')
+    parser.add_argument('paths', nargs='+', help='HDF5 files or rosbag2 directories')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--period', type=float, default=0.1, help='filter period, s')
+    parser.add_argument('--vel-std', type=float, default=1.0)
+    parser.add_argument('--rot-vel-std', type=float, default=1.0)
+    parser.add_argument('--history-size', type=int, default=20)
+    parser.add_argument('--update-mode', default='standard', choices=UPDATE_MODES)
+    parser.add_argument('--rpe-delta', type=float, default=1.0, help='time delta of RPE, s')
+    args = parser.parse_args(args)
+
+    # Compile the kernels once, so that the workers only load them from the numba cache
+    warmup(update_modes=[args.update_mode])
+
+    kwargs = {
+        'period': args.period,
+        'vel_std': args.vel_std,
+        'rot_vel_std': args.rot_vel_std,
+        'history_size': args.history_size,
+        'update_mode': args.update_mode,
+        'rpe_delta': args.rpe_delta,
+    }
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(replay_file, path, **kwargs) for path in args.paths]
+        results = [future.result() for future in futures]
+
+    print(
+        f'{"sequence":40} {"ATE, m":>8} {"RPE, m":>8} {"RPE, deg":>9} {"speed":>8} '
+        f'{"predict, us":>12} {"imu, us":>9} {"flow, us":>9}'
+    )
+    for r in results:
+        speed = r['duration'] / r['run_time'] if r['run_time'] > 0 else np.inf
+        print(
+            f'{os.path.basename(r["path"].rstrip("/")):40} {r["ate"]:8.3f} {r["rpe_trans"]:8.3f} '
+            f'{r["rpe_rot"]:9.2f} {speed:7.0f}x {r["predict_time"] * 1e6:12.1f} '
+            f'{r["imu_time"] * 1e6:9.1f} {r["flow_time"] * 1e6:9.1f}'
+        )
+    print(
+        f'{"mean":40} {np.nanmean([r["ate"] for r in results]):8.3f} '
+        f'{np.nanmean([r["rpe_trans"] for r in results]):8.3f} '
+        f'{np.nanmean([r["rpe_rot"] for r in results]):9.2f}'
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+import numpy as np
+from numba import njit
+
+
+class FixedLagSmoother:
+    '''
+    Fixed-lag Rauch-Tung-Striebel smoother
+
+    Keeps a window of the last `lag + 1` filter steps. Slot `k` stores the prior
+    `x_pred`, `P_pred` of step k, the jacobian `F` of the transition into step k,
+    the filtered `x`, `P` of step k and optional `extra` data (e.g. the center quaternion
+    of a filter on a manifold). All arrays are allocated once, in the constructor.
+
+    The filter calls `filtered` with its state right before every predict step
+    (after all updates of the current step) and `push` right after it.
+    `smooth` runs the backward pass over the window and returns the state
+    `lag` steps behind the current one, so the cost of a step is O(lag * dim^3)
+    and does not depend on the run length. A filter which recomputes older steps
+    (e.g. after an out-of-sequence measurement) overwrites them with `store` and `filtered`,
+    addressing them by `slot`.
+
+    For filters on a manifold the filtered state must be stored in the same chart as the prior,
+    i.e. before the manifold reset.
+    '''
+
+    def __init__(self, dim, lag, extra_dim=0):
+        '''
+        dim (int): dimension of the state
+        lag (int): number of steps between the current and the smoothed state
+        extra_dim (int): size of the extra data stored with every step
+        '''
+        size = lag + 1
+        self.lag = lag
+        self.size = size
+        self.x = np.zeros([size, dim])
+        self.P = np.zeros([size, dim, dim])
+        self.x_pred = np.zeros([size, dim])
+        self.P_pred = np.zeros([size, dim, dim])
+        self.F = np.zeros([size, dim, dim])
+        self.extra = np.zeros([size, extra_dim])
+        self.stamps = np.zeros(size)
+        self.count = 0
+        self.newest = -1
+
+    def slot(self, age):
+        '''
+        Slot of the step `age` steps behind the newest one, None if it is not in the window
+        '''
+        if age >= self.count:
+            return None
+        return (self.newest - age) % self.size
+
+    def filtered(self, x, P, i=None):
+        '''
+        Store the filtered state of the i-th slot. Default: the newest step
+        '''
+        if self.count > 0:
+            i = self.newest if i is None else i
+            self.x[i] = x
+            self.P[i] = P
+
+    def push(self, stamp, x_pred, P_pred, F, extra=None):
+        '''
+        Start a new step with the prior `x_pred`, `P_pred` and the transition jacobian `F`
+        '''
+        self.newest = (self.newest + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        self.stamps[self.newest] = stamp
+        self.store(self.newest, x_pred, P_pred, F, extra)
+
+    def store(self, i, x_pred, P_pred, F, extra=None):
+        '''
+        Overwrite the prior and the transition jacobian of the i-th slot.
+        Its filtered state is reset to the prior
+        '''
+        self.x_pred[i] = x_pred
+        self.P_pred[i] = P_pred
+        self.F[i] = F
+        # Until an update arrives, the filtered state equals the prior
+        self.x[i] = x_pred
+        self.P[i] = P_pred
+        if extra is not None:
+            self.extra[i] = extra
+
+    def smooth(self, x=None, P=None):
+        '''
+        Backward pass over the window
+
+        x, P: current filtered state (stored into the newest step before smoothing)
+
+        Returns:
+        (stamp, x, P, extra) of the step `lag` steps behind the newest one,
+        or None until the window is full
+        '''
+        if x is not None:
+            self.filtered(x, P)
+        if self.count < self.size:
+            return None
+        oldest = (self.newest + 1) % self.size
+        x_s, P_s = rts_backward(self.x, self.P, self.x_pred, self.P_pred, self.F, self.newest, self.size)
+        return self.stamps[oldest], x_s, P_s, self.extra[oldest].copy()
+
+
+@njit(cache=True)
+def rts_backward(x, P, x_pred, P_pred, F, newest, size):
+    '''
+    RTS backward pass from the newest slot of a ring buffer to the oldest one:
+        C = P_k F_{k+1}^T P_pred_{k+1}^-1
+        x_s_k = x_k + C (x_s_{k+1} - x_pred_{k+1})
+        P_s_k = P_k + C (P_s_{k+1} - P_pred_{k+1}) C^T
+
+    Returns smoothed x, P of the oldest slot
+    '''
+    x_s = x[newest].copy()
+    P_s = P[newest].copy()
+    for age in range(1, size):
+        k = (newest - age) % size
+        k1 = (k + 1) % size
+        # C^T = P_pred^-1 F P_k, P_pred and P_k are symmetric
+        C = np.linalg.solve(P_pred[k1], F[k1] @ P[k]).T
+        x_s = x[k] + C @ (x_s - x_pred[k1])
+        P_s = P[k] + C @ (P_s - P_pred[k1]) @ C.T
+    return x_s, 0.5 * (P_s + P_s.T)
@@ -1,3 +1,4 @@
 from .filter import SpaceKF12
+from .batch import SpaceKF12Batch
 
 __version__ = '0.0.0'
\ No newline at end of file
@@ -0,0 +1,185 @@
+import numpy as np
+from numba import njit, prange
+
+from . import physics, geometry, measurent
+from .filter import SpaceKF12, GRAVITY, KALMAN_UPDATES, kalman_update_diag
+
+
+class SpaceKF12Batch:
+    '''
+    N independent 12-dimensional Extended Kalman Filters stepped together
+
+    Every filter has the same state layout as `SpaceKF12`, but the states are stored in
+    contiguous arrays so that predict and update run in one compiled call for the whole batch:
+    `x` has shape [N, 12], `P` has shape [N, 12, 12], `q` has shape [N, 4], `Q` has shape [N, 12, 12].
+
+    Useful for parameter sweeps (each filter may have its own `velocity_std` and `rot_vel_std`)
+    and for multi-hypothesis tracking (each filter may start from its own `x`, `P` and `q`).
+
+    All filters receive the same measurement `z`. Measurement priors and jacobians
+    are computed per filter.
+    `update_mode` is one of `KALMAN_UPDATES` keys, the square-root mode of `SpaceKF12` is not batched.
+    '''
+
+    ACCEL_STD = SpaceKF12.ACCEL_STD
+
+    def __init__(
+        self,
+        n,
+        dt,
+        velocity_std,
+        rot_vel_std,
+        update_mode='standard',
+    ):
+        self.n = n
+        self.x = np.zeros([n, 12])
+        self.P = np.repeat(np.eye(12)[None], n, 0)
+        velocity_var = np.broadcast_to(np.asarray(velocity_std, dtype=float)**2, [n])
+        rot_vel_var = np.broadcast_to(np.asarray(rot_vel_std, dtype=float)**2, [n])
+        self.Q = np.zeros([n, 12, 12])
+        for i in range(3, 6):
+            self.Q[:, i, i] = dt * velocity_var
+        for i in range(9, 12):
+            self.Q[:, i, i] = dt * rot_vel_var
+        self.q = np.zeros([n, 4])
+        self.q[:, 3] = 1
+        self.dt = dt
+        self.update_mode = update_mode
+        self._kalman_update = KALMAN_UPDATES[update_mode]
+
+    @classmethod
+    def from_filters(cls, filters):
+        '''
+        Stack several `SpaceKF12` filters into a batch. The filters must share `dt`.
+        '''
+        batch = cls(len(filters), filters[0].dt, 0, 0, update_mode=filters[0].update_mode)
+        for i, f in enumerate(filters):
+            batch.x[i] = f.x
+            batch.P[i] = f.P
+            batch.Q[i] = f.Q
+            batch.q[i] = f.q
+        return batch
+
+    def get_filter(self, i):
+        '''
+        Returns a standalone `SpaceKF12` holding a copy of the i-th filter of the batch.
+        '''
+        f = SpaceKF12(dt=self.dt, velocity_std=0, rot_vel_std=0, update_mode=self.update_mode)
+        f.x = self.x[i].copy()
+        f.P = self.P[i].copy()
+        f.Q = self.Q[i].copy()
+        f.q = self.q[i].copy()
+        return f
+
+    def predict(self, dt=None):
+        dt = dt or self.dt
+        _predict_batch(self.x, self.P, self.Q, self.q, dt, dt / self.dt)
+
+    def update_linear(self, H, z, R):
+        z = self._broadcast_measurement(z)
+        _update_linear_batch(self._kalman_update, self.x, self.P, np.ascontiguousarray(H), z, R)
+
+    def update_acc(self, z, R, gravity=None, extrinsic=None):
+        '''
+        Update states by a measurement coming from on-board accelerometer.
+        '''
+        R_new = R + np.eye(3) * self.ACCEL_STD**2
+        self.update_static_vec(z, R_new, vec=gravity or GRAVITY, extrinsic=extrinsic)
+
+    def update_rot_vel(self, z, R, extrinsic=None):
+        '''
+        Update states by a measurement coming from on-board gyroscope.
+        '''
+        z = self._broadcast_measurement(z)
+        _update_rot_vel_batch(self._kalman_update, self.x, self.P, z, R, extrinsic)
+
+    def update_static_vec(self, z, R, vec, extrinsic=None):
+        '''
+        Update states by a measurement of some vector which is known in the world coordinates.
+        '''
+        z = self._broadcast_measurement(z)
+        _update_static_vec_batch(self._kalman_update, self.x, self.P, self.q, z, R, np.asarray(vec, dtype=float), extrinsic)
+
+    def update_flow(self, flows, delta_t, depths, pixels, R, camera_matrix, camera_matrix_inv, extrinsic=None, delay=0):
+        '''
+        Update states by a visual odometry measurement coming from a neural network.
+
+        Parameters are the same as in `SpaceKF12.update_flow`.
+        '''
+        z = self._broadcast_measurement(flows.flatten())
+        noise_scale = (delta_t + delay) / self.dt
+        _update_flow_batch(
+            kalman_update_diag if R.ndim == 1 else self._kalman_update, self.x, self.P, self.Q, self.q, z, R, delta_t,
+            np.ascontiguousarray(depths, dtype=float),
+            np.ascontiguousarray(pixels, dtype=float),
+            camera_matrix, camera_matrix_inv, extrinsic, noise_scale,
+        )
+
+    def _broadcast_measurement(self, z):
+        z = np.asarray(z, dtype=float)
+        return np.ascontiguousarray(np.broadcast_to(z, [self.n, z.shape[-1]]))
+
+    @property
+    def pos(self):
+        return self.x[:, :3]
+
+    @property
+    def vel(self):
+        return self.x[:, 3:6]
+
+    @property
+    def rot_vel(self):
+        return self.x[:, 9:]
+
+
+@njit(parallel=True)
+def _predict_batch(x, P, Q, q, dt, q_scale):
+    for i in prange(x.shape[0]):
+        # Reset manifold before each predict
+        epsilon, q[i] = geometry.reset_manifold(x[i, 6:9], q[i])
+        x[i, 6:9] = epsilon
+        # Prediction step
+        F = physics.transition_jac(x[i, 9:], dt)
+        pos, vel, epsilon, rot_vel, q[i] = physics.transition_function(
+            x[i, :3], x[i, 3:6], x[i, 6:9], x[i, 9:], q[i], dt
+        )
+        x[i, :3] = pos
+        x[i, 3:6] = vel
+        x[i, 6:9] = epsilon
+        x[i, 9:] = rot_vel
+        P[i] = F @ (P[i] + Q[i] * q_scale) @ F.T
+
+
+@njit(parallel=True)
+def _update_linear_batch(kalman_update, x, P, H, z, R):
+    for i in prange(x.shape[0]):
+        y = z[i] - H @ x[i]
+        x[i], P[i], _ = kalman_update(x[i], P[i], H, R, y)
+
+
+@njit(parallel=True)
+def _update_rot_vel_batch(kalman_update, x, P, z, R, extrinsic):
+    for i in prange(x.shape[0]):
+        z_prior, H = measurent.rot_vel_local(x[i, 9:], extrinsic)
+        y = z[i] - z_prior
+        x[i], P[i], _ = kalman_update(x[i], P[i], H, R, y)
+
+
+@njit(parallel=True)
+def _update_static_vec_batch(kalman_update, x, P, q, z, R, vec, extrinsic):
+    for i in prange(x.shape[0]):
+        z_prior, H = measurent.static_vec(q[i], vec, extrinsic)
+        y = z[i] - z_prior
+        x[i], P[i], _ = kalman_update(x[i], P[i], H, R, y)
+
+
+@njit(parallel=True)
+def _update_flow_batch(
+    kalman_update, x, P, Q, q, z, R, delta_t, depths, pixels, camera_matrix, camera_matrix_inv, extrinsic, noise_scale,
+):
+    for i in prange(x.shape[0]):
+        z_prior, H = measurent.flow_odom12(
+            x[i, 3:6], x[i, 9:], q[i], delta_t, depths, pixels, camera_matrix, camera_matrix_inv, extrinsic
+        )
+        y = z[i] - z_prior
+        x[i], P[i], _ = kalman_update(x[i], P[i], H, R, y, Q[i] * noise_scale)
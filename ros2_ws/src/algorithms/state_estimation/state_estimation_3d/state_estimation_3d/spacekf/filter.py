@@ -1,3 +1,5 @@
+import functools
+
 import numpy as np
 import scipy
 from numba import njit
@@ -5,11 +7,35 @@ from scipy.spatial.transform import Rotation
 from filterpy.common import Q_discrete_white_noise
 
 from . import physics, geometry, measurent
+from .history import StateHistory
+from ..smoother import FixedLagSmoother
+from ..gating import ChiSquareGate
+from ..messages import covariance_index, fill_covariance
 
 
 GRAVITY = np.array([0, 0, 9.8])
 
 
+def _recorded(update):
+    '''
+    Decorator for update methods of `SpaceKF12`.
+    Remembers the update in the state history, so that it can be replayed
+    after an out-of-sequence measurement.
+    '''
+    @functools.wraps(update)
+    def wrapper(self, *args, **kwargs):
+        if self.history is None or not self._record_updates:
+            return update(self, *args, **kwargs)
+        self.history.record(update.__name__, args, kwargs)
+        # Do not record nested updates (e.g. update_acc -> update_static_vec)
+        self._record_updates = False
+        try:
+            return update(self, *args, **kwargs)
+        finally:
+            self._record_updates = True
+    return wrapper
+
+
 class SpaceKF12:
     '''
     12-dimensional Extended Kalman Filter
@@ -38,6 +64,24 @@ class SpaceKF12:
     `pos`, `vel`, `rot_vel`.
     You can get yaw, pitch, roll by using property `euler`.
     You can get rotation matrix by using property `rot_matrix`.
+
+    If `history_size > 0`, the filter keeps the last `history_size` predict steps
+    and the updates applied after them. A delayed measurement can then be fused
+    at its true timestamp with `update_at`. `stamp` is the time of the current state.
+
+    If `smoother_lag > 0`, the filter also runs a fixed-lag RTS smoother over the last
+    `smoother_lag` predict steps, see `smooth`. The steps replayed by `update_at`
+    are rewritten in the smoother window as well.
+
+    If `gate_probability > 0`, every update is gated by the squared Mahalanobis distance
+    of its innovation, see `ChiSquareGate`. Rejected measurements leave the state unchanged.
+    The flow update also gates each point separately and fuses only the consistent ones.
+    The numbers of accepted and rejected measurements are counted in `gate`.
+
+    With `update_mode='sqrt'` the filter is a square-root filter: it carries a factor `P_sqrt`
+    of the covariance (P = P_sqrt P_sqrt^T) through predict and every update, see `kalman_update_sqrt`,
+    and `P` is computed from it. Assigning `P` factors it again. An update costs about twice
+    as much as in the standard form, see benchmark/kalman_update.py.
     '''
 
     ACCEL_STD = 5.0
@@ -47,7 +91,29 @@ class SpaceKF12:
         dt,
         velocity_std,
         rot_vel_std,
+        update_mode='standard',
+        parallel_flow=False,
+        history_size=0,
+        smoother_lag=0,
+        gate_probability=0.,
     ):
+        '''
+        update_mode (str): covariance update used by every measurement update.
+            One of `UPDATE_MODES`: 'standard', 'joseph' (see `KALMAN_UPDATES`) or 'sqrt'.
+        parallel_flow (bool): compute the flow measurement model with a prange over points.
+            Pays off only for thousands of points.
+        history_size (int): number of predict steps kept for out-of-sequence measurements.
+            0 disables the history.
+        smoother_lag (int): number of predict steps between the current and the smoothed state.
+            0 disables the smoother.
+        gate_probability (float): probability of accepting a measurement which fits the model.
+            0 disables gating.
+        '''
+        if update_mode not in UPDATE_MODES:
+            raise ValueError(f'update_mode must be one of {UPDATE_MODES}, got {update_mode!r}')
+        self.update_mode = update_mode
+        self._kalman_update = KALMAN_UPDATES.get(update_mode)
+        self.P_sqrt = None
         self.x = np.zeros(12)
         self.P = np.eye(12)
         # Idk why there are minuses , but it works:
@@ -68,22 +134,173 @@ class SpaceKF12:
         self.Q[11, 11] = dt * rot_vel_std**2
         self.q = np.array([0., 0, 0, 1])
         self.dt = dt
+        self._flow_odom12 = measurent.flow_odom12_parallel if parallel_flow else measurent.flow_odom12
+        self.stamp = 0.
+        self.history = StateHistory(history_size) if history_size > 0 else None
+        self._record_updates = True
+        self._replaying = False
+        self.smoother = FixedLagSmoother(12, smoother_lag, extra_dim=4) if smoother_lag > 0 else None
+        self.gate = ChiSquareGate(gate_probability)
 
-    def predict(self, dt=None):
+    def predict(self, dt=None, stamp=None):
+        '''
+        Prediction step.
+
+        dt (float): time step. Default: `self.dt`
+        stamp (float): time of the predicted state. Default: `self.stamp + dt`
+        '''
+        dt = dt or self.dt
+        if self.smoother is not None:
+            # Filtered state of the finished step, in the chart of its prior
+            self.smoother.filtered(self.x, self.P)
+        F = self._predict(dt)
+        self.stamp = self.stamp + dt if stamp is None else stamp
+        if self.history is not None:
+            self.history.push(self.x, self.P, self.q, self.stamp, dt)
+        if self.smoother is not None:
+            self.smoother.push(self.stamp, self.x, self.P, F, self.q)
+
+    def _predict(self, dt):
         # Reset manifold before each predict
         self.reset_manifold()
         # Prediction step
-        dt = dt or self.dt
         F = physics.transition_jac(self.rot_vel, dt)
         self.pos, self.vel, self._epsilon, self.rot_vel, self.q = physics.transition_function(
             self.pos, self.vel, self._epsilon, self.rot_vel, self.q, dt
         )
-        self.P = F @ (self.P + self.Q) @ F.T
+        # Q is the process noise of one nominal period `self.dt`
+        if self.P_sqrt is None:
+            self.P = F @ (self.P + self.Q * (dt / self.dt)) @ F.T
+        else:
+            self._set_factor(sqrt_predict(F, self.P_sqrt, psd_factor(self.Q * (dt / self.dt))))
+        return F
+
+    @property
+    def P(self):
+        return self._P
+
+    @P.setter
+    def P(self, value):
+        self._P = value
+        if self.update_mode == 'sqrt':
+            try:
+                self.P_sqrt = np.linalg.cholesky(value)
+            except np.linalg.LinAlgError:
+                # Semi-definite or slightly indefinite from rounding
+                self.P_sqrt = psd_factor(value)
+
+    def _set_factor(self, P_sqrt):
+        self.P_sqrt = P_sqrt
+        self._P = P_sqrt @ P_sqrt.T
+
+    def smooth(self):
+        '''
+        Fixed-lag smoothed state `smoother_lag` predict steps behind the current one
 
+        Returns:
+        (stamp, x, P, q) or None if the smoother is disabled or has not collected enough steps.
+        Epsilon of the returned `x` is zero and `q` is the smoothed attitude.
+        '''
+        if self.smoother is None:
+            return None
+        result = self.smoother.smooth(self.x, self.P)
+        if result is None:
+            return None
+        stamp, x, P, q = result
+        x[6:9], q = geometry.reset_manifold(x[6:9], q)
+        return stamp, x, P, q
+
+    def update_at(self, stamp, update, *args, **kwargs):
+        '''
+        Apply a measurement taken at `stamp`, which may be older than the current state.
+
+        The filter is rolled back to the stored predict step nearest to `stamp`,
+        the measurement is applied there and the later predicts and updates are replayed.
+        If the history is disabled or `stamp` is older than the history,
+        the measurement is fused as if it was current.
+
+        Parameters
+        ----------
+            stamp (float): time when the measurement was taken
+            update (str): name of the update method, e.g. 'update_flow'
+            args, kwargs: arguments of the update method
+        '''
+        i = None
+        if self.history is not None and stamp < self.stamp:
+            i = self.history.find(stamp)
+        if i is None:
+            getattr(self, update)(*args, **kwargs)
+            return
+        self.history.updates[i].append((update, args, kwargs))
+        self._replay(i, counted=len(self.history.updates[i]) - 1)
+
+    def _replay(self, i, counted=None):
+        '''
+        Restore the state of the i-th history slot and replay everything after it
+
+        counted (int or None): index of the new update in the updates of the i-th slot.
+            Only its gate result is counted, the other updates were counted when they arrived
+        '''
+        history = self.history
+        smoother = self.smoother
+        self._record_updates = False
+        self._replaying = True
+        try:
+            self.x = history.x[i].copy()
+            self.P = history.P[i].copy()
+            self.q = history.q[i].copy()
+            self._apply_updates(history.updates[i], counted)
+            # Smoother slot of the replayed step, None if it is older than the smoother window
+            k = smoother.slot((history.newest - i) % history.size) if smoother is not None else None
+            for j in history.following(i):
+                if k is not None:
+                    smoother.filtered(self.x, self.P, k)
+                F = self._predict(history.dts[j])
+                history.store(j, self.x, self.P, self.q)
+                k = smoother.slot((history.newest - j) % history.size) if smoother is not None else None
+                if k is not None:
+                    smoother.store(k, self.x, self.P, F, self.q)
+                self._apply_updates(history.updates[j])
+            if k is not None:
+                smoother.filtered(self.x, self.P, k)
+        finally:
+            self._record_updates = True
+            self._replaying = False
+
+    def _apply_updates(self, updates, counted=None):
+        for k, (update, args, kwargs) in enumerate(updates):
+            self._replaying = k != counted
+            getattr(self, update)(*args, **kwargs)
+        self._replaying = True
+
+    def _gated_update(self, name, kalman_update, H, R, y, noise=None):
+        '''
+        Apply `kalman_update` if the innovation passes the gate and count the result as `name`
+
+        In the 'sqrt' mode every update is applied to the factor of P by `kalman_update_sqrt` instead,
+        or by `kalman_update_sqrt_diag` if R is given as its diagonal
+        '''
+        gate = self.gate.threshold(y.shape[0])
+        if self.P_sqrt is None:
+            self.x, self.P, d2 = kalman_update(self.x, self.P, H, R, y, noise, gate)
+        else:
+            noise_sqrt = None if noise is None else psd_factor(noise)
+            if R.ndim == 1:
+                self.x, P_sqrt, d2 = kalman_update_sqrt_diag(self.x, self.P_sqrt, H, R, y, noise_sqrt, gate)
+            else:
+                self.x, P_sqrt, d2 = kalman_update_sqrt(self.x, self.P_sqrt, H, psd_factor(R), y, noise_sqrt, gate)
+            if d2 <= gate:
+                self._set_factor(P_sqrt)
+        # Replayed updates were counted when they arrived, see `_replay`
+        if self.gate.enabled and not self._replaying:
+            self.gate.record(name, d2 <= gate)
+
+    @_recorded
     def update_linear(self, H, z, R):
         y = z - H @ self.x
-        self.x, self.P = kalman_update(self.x, self.P, H, R, y)
+        self._gated_update('update_linear', self._kalman_update, H, R, y)
 
+    @_recorded
     def update_acc(self, z, R, gravity=None, extrinsic=None):
         '''
         Update state by a measurement coming from on-board accelerometer.
@@ -91,14 +308,16 @@ class SpaceKF12:
         R_new = R + np.eye(3) * self.ACCEL_STD**2
         self.update_static_vec(z, R_new, vec=gravity or GRAVITY, extrinsic=extrinsic)
 
+    @_recorded
     def update_rot_vel(self, z, R, extrinsic=None):
         '''
         Update state by a measurement coming from on-board gyroscope.
         '''
         z_prior, H = measurent.rot_vel_local(self.rot_vel, extrinsic=extrinsic)
         y = z - z_prior
-        self.x, self.P = kalman_update(self.x, self.P, H, R, y)
+        self._gated_update('update_rot_vel', self._kalman_update, H, R, y)
 
+    @_recorded
     def update_static_vec(self, z, R, vec, extrinsic=None):
         '''
         Update state by a measurement of some vector which is known in the world coordinates.
@@ -106,8 +325,9 @@ class SpaceKF12:
         '''
         z_prior, H = measurent.static_vec(self.q, vec, extrinsic=extrinsic)
         y = z - z_prior
-        self.x, self.P = kalman_update(self.x, self.P, H, R, y)
+        self._gated_update('update_static_vec', self._kalman_update, H, R, y)
 
+    @_recorded
     def update_flow(self, flows, delta_t, depths, pixels, R, camera_matrix, camera_matrix_inv, extrinsic=None, delay=0):
         '''
         Update state by a visual odometry measurement coming from a neural network.
@@ -118,16 +338,46 @@ class SpaceKF12:
             delta_t (float): time step
             depths (np.array of shape [N]): Depth at N given points
             pixels (np.array of shape [N, 2]): x and y coordinates of image points, in pixel scale
-            R (np.array of shape [3, 3]): error of measurements
+            R (np.array of shape [3N, 3N] or [3N]): error of measurements. If R is given as a diagonal
+                of shape [3N], the information-form update is used, which is linear in N
+                (`kalman_update_sqrt_diag` in the 'sqrt' mode)
             camera_matrix (np.array of shape [3, 3]): camera intrinsic matrix
             extrinsic (None or np.array of shape [3, 4]): optional. Camera pose relative to filter
             delay (float): seconds passed between measurement being taken and it being processed
         '''
         z = flows.flatten()
-        z_prior, H = measurent.flow_odom12(self.vel, self.rot_vel, self.q, delta_t, depths, pixels, camera_matrix, camera_matrix_inv, extrinsic)
+        # Same dtypes for every caller, so that a single compiled signature is used
+        depths = np.ascontiguousarray(depths, dtype=float)
+        pixels = np.ascontiguousarray(pixels, dtype=float)
+        z_prior, H = self._flow_odom12(self.vel, self.rot_vel, self.q, float(delta_t), depths, pixels, camera_matrix, camera_matrix_inv, extrinsic)
         y = z - z_prior
         noise = self.Q / self.dt * (delta_t + delay)
-        self.x, self.P = kalman_update(self.x, self.P, H, R, y, noise)
+        if self.gate.enabled:
+            H, R, y = self._gate_flow_points(H, R, y, noise)
+            if y.shape[0] == 0:
+                return
+        if R.ndim == 1:
+            self._gated_update('update_flow', kalman_update_diag, H, R, y, noise)
+        else:
+            self._gated_update('update_flow', self._kalman_update, H, R, y, noise)
+
+    def _gate_flow_points(self, H, R, y, noise):
+        '''
+        Drop the rows of the flow points whose own innovations do not pass the 3-dof gate
+        '''
+        N = y.shape[0] // 3
+        if R.ndim == 1:
+            R_blocks = R.reshape(N, 3)[:, :, None] * np.eye(3)
+        else:
+            R_blocks = np.array([R[3 * i:3 * i + 3, 3 * i:3 * i + 3] for i in range(N)])
+        accepted = point_distances(H, self.P, R_blocks, y, noise) <= self.gate.threshold(3)
+        if not self._replaying:
+            self.gate.count('update_flow_points', int(accepted.sum()), int(N - accepted.sum()))
+        if accepted.all():
+            return H, R, y
+        rows = np.repeat(accepted, 3)
+        R = R[rows] if R.ndim == 1 else R[rows][:, rows]
+        return H[rows], R, y[rows]
 
     def reset_manifold(self):
         '''
@@ -173,34 +423,244 @@ class SpaceKF12:
     def rot_matrix(self):
         return geometry.quat_as_matrix(self.q)
 
-    def get_pose_covariance(self):
+    def get_pose_covariance(self, out=None):
         '''
         Returns 6x6 covariance matrix of pose in the form a list with length 36:
         (x, y, z, rotation about X axis, rotation about Y axis, rotation about Z axis)
+        If `out` is given (e.g. `msg.pose.covariance`), it is filled in place and returned instead.
         '''
-        indeces = [0, 1, 2, 6, 7, 8]
-        mat = self.P[indeces][:, indeces]
-        return list(mat.flatten())
+        if out is None:
+            return list(self.P.take(POSE_COVARIANCE_INDEX))
+        return fill_covariance(out, self.P, POSE_COVARIANCE_INDEX)
 
-    def get_twist_covariance(self):
+    def get_twist_covariance(self, out=None):
         '''
         Returns 6x6 covariance matrix of velocity in the form a list with length 36:
         (x, y, z, rotation about X axis, rotation about Y axis, rotation about Z axis)
+        If `out` is given (e.g. `msg.twist.covariance`), it is filled in place and returned instead.
         '''
-        indeces = [3, 4, 5, 9, 10, 11]
-        mat = self.P[indeces][:, indeces]
-        return list(mat.flatten())
+        if out is None:
+            return list(self.P.take(TWIST_COVARIANCE_INDEX))
+        return fill_covariance(out, self.P, TWIST_COVARIANCE_INDEX)
+
+
+POSE_COVARIANCE_INDEX = covariance_index([0, 1, 2, 6, 7, 8], 12)
+TWIST_COVARIANCE_INDEX = covariance_index([3, 4, 5, 9, 10, 11], 12)
 
 
-@njit
-def kalman_update(x, P, H, R, y, noise=None):
+@njit(cache=True)
+def kalman_update(x, P, H, R, y, noise=None, gate=np.inf):
+    '''
+    Kalman update in the standard form: P = (I - K H) P
+
+    All update kernels return the new x, P and the squared Mahalanobis distance
+    d^2 = y^T S^-1 y of the innovation. If d^2 > `gate`, the measurement is rejected
+    and x, P are returned unchanged.
+    '''
     if noise is None:
         S = H @ P @ H.T + R
     else:
         S = H @ (P + noise) @ H.T + R
-    K = P @ H.T @ np.linalg.inv(S)
+    S_inv = np.linalg.inv(S)
+    d2 = y @ S_inv @ y
+    if d2 > gate:
+        return x, P, d2
+    K = P @ H.T @ S_inv
     # This must be faster but it is slower:
     # K = np.linalg.solve(S.T, H @ P.T).T
     new_x = x + K @ y
     new_P = (np.eye(x.shape[0]) - K @ H) @ P
-    return new_x, new_P
+    return new_x, new_P, d2
+
+
+@njit(cache=True)
+def kalman_update_joseph(x, P, H, R, y, noise=None, gate=np.inf):
+    '''
+    Kalman update with the Joseph form of the covariance update:
+    P = (I - K H) P (I - K H)^T + K R K^T
+
+    Keeps P symmetric and positive semi-definite on long runs.
+    `noise` is treated as an additional measurement noise H noise H^T,
+    which gives the same S as in `kalman_update`.
+    S is solved by an LU decomposition, which, unlike a Cholesky one,
+    does not fail on an S that is not positive definite due to rounding.
+    '''
+    if noise is not None:
+        R = R + H @ noise @ H.T
+    S = H @ P @ H.T + R
+    m = y.shape[0]
+    # K^T = S^-1 H P and S^-1 y in one solve
+    rhs = np.empty((m, x.shape[0] + 1))
+    rhs[:, :-1] = H @ P
+    rhs[:, -1] = y
+    solved = np.linalg.solve(S, rhs)
+    d2 = y @ solved[:, -1]
+    if d2 > gate:
+        return x, P, d2
+    K = np.ascontiguousarray(solved[:, :-1].T)
+    new_x = x + K @ y
+    I_KH = np.eye(x.shape[0]) - K @ H
+    new_P = I_KH @ P @ I_KH.T + K @ R @ K.T
+    new_P = 0.5 * (new_P + new_P.T)
+    return new_x, new_P, d2
+
+
+@njit(cache=True)
+def kalman_update_sqrt(x, L, H, R_sqrt, y, noise_sqrt=None, gate=np.inf):
+    '''
+    Kalman update of a square-root filter, which carries a factor L of P = L L^T instead of P.
+
+    The pre-array [[R^1/2, H N^1/2, H L], [0, 0, L]] is triangularized with a QR decomposition
+    into the lower triangular post-array [[S^1/2, 0], [K S^1/2, L+]]. The updated covariance L+ L+^T
+    is symmetric and positive semi-definite by construction, and the factor needs about half
+    the number of digits of P, so it does not drift where the standard form does.
+    `noise_sqrt` N^1/2 is a factor of the noise added to P in S, it is treated as an additional
+    measurement noise, same as in `kalman_update_joseph`.
+
+    Returns the new x, the new lower triangular factor L+ and d^2 (see `kalman_update`).
+    '''
+    n = x.shape[0]
+    m = y.shape[0]
+    k = 0 if noise_sqrt is None else noise_sqrt.shape[1]
+    pre = np.zeros((m + n, m + k + n))
+    pre[:m, :m] = R_sqrt
+    if noise_sqrt is not None:
+        pre[:m, m:m + k] = H @ noise_sqrt
+    pre[:m, m + k:] = H @ L
+    pre[m:, m + k:] = L
+    # pre = post @ Q^T, where post = r^T is lower triangular
+    post = np.ascontiguousarray(np.linalg.qr(np.ascontiguousarray(pre.T))[1].T)
+    S_sqrt = np.ascontiguousarray(post[:m, :m])
+    w = solve_lower(S_sqrt, y)
+    d2 = w @ w
+    if d2 > gate:
+        return x, L, d2
+    # K y = (K S^1/2) S^-1/2 y
+    new_x = x + np.ascontiguousarray(post[m:, :m]) @ w
+    return new_x, np.ascontiguousarray(post[m:, m:]), d2
+
+
+@njit(cache=True)
+def kalman_update_sqrt_diag(x, L, H, R_diag, y, noise_sqrt=None, gate=np.inf):
+    '''
+    `kalman_update_sqrt` for a measurement with diagonal noise R = diag(R_diag), linear in the number of rows m.
+
+    The whitened measurement R^-1/2 H = Q T (reduced QR, T is n x n) is compressed to the n rows
+    Q^T R^-1/2 y with the jacobian T and the noise I + T N T^T. The rest of the whitened innovation
+    is orthogonal to the columns of H, it does not change the state and only adds its squared norm to d^2.
+    The cost is O(m n^2), as in `kalman_update_diag`.
+    '''
+    n = x.shape[0]
+    m = y.shape[0]
+    R_sqrt = np.sqrt(R_diag)
+    H_white = H / R_sqrt.reshape(-1, 1)
+    y_white = y / R_sqrt
+    if m <= n:
+        return kalman_update_sqrt(x, L, H_white, np.eye(m), y_white, noise_sqrt, gate)
+    Q, T = np.linalg.qr(H_white)
+    z = np.ascontiguousarray(Q.T) @ y_white
+    residual = y_white @ y_white - z @ z
+    new_x, new_L, d2 = kalman_update_sqrt(x, L, T, np.eye(n), z, noise_sqrt, gate - residual)
+    return new_x, new_L, d2 + residual
+
+
+@njit(cache=True)
+def sqrt_predict(F, L, Q_sqrt):
+    '''
+    Lower triangular factor of the predicted covariance F (P + Q) F^T of a square-root filter,
+    P = L L^T, Q = Q_sqrt Q_sqrt^T: the post-array of the triangularized [F L, F Q_sqrt]
+    '''
+    pre = np.concatenate((F @ L, F @ Q_sqrt), axis=1)
+    return np.ascontiguousarray(np.linalg.qr(np.ascontiguousarray(pre.T))[1].T)
+
+
+@njit(cache=True)
+def kalman_update_diag(x, P, H, R_diag, y, noise=None, gate=np.inf):
+    '''
+    Kalman update for a measurement with diagonal noise R = diag(R_diag), in information form.
+
+    Only H^T R^-1 H and H^T R^-1 y depend on the number of measurement rows m,
+    so the cost is O(m n^2) instead of the O(m^3) inversion of the m x m matrix S.
+    Gives the same result as `kalman_update`, including the `noise` term:
+    with P' = P + noise and A = H^T R^-1 H, the gain is K = P (I + A P')^-1 H^T R^-1.
+    The Mahalanobis distance follows from the Woodbury identity:
+    y^T S^-1 y = y^T R^-1 y - b^T P' (I + A P')^-1 b, where b = H^T R^-1 y.
+    '''
+    n = x.shape[0]
+    R_inv = 1 / R_diag
+    HtR_inv = H.T * R_inv
+    A = HtR_inv @ H
+    b = HtR_inv @ y
+    if noise is None:
+        P_noise = P
+    else:
+        P_noise = P + noise
+    M = np.eye(n) + A @ P_noise
+    M_inv_b = np.linalg.solve(M, b)
+    d2 = y @ (R_inv * y) - b @ (P_noise @ M_inv_b)
+    if d2 > gate:
+        return x, P, d2
+    new_x = x + P @ M_inv_b
+    new_P = P - P @ np.linalg.solve(M, A @ P)
+    new_P = 0.5 * (new_P + new_P.T)
+    return new_x, new_P, d2
+
+
+@njit(cache=True)
+def point_distances(H, P, R_blocks, y, noise=None):
+    '''
+    Squared Mahalanobis distances of the innovations of N points with `d` rows each:
+    d^2_i = y_i^T S_i^-1 y_i, S_i = H_i P' H_i^T + R_i. Cross-covariances of the points are ignored.
+
+    H: [N * d, n], R_blocks: [N, d, d], y: [N * d]
+    Returns [N] distances. The cost is O(N d n^2).
+    '''
+    if noise is not None:
+        P = P + noise
+    N, d, _ = R_blocks.shape
+    distances = np.empty(N)
+    for i in range(N):
+        H_i = H[i * d:(i + 1) * d]
+        y_i = y[i * d:(i + 1) * d]
+        S_i = H_i @ P @ H_i.T + R_blocks[i]
+        distances[i] = y_i @ np.linalg.solve(S_i, y_i)
+    return distances
+
+
+@njit(cache=True)
+def psd_factor(A):
+    '''
+    Factor L with L L^T = A for a symmetric positive semi-definite A.
+    L = V diag(sqrt(max(w, 0))) from the eigen-decomposition A = V diag(w) V^T, it is not triangular.
+    Negative eigenvalues (rounding errors of an indefinite P) are clipped to 0.
+    A diagonal A (the usual R) is factored without the decomposition
+    '''
+    n = A.shape[0]
+    diagonal = True
+    for i in range(n):
+        for j in range(n):
+            if i != j and A[i, j] != 0:
+                diagonal = False
+    if diagonal:
+        return np.diag(np.sqrt(np.maximum(np.diag(A), 0.)))
+    w, V = np.linalg.eigh(0.5 * (A + A.T))
+    return V * np.sqrt(np.maximum(w, 0.))
+
+
+@njit(cache=True)
+def solve_lower(L, B):
+    '''
+    Solves L X = B for lower triangular L by forward substitution
+    '''
+    X = np.empty_like(B)
+    for i in range(L.shape[0]):
+        X[i] = (B[i] - L[i, :i] @ X[:i]) / L[i, i]
+    return X
+
+
+KALMAN_UPDATES = {
+    'standard': kalman_update,
+    'joseph': kalman_update_joseph,
+}
+# Modes of SpaceKF12: the covariance updates and the square-root filter, which carries a factor of P
+UPDATE_MODES = list(KALMAN_UPDATES) + ['sqrt']
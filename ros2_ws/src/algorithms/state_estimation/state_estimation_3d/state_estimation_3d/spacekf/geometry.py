@@ -2,21 +2,21 @@ import numpy as np
 from numba import njit
 
 
-@njit
+@njit(cache=True)
 def quat_product(q1, q2):
     res = np.empty(4)
     res[:3] = q1[3] * q2[:3] + q2[3] * q1[:3] + np.cross(q1[:3], q2[:3])
     res[3] = q1[3] * q2[3] - np.dot(q1[:3], q2[:3])
     return res
 
-@njit
+@njit(cache=True)
 def quat_inv(q):
     q_inv = np.empty_like(q)
     q_inv[:3] = -q[:3]
     q_inv[3] = q[3]
     return q_inv
 
-@njit
+@njit(cache=True)
 def quat_as_matrix(q):
     '''
     Transforms a quaternion to a rotation matrix
@@ -33,7 +33,7 @@ def quat_as_matrix(q):
     mat[2, 2] = 1 - 2 * q[0]*q[0] - 2 * q[1] * q[1]
     return mat
 
-@njit
+@njit(cache=True)
 def rotate_vector(p, q):
     p_quat = np.empty(4)
     p_quat[:3] = p
@@ -43,7 +43,7 @@ def rotate_vector(p, q):
     res2 = quat_product(res1, q_inv)
     return res2[:3]
 
-@njit
+@njit(cache=True)
 def vector_to_pseudo_matrix(vec):
     mat = np.empty(shape=(3,3))
     mat[0, 0] = 0
@@ -57,7 +57,7 @@ def vector_to_pseudo_matrix(vec):
     mat[2, 2] = 0
     return mat
 
-@njit
+@njit(cache=True)
 def chart(q, q0=None):
     '''
     Chart function phi.
@@ -75,7 +75,7 @@ def chart(q, q0=None):
     # epsilon = delta[:3] * (4 / (1 + delta[3] + 1e-12))
     return epsilon
 
-@njit
+@njit(cache=True)
 def chart_inv(epsilon, q0=None):
     '''
     Inverse of the phi function.
@@ -96,7 +96,7 @@ def chart_inv(epsilon, q0=None):
         q = delta
     return q
 
-@njit
+@njit(cache=True)
 def reset_manifold(epsilon, q_center):
     # Rotate the center
     next_center = chart_inv(epsilon, q_center)
@@ -104,7 +104,7 @@ def reset_manifold(epsilon, q_center):
     next_epsilon = np.zeros_like(epsilon)
     return next_epsilon, next_center
 
-@njit
+@njit(cache=True)
 def rot_vel_to_q(rot_vel, delta_t):
     '''
     input:
@@ -120,3 +120,19 @@ def rot_vel_to_q(rot_vel, delta_t):
     rot_q[:3] = w_unit * np.sin(rot_angle_05)
     rot_q[3] = np.cos(rot_angle_05)
     return rot_q
+
+@njit(cache=True)
+def q_to_rot_vel(q, delta_t):
+    '''
+    Inverse of `rot_vel_to_q`
+    input:
+        q (np.array of shape (4)): quaternion of the rotation
+        delta_t (float): time step
+    output:
+        rotational velocity
+    '''
+    if q[3] < 0:
+        q = -q
+    sin_length = np.sqrt((q[:3]**2).sum())
+    rot_angle = 2 * np.arctan2(sin_length, q[3])
+    return q[:3] / (sin_length + 1e-12) * (rot_angle / delta_t)
@@ -0,0 +1,88 @@
+import numpy as np
+
+
+class StateHistory:
+    '''
+    Fixed-size ring buffer of filter snapshots, used to fuse out-of-sequence measurements
+
+    Slot `i` stores the filter state right after the predict step at `stamps[i]`
+    (`x`, `P`, `q`), the time step `dts[i]` of that predict and the list of updates
+    applied after it, as tuples (method name, args, kwargs).
+    All arrays are allocated once, in the constructor.
+    '''
+
+    def __init__(self, size, dim=12):
+        self.size = size
+        self.x = np.zeros([size, dim])
+        self.P = np.zeros([size, dim, dim])
+        self.q = np.zeros([size, 4])
+        self.stamps = np.zeros(size)
+        self.dts = np.zeros(size)
+        self.updates = [[] for _ in range(size)]
+        self.count = 0
+        self.newest = -1
+
+    def push(self, x, P, q, stamp, dt):
+        '''
+        Store a new snapshot, overwriting the oldest one if the buffer is full
+        '''
+        self.newest = (self.newest + 1) % self.size
+        self.count = min(self.count + 1, self.size)
+        self.store(self.newest, x, P, q)
+        self.stamps[self.newest] = stamp
+        self.dts[self.newest] = dt
+        self.updates[self.newest].clear()
+
+    def store(self, i, x, P, q):
+        '''
+        Overwrite the state of the i-th slot
+        '''
+        self.x[i] = x
+        self.P[i] = P
+        self.q[i] = q
+
+    def record(self, update, args, kwargs):
+        '''
+        Remember an update applied after the newest snapshot
+        '''
+        if self.count > 0:
+            self.updates[self.newest].append((update, args, kwargs))
+
+    def find(self, stamp):
+        '''
+        Returns the index of the slot nearest to `stamp`
+        or None if `stamp` is older than the whole buffer.
+
+        The slot is guessed from the age of the measurement and the period of the newest step,
+        so the lookup takes constant time when the filter is stepped with a fixed period.
+        '''
+        if self.count == 0:
+            return None
+        oldest = (self.newest - self.count + 1) % self.size
+        if stamp < self.stamps[oldest] - 0.5 * self.dts[oldest]:
+            return None
+
+        period = self.dts[self.newest]
+        if period > 0:
+            age = int(round((self.stamps[self.newest] - stamp) / period))
+        else:
+            age = 0
+        age = min(max(age, 0), self.count - 1)
+
+        # Correct the guess if steps were not equal
+        while age < self.count - 1 and self._distance(stamp, age + 1) < self._distance(stamp, age):
+            age += 1
+        while age > 0 and self._distance(stamp, age - 1) < self._distance(stamp, age):
+            age -= 1
+        return (self.newest - age) % self.size
+
+    def following(self, i):
+        '''
+        Yields the indices of the slots newer than the i-th one, from old to new
+        '''
+        while i != self.newest:
+            i = (i + 1) % self.size
+            yield i
+
+    def _distance(self, stamp, age):
+        return abs(self.stamps[(self.newest - age) % self.size] - stamp)
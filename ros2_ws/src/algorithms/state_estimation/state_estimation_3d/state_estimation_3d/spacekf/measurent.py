@@ -1,10 +1,10 @@
 import numpy as np
-from numba import njit
+from numba import njit, prange
 
 from . import geometry, physics
 
 
-@njit
+@njit(cache=True)
 def rot_vel_local(rot_vel, extrinsic=None):
     # Get rot_vel
     z_prior = rot_vel
@@ -24,7 +24,7 @@ def rot_vel_local(rot_vel, extrinsic=None):
         H[:, 9:] = rot_extrinsic
     return z_prior, H
 
-@njit
+@njit(cache=True)
 def static_vec(q_center, vec, extrinsic=None):
     # Rotate the vector backwards
     q_inv = geometry.quat_inv(q_center)
@@ -44,8 +44,111 @@ def static_vec(q_center, vec, extrinsic=None):
         H[:, 6:9] = vec_cross @ rot_extrinsic
     return z_prior, H
 
-@njit
-def flow_odom12(vel, rot_vel, q_center, delta_t, depths, pixels, camera_matrix, camera_matrix_inv, extrinsic=None):
+def _flow_odom12_points(vel, rot_vel, q_center, delta_t, depths, pixels, camera_matrix, camera_matrix_inv, extrinsic=None):
+    '''
+    Flow measurement at N points: z_prior of shape [3N] and H of shape [3N, 12].
+
+    The parts which do not depend on the point (rotation matrices, local velocity,
+    velocity and angle jacobians) are computed once. Then every point is written
+    directly into z_prior and H without temporary arrays.
+    Compiled twice: `flow_odom12` (serial) and `flow_odom12_parallel` (prange over points).
+    '''
+    n = len(depths)
+    z_full = np.empty(3 * n)
+    H_full = np.zeros((3 * n, 12))
+
+    # Rotate the vector backwards
+    q_inv = geometry.quat_inv(q_center)
+    rot_matrix_inv = geometry.quat_as_matrix(q_inv)
+
+    # Extrinsic transform
+    vel = np.ascontiguousarray(vel)
+    rot_vel = np.ascontiguousarray(rot_vel)
+    if extrinsic is not None:
+        rot_extrinsic = np.ascontiguousarray(extrinsic[:3, :3])
+    else:
+        rot_extrinsic = np.eye(3)
+
+    # Point-invariant part of the point velocity and of the jacobian [3, 9]
+    vel_local = geometry.rotate_vector(vel, q_inv)
+    vel_camera = -rot_extrinsic @ vel_local
+    rot_vel_camera = rot_extrinsic @ rot_vel
+    jacobian_3x6 = np.concatenate((
+        -rot_extrinsic @ rot_matrix_inv,                                # velocity from velocity
+        -rot_extrinsic @ geometry.vector_to_pseudo_matrix(vel_local),   # velocity from angle
+    ), 1)
+
+    # Target point coordinates [N, 3]
+    pixels_h = np.ones((n, 3))
+    pixels_h[:, :2] = pixels
+    target = pixels_h @ np.ascontiguousarray(camera_matrix_inv.T)
+    for i in range(n):
+        target[i] *= depths[i]
+
+    f_xx = camera_matrix[0, 0]
+    f_xy = camera_matrix[0, 1]
+    f_yx = camera_matrix[1, 0]
+    f_yy = camera_matrix[1, 1]
+
+    for i in prange(n):
+        tx = target[i, 0]
+        ty = target[i, 1]
+        tz = target[i, 2]
+
+        # 3: Velocity of a point in camera coordinates
+        pv_x = vel_camera[0] + ty * rot_vel_camera[2] - tz * rot_vel_camera[1]
+        pv_y = vel_camera[1] + tz * rot_vel_camera[0] - tx * rot_vel_camera[2]
+        pv_z = vel_camera[2] + tx * rot_vel_camera[1] - ty * rot_vel_camera[0]
+
+        # 2: Source hyperbolic coordinates
+        sz = tz - pv_z * delta_t
+        sm_x = (tx - pv_x * delta_t) / sz
+        sm_y = (ty - pv_y * delta_t) / sz
+
+        # 1: Compute optical flow
+        z_full[3 * i] = f_xx * sm_x + f_xy * sm_y + camera_matrix[0, 2] - pixels[i, 0]
+        z_full[3 * i + 1] = f_yx * sm_x + f_yy * sm_y + camera_matrix[1, 2] - pixels[i, 1]
+        z_full[3 * i + 2] = -pv_z * delta_t
+
+        # Jacobians [2, 2] @ [2, 3] -> c
+        a = -delta_t / tz
+        b_x = delta_t * tx / tz**2
+        b_y = delta_t * ty / tz**2
+        c00 = f_xx * a
+        c01 = f_xy * a
+        c02 = f_xx * b_x + f_xy * b_y
+        c10 = f_yx * a
+        c11 = f_yy * a
+        c12 = f_yx * b_x + f_yy * b_y
+
+        # Velocity and angle
+        for k in range(6):
+            j0 = jacobian_3x6[0, k]
+            j1 = jacobian_3x6[1, k]
+            j2 = jacobian_3x6[2, k]
+            H_full[3 * i, 3 + k] = c00 * j0 + c01 * j1 + c02 * j2
+            H_full[3 * i + 1, 3 + k] = c10 * j0 + c11 * j1 + c12 * j2
+            H_full[3 * i + 2, 3 + k] = -delta_t * j2
+        # Rotation velocity: vector_to_pseudo_matrix(target) @ rot_extrinsic
+        for k in range(3):
+            j0 = -tz * rot_extrinsic[1, k] + ty * rot_extrinsic[2, k]
+            j1 = tz * rot_extrinsic[0, k] - tx * rot_extrinsic[2, k]
+            j2 = -ty * rot_extrinsic[0, k] + tx * rot_extrinsic[1, k]
+            H_full[3 * i, 9 + k] = c00 * j0 + c01 * j1 + c02 * j2
+            H_full[3 * i + 1, 9 + k] = c10 * j0 + c11 * j1 + c12 * j2
+            H_full[3 * i + 2, 9 + k] = -delta_t * j2
+
+    return z_full, H_full
+
+flow_odom12 = njit(cache=True)(_flow_odom12_points)
+# Not cached: it shares the cache index with `flow_odom12`
+flow_odom12_parallel = njit(parallel=True)(_flow_odom12_points)
+
+@njit(cache=True)
+def flow_odom12_loop(vel, rot_vel, q_center, delta_t, depths, pixels, camera_matrix, camera_matrix_inv, extrinsic=None):
+    '''
+    Reference implementation of `flow_odom12`, one `_flow_odom12_single` call per point
+    '''
     z_full = np.empty(3 * len(depths))
     H_full = np.empty((3 * len(depths), 12))
 
@@ -58,7 +161,7 @@ def flow_odom12(vel, rot_vel, q_center, delta_t, depths, pixels, camera_matrix,
 
     return np.ascontiguousarray(z_full), np.ascontiguousarray(H_full)
 
-@njit
+@njit(cache=True)
 def _flow_odom12_single(vel, rot_vel, q_center, delta_t, depth, pixel, camera_matrix, camera_matrix_inv, extrinsic=None):
     '''
     Function for single measurement
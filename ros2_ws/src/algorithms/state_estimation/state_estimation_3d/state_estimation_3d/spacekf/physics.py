@@ -4,7 +4,7 @@ from numba import njit
 from . import geometry
 
 
-@njit
+@njit(cache=True)
 def transition_function(
     pos, vel, epsilon, rot_vel,
     q_center,
@@ -32,7 +32,7 @@ def transition_function(
     return next_pos, next_vel, next_epsilon, next_rot_vel, next_q_center
 
 
-@njit
+@njit(cache=True)
 def transition_jac(
     rot_vel,
     delta_t: float,
@@ -0,0 +1,105 @@
+import numpy as np
+from numba import njit
+
+from . import geometry
+
+
+class ImuPreintegration:
+    '''
+    Buffer of IMU samples between two filter steps
+
+    Samples are stored in preallocated arrays (`stamps`, `gyro`, `acc`).
+    `integrate` turns them into one measurement for `SpaceKF12`:
+    the mean rotational velocity, found from the integrated rotation increment,
+    and the mean acceleration, where every sample is rotated to the IMU attitude at the last sample.
+    Covariances of the means are scaled down according to the number of samples.
+    '''
+
+    def __init__(self, capacity=256):
+        self.stamps = np.zeros(capacity)
+        self.gyro = np.zeros([capacity, 3])
+        self.acc = np.zeros([capacity, 3])
+        self.gyro_R = np.eye(3)
+        self.acc_R = np.eye(3)
+        self.count = 0
+        self.prev_stamp = None
+
+    def add(self, stamp, gyro, acc, gyro_R=None, acc_R=None):
+        '''
+        Add one IMU sample
+
+        stamp (float): time of the sample in seconds
+        gyro (array of shape [3]): rotational velocity
+        acc (array of shape [3]): linear acceleration
+        gyro_R, acc_R (arrays of shape [3, 3]): optional. Covariances of a single sample
+        '''
+        if self.count == len(self.stamps):
+            # Filter is late. Grow the buffers rather than loose samples
+            self.stamps = np.concatenate([self.stamps, np.zeros_like(self.stamps)])
+            self.gyro = np.concatenate([self.gyro, np.zeros_like(self.gyro)])
+            self.acc = np.concatenate([self.acc, np.zeros_like(self.acc)])
+        self.stamps[self.count] = stamp
+        self.gyro[self.count] = gyro
+        self.acc[self.count] = acc
+        if gyro_R is not None:
+            self.gyro_R = gyro_R
+        if acc_R is not None:
+            self.acc_R = acc_R
+        self.count += 1
+
+    def integrate(self):
+        '''
+        Integrate the buffered samples and clear the buffer
+
+        Returns:
+        rot_vel (np.array of shape [3]): mean rotational velocity
+        rot_vel_R (np.array of shape [3, 3]): its covariance
+        acc (np.array of shape [3]): mean acceleration in the IMU frame at the last sample
+        acc_R (np.array of shape [3, 3]): its covariance
+        '''
+        n = self.count
+        stamps = self.stamps[:n]
+        dts = np.empty(n)
+        dts[1:] = stamps[1:] - stamps[:-1]
+        if self.prev_stamp is not None:
+            dts[0] = stamps[0] - self.prev_stamp
+        else:
+            dts[0] = dts[1:].mean() if n > 1 else 0.
+        rot_vel, gyro_scale, acc = preintegrate(dts, self.gyro[:n], self.acc[:n])
+        self.prev_stamp = stamps[-1]
+        self.count = 0
+        return rot_vel, self.gyro_R * gyro_scale, acc, self.acc_R / n
+
+
+@njit(cache=True)
+def preintegrate(dts, gyro, acc):
+    '''
+    dts (np.array of shape [N]): time since the previous sample
+    gyro (np.array of shape [N, 3]): rotational velocities
+    acc (np.array of shape [N, 3]): accelerations
+
+    Returns mean rotational velocity, scale of its covariance relative to a single sample
+    and mean acceleration in the frame of the last sample.
+    '''
+    n = len(dts)
+    q = np.array([0., 0, 0, 1])
+    acc_sum = np.zeros(3)
+    for i in range(n):
+        # Attitude at the i-th sample relative to the start
+        q = geometry.quat_product(q, geometry.rot_vel_to_q(gyro[i], dts[i]))
+        acc_sum += geometry.quat_as_matrix(q) @ acc[i]
+    # Rotate the sum to the attitude at the last sample
+    acc_mean = geometry.quat_as_matrix(q).T @ acc_sum / n
+
+    total = dts.sum()
+    if total > 0:
+        rot_vel = geometry.q_to_rot_vel(q / np.sqrt((q**2).sum()), total)
+        # Variance of the time-weighted mean
+        gyro_scale = (dts**2).sum() / total**2
+    else:
+        rot_vel = np.zeros(3)
+        for i in range(n):
+            rot_vel += gyro[i]
+        rot_vel /= n
+        gyro_scale = 1. / n
+    return rot_vel, gyro_scale, acc_mean
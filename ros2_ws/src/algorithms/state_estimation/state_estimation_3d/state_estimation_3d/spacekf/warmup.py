@@ -0,0 +1,96 @@
+import time
+
+import numpy as np
+
+from .filter import SpaceKF12, KALMAN_UPDATES, UPDATE_MODES
+from .batch import SpaceKF12Batch
+from .preintegration import ImuPreintegration
+
+
+def warmup(update_modes=None, parallel_flow=False, batch=False):
+    '''
+    Compile (or load from the numba cache) every kernel used by `SpaceKF12`
+
+    Runs predict and all updates with the same argument types as `EKFNode`:
+    with `extrinsic=None` and with a [3, 4] extrinsic, with a full and a diagonal flow covariance.
+    Gating is enabled, so that the per-point flow gate is compiled too,
+    and the fixed-lag smoother is enabled and run, as with the default `smoother_lag` of the node.
+    Kernels are declared with `cache=True`, so after the first run
+    the compiled code is stored on disk and later calls only load it.
+    `flow_odom12_parallel` and the `SpaceKF12Batch` kernels (which take the update kernel
+    as an argument) can not be cached, they are compiled in the calling process only.
+
+    Parameters
+    ----------
+        update_modes (list of str): update modes to compile. Default: all `UPDATE_MODES`
+        parallel_flow (bool): also compile `flow_odom12_parallel`. Not cached
+        batch (bool): also compile `SpaceKF12Batch` kernels of the `KALMAN_UPDATES` modes. Not cached
+
+    Returns
+    -------
+        float: seconds spent
+    '''
+    start = time.perf_counter()
+    update_modes = update_modes or UPDATE_MODES
+
+    extrinsic = np.concatenate([np.eye(3), np.zeros([3, 1])], 1)
+    camera_matrix = np.array([
+        [100., 0, 64],
+        [0, 100, 64],
+        [0, 0, 1],
+    ])
+    camera_matrix_inv = np.linalg.inv(camera_matrix)
+    n_points = 4
+    flows = np.zeros([n_points, 3], dtype=np.float32)
+    depths = np.ones(n_points, dtype=np.float32)
+    pixels = np.full([n_points, 2], 64, dtype=np.int64)
+    R_diag = np.ones(3 * n_points)
+
+    for update_mode in update_modes:
+        f = SpaceKF12(
+            dt=0.1, velocity_std=1., rot_vel_std=1., update_mode=update_mode,
+            parallel_flow=parallel_flow, history_size=2, smoother_lag=1, gate_probability=0.999,
+        )
+        f.predict()
+        f.predict(dt=0.05, stamp=0.15)
+        for extr in [None, extrinsic]:
+            f.update_acc(np.array([0, 0, 9.8]), np.eye(3), extrinsic=extr)
+            f.update_rot_vel(np.zeros(3), np.eye(3), extrinsic=extr)
+            for R in [R_diag, np.diag(R_diag)]:
+                f.update_flow(flows, 0.1, depths, pixels, R, camera_matrix, camera_matrix_inv, extrinsic=extr)
+        f.update_linear(np.eye(3, 12), np.zeros(3), np.eye(3))
+        # Out-of-sequence measurement
+        f.update_at(0.1, 'update_flow', flows, 0.1, depths, pixels, R_diag, camera_matrix, camera_matrix_inv)
+        f.smooth()
+
+        if batch and update_mode in KALMAN_UPDATES:
+            b = SpaceKF12Batch(2, dt=0.1, velocity_std=1., rot_vel_std=1., update_mode=update_mode)
+            b.predict()
+            for extr in [None, extrinsic]:
+                b.update_acc(np.array([0, 0, 9.8]), np.eye(3), extrinsic=extr)
+                b.update_rot_vel(np.zeros(3), np.eye(3), extrinsic=extr)
+                for R in [R_diag, np.diag(R_diag)]:
+                    b.update_flow(flows, 0.1, depths, pixels, R, camera_matrix, camera_matrix_inv, extrinsic=extr)
+            b.update_linear(np.eye(3, 12), np.zeros(3), np.eye(3))
+
+    imu = ImuPreintegration()
+    for i in range(2):
+        imu.add(0.01 * i, np.zeros(3), np.array([0, 0, 9.8]))
+    imu.integrate()
+    imu.add(0.02, np.zeros(3), np.array([0, 0, 9.8]))
+    imu.integrate()
+
+    return time.perf_counter() - start
+
+
+def main():
+    '''
+    Populate the numba cache. `colcon build` runs it when installing the package (see setup.py),
+    run it by hand if the build skipped it (SKIP_NUMBA_WARMUP=1):
+        ros2 run state_estimation_3d spacekf_warmup
+    '''
+    print(f'spacekf kernels compiled in {warmup():.2f} s')
+
+
+if __name__ == '__main__':
+    main()
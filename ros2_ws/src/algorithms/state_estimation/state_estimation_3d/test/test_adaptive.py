@@ -0,0 +1,53 @@
+import numpy as np
+
+from state_estimation_3d.adaptive import InnovationNoiseEstimator, ProcessNoiseEstimator
+
+
+def test_innovation_noise_is_positive_definite_for_adversarial_innovations():
+    # Innovations give C = 19 I and the predicted covariances 9 on every element,
+    # so C - H P H^T has variances 10 and all correlations -0.9: eigenvalues (-8, 19, 19)
+    estimator = InnovationNoiseEstimator(np.eye(3) * 10, window=30)
+    HPHt = np.full([3, 3], 9.)
+    for step in range(30):
+        y = np.zeros(3)
+        y[step % 3] = np.sqrt(57)
+        estimator.add(y, HPHt)
+    assert estimator.ready
+    np.testing.assert_allclose(np.diag(estimator.R), 10)
+    np.testing.assert_allclose(estimator.R, estimator.R.T)
+    # Smallest eigenvalue of the correlation matrix is 1 - max_correlation
+    assert np.linalg.eigvalsh(estimator.R)[0] >= 10 * (1 - 0.9) - 1e-9
+
+
+def test_correlations_with_small_row_sums_are_kept():
+    R = np.array([
+        [1., 0.5, 0.],
+        [0.5, 1., 0.3],
+        [0., 0.3, 1.],
+    ])
+    estimator = InnovationNoiseEstimator(np.eye(3), window=1)
+    # C - H P H^T = R for y = 0
+    estimator.add(np.zeros(3), -R)
+    np.testing.assert_allclose(estimator.R, R)
+    # Rows 0 and 1 have sums 1.2 and 1.4 of the correlations, the (0, 1) one is scaled by 0.9 / 1.4
+    estimator.add(np.zeros(3), -np.where(R == 0.3, 0.9, R))
+    np.testing.assert_allclose(estimator.R[0, 1], 0.5 * 0.9 / 1.4)
+    np.testing.assert_allclose(estimator.R[1, 2], 0.9 * 0.9 / 1.4)
+
+
+def test_random_adaptive_noise_is_positive_definite():
+    rng = np.random.default_rng(0)
+    m = 6
+    estimator = InnovationNoiseEstimator(np.eye(m), window=10)
+    Q = np.eye(m)
+    Q[0, 1] = Q[1, 0] = 0.5
+    process = ProcessNoiseEstimator(Q, window=10)
+    for step in range(200):
+        A = rng.normal(size=(m, m))
+        estimator.add(rng.normal(scale=3, size=m), A @ A.T)
+        process.add(rng.normal(size=m) * rng.normal(size=m)[0])
+        if estimator.ready:
+            assert np.linalg.eigvalsh(estimator.R)[0] > 0
+            assert np.linalg.eigvalsh(process.Q)[0] > 0
+            # Elements which are zero in the initial Q stay zero
+            assert np.all(process.Q[~process.mask] == 0)
@@ -0,0 +1,60 @@
+from types import SimpleNamespace
+
+import numpy as np
+
+from state_estimation_3d.extrinsics import ExtrinsicsCache
+
+
+def make_transform(parent, child, x):
+    return SimpleNamespace(
+        header=SimpleNamespace(frame_id=parent),
+        child_frame_id=child,
+        transform=SimpleNamespace(
+            translation=SimpleNamespace(x=x, y=0., z=0.),
+            rotation=SimpleNamespace(x=0., y=0., z=0., w=1.),
+        ),
+    )
+
+
+class FakeNode:
+    def create_subscription(self, msg_type, topic, callback, qos):
+        self.tf_static_callback = callback
+
+
+class FakeBuffer:
+    '''
+    Transforms by (parent, child), every lookup is counted
+    '''
+
+    def __init__(self):
+        self.transforms = {}
+        self.lookups = 0
+
+    def set_transform_static(self, transform, authority):
+        self.transforms[(transform.header.frame_id, transform.child_frame_id)] = transform
+
+    def lookup_transform(self, frame1, frame2, time):
+        self.lookups += 1
+        return self.transforms[(frame1, frame2)]
+
+
+def test_only_static_transforms_are_cached():
+    node, buffer = FakeNode(), FakeBuffer()
+    cache = ExtrinsicsCache(node, buffer)
+    node.tf_static_callback(SimpleNamespace(transforms=[
+        make_transform('base_link', 'imu', 0.1),
+        make_transform('base_link', 'camera', 0.2),
+    ]))
+    assert cache.get('base_link', 'imu')[0, 3] == 0.1
+    assert cache.get('base_link', 'imu')[0, 3] == 0.1
+    assert buffer.lookups == 1
+    assert cache.is_static('imu', 'camera')
+
+    # A camera on a pan joint, published on /tf
+    buffer.transforms[('camera', 'pan_camera')] = make_transform('camera', 'pan_camera', 0.3)
+    assert not cache.is_static('base_link', 'pan_camera')
+    cache.get('camera', 'pan_camera')
+    buffer.transforms[('camera', 'pan_camera')] = make_transform('camera', 'pan_camera', 0.4)
+    assert cache.get('camera', 'pan_camera')[0, 3] == 0.4
+    assert buffer.lookups == 3
+    np.testing.assert_array_equal(cache.get('imu', 'imu'), np.eye(3, 4))
@@ -0,0 +1,56 @@
+import numpy as np
+
+from state_estimation_3d.spacekf import SpaceKF12
+
+
+CAMERA_MATRIX = np.array([
+    [100., 0, 64],
+    [0, 100, 64],
+    [0, 0, 1],
+])
+N_POINTS = 5
+
+
+def make_filter():
+    f = SpaceKF12(dt=0.1, velocity_std=1., rot_vel_std=1., history_size=20, gate_probability=0.999)
+    f.P = f.P * 0.01
+    return f
+
+
+def flow_args(rng):
+    flows = rng.normal(scale=0.1, size=(N_POINTS, 3))
+    depths = rng.uniform(1, 3, size=N_POINTS)
+    pixels = rng.integers(20, 108, size=(N_POINTS, 2))
+    R = np.ones(3 * N_POINTS)
+    return flows, 0.1, depths, pixels, R, CAMERA_MATRIX, np.linalg.inv(CAMERA_MATRIX)
+
+
+def total(gate, name):
+    return gate.accepted.get(name, 0) + gate.rejected.get(name, 0)
+
+
+def test_delayed_updates_are_counted_once():
+    rng = np.random.default_rng(0)
+    f = make_filter()
+    for step in range(20):
+        f.predict()
+        f.update_rot_vel(np.zeros(3), np.eye(3))
+        f.update_flow(*flow_args(rng))
+        # Fused two steps back, so the later updates are replayed
+        f.update_at(f.stamp - 0.2, 'update_flow', *flow_args(rng))
+        f.update_at(f.stamp - 0.1, 'update_rot_vel', np.zeros(3), np.eye(3))
+    assert total(f.gate, 'update_flow') == 40
+    assert total(f.gate, 'update_flow_points') == 40 * N_POINTS
+    assert total(f.gate, 'update_rot_vel') == 40
+
+
+def test_delayed_outlier_is_rejected_and_counted():
+    f = make_filter()
+    for step in range(5):
+        f.predict()
+        f.update_rot_vel(np.zeros(3), np.eye(3) * 0.01)
+    x = f.x.copy()
+    f.update_at(f.stamp - 0.2, 'update_rot_vel', np.full(3, 100.), np.eye(3) * 0.01)
+    assert f.gate.rejected['update_rot_vel'] == 1
+    assert f.gate.accepted['update_rot_vel'] == 5
+    np.testing.assert_allclose(f.x, x)
@@ -0,0 +1,147 @@
+import numpy as np
+import pytest
+
+from state_estimation_3d.spacekf.filter import (
+    KALMAN_UPDATES, SpaceKF12, kalman_update, kalman_update_sqrt, kalman_update_sqrt_diag, sqrt_predict,
+)
+
+
+def make_problem(n=12, m=6, seed=0):
+    rng = np.random.default_rng(seed)
+    A = rng.normal(size=(n, n))
+    P = A @ A.T + np.eye(n)
+    H = rng.normal(size=(m, n))
+    R = np.eye(m) * 0.1
+    return rng.normal(size=n), P, H, R, rng.normal(size=m)
+
+
+def ill_conditioned_covariance(update, delta, steps, n=12, dtype=float):
+    '''
+    Covariance after `steps` cycles of two nearly parallel, nearly perfect scalar measurements
+    (rows of ones, the second one perturbed by `delta`, R = delta^2) and a predict P + 1e-3 I.
+    The example of Bierman (1977) where the standard form loses positive definiteness.
+    update(P, h, r) -> new P
+    '''
+    P = np.eye(n, dtype=dtype)
+    H = np.ones((2, n), dtype=dtype)
+    H[1, -1] += delta
+    for _ in range(steps):
+        for i in range(2):
+            P = update(P, H[i:i + 1], delta**2)
+        P = P + np.eye(n, dtype=dtype) * 1e-3
+    return P
+
+
+def joseph_reference(P, h, r):
+    S = (h @ P @ h.T)[0, 0] + r
+    K = P @ h.T / S
+    I_KH = np.eye(P.shape[0], dtype=P.dtype) - K @ h
+    return I_KH @ P @ I_KH.T + K @ K.T * r
+
+
+@pytest.mark.parametrize('mode', list(KALMAN_UPDATES))
+def test_updates_match_standard_form(mode):
+    x, P, H, R, y = make_problem()
+    new_x, new_P, d2 = KALMAN_UPDATES[mode](x, P, H, R, y)
+    ref_x, ref_P, ref_d2 = kalman_update(x, P, H, R, y)
+    np.testing.assert_allclose(new_x, ref_x, atol=1e-8)
+    np.testing.assert_allclose(new_P, ref_P, atol=1e-8)
+    np.testing.assert_allclose(d2, ref_d2)
+
+
+def test_sqrt_update_matches_standard_form():
+    x, P, H, R, y = make_problem()
+    noise = np.diag(np.linspace(0, 1, 12))
+    L = np.linalg.cholesky(P)
+    new_x, new_L, d2 = kalman_update_sqrt(x, L, H, np.sqrt(R), y, np.sqrt(noise), np.inf)
+    ref_x, ref_P, ref_d2 = kalman_update(x, P, H, R, y, noise)
+    np.testing.assert_allclose(new_x, ref_x, atol=1e-8)
+    np.testing.assert_allclose(new_L @ new_L.T, ref_P, atol=1e-8)
+    np.testing.assert_allclose(d2, ref_d2)
+    # The factor stays lower triangular
+    assert np.all(np.triu(new_L, 1) == 0)
+
+    F = np.eye(12) + 0.1 * np.eye(12, k=3)
+    Q = np.diag(np.linspace(0, 1, 12))
+    predicted = sqrt_predict(F, new_L, np.sqrt(Q))
+    np.testing.assert_allclose(predicted @ predicted.T, F @ (ref_P + Q) @ F.T, atol=1e-8)
+
+
+@pytest.mark.parametrize('m', [6, 30])
+def test_sqrt_diag_update_matches_standard_form(m):
+    x, P, H, _, y = make_problem(m=m)
+    R_diag = np.random.default_rng(1).uniform(0.05, 0.5, size=m)
+    noise = np.diag(np.linspace(0, 1, 12))
+    L = np.linalg.cholesky(P)
+    new_x, new_L, d2 = kalman_update_sqrt_diag(x, L, H, R_diag, y, np.sqrt(noise), np.inf)
+    ref_x, ref_P, ref_d2 = kalman_update(x, P, H, np.diag(R_diag), y, noise)
+    np.testing.assert_allclose(new_x, ref_x, atol=1e-8)
+    np.testing.assert_allclose(new_L @ new_L.T, ref_P, atol=1e-8)
+    np.testing.assert_allclose(d2, ref_d2)
+    # Rejected by the gate as a whole
+    rejected_x, rejected_L, _ = kalman_update_sqrt_diag(x, L, H, R_diag, y, np.sqrt(noise), ref_d2 * 0.99)
+    assert rejected_x is x and rejected_L is L
+
+
+@pytest.mark.skipif(np.finfo(np.longdouble).eps > 1e-18, reason='needs an extended precision reference')
+def test_sqrt_update_does_not_drift():
+    delta = 1e-8
+    reference = ill_conditioned_covariance(joseph_reference, delta, 100, dtype=np.longdouble).astype(float)
+
+    def standard(P, h, r):
+        return kalman_update(np.zeros(P.shape[0]), P, h, np.array([[r]]), np.zeros(1))[1]
+
+    def sqrt(L, h, r):
+        return kalman_update_sqrt(np.zeros(L.shape[0]), L, h, np.array([[np.sqrt(r)]]), np.zeros(1))[1]
+
+    def sqrt_covariance(delta, steps):
+        L = np.eye(12)
+        H = np.ones((2, 12))
+        H[1, -1] += delta
+        for _ in range(steps):
+            for i in range(2):
+                L = sqrt(L, H[i:i + 1], delta**2)
+            L = sqrt_predict(np.eye(12), L, np.eye(12) * np.sqrt(1e-3))
+        return L @ L.T
+
+    scale = np.abs(reference).max()
+    standard_error = np.abs(ill_conditioned_covariance(standard, delta, 100) - reference).max() / scale
+    sqrt_error = np.abs(sqrt_covariance(delta, 100) - reference).max() / scale
+    assert standard_error > 1e-2
+    assert sqrt_error < 1e-3
+
+
+def test_sqrt_filter_matches_standard_filter():
+    camera_matrix = np.array([[100., 0, 64], [0, 100, 64], [0, 0, 1]])
+    rng = np.random.default_rng(0)
+    flows = rng.normal(size=(4, 3)) * 0.1
+    depths = np.ones(4)
+    pixels = rng.integers(0, 128, size=(4, 2))
+    R_diag = np.full(12, 0.1)
+    filters = [
+        SpaceKF12(dt=0.1, velocity_std=1., rot_vel_std=0.5, update_mode=mode, history_size=5)
+        for mode in ['standard', 'sqrt']
+    ]
+    for f in filters:
+        f.predict()
+        f.update_acc(np.array([0.1, 0, 9.8]), np.eye(3))
+        f.update_rot_vel(np.array([0, 0, 0.1]), np.eye(3) * 0.01)
+        f.predict()
+        for R in [R_diag, np.diag(R_diag)]:
+            f.update_flow(flows, 0.1, depths, pixels, R, camera_matrix, np.linalg.inv(camera_matrix))
+        f.predict()
+        # Rolls back to the stored P, which is factored again
+        f.update_at(0.15, 'update_rot_vel', np.array([0, 0, 0.2]), np.eye(3) * 0.01)
+    standard, sqrt = filters
+    np.testing.assert_allclose(sqrt.x, standard.x, atol=1e-9)
+    np.testing.assert_allclose(sqrt.q, standard.q, atol=1e-9)
+    np.testing.assert_allclose(sqrt.P, standard.P, atol=1e-9)
+    np.testing.assert_allclose(sqrt.P_sqrt @ sqrt.P_sqrt.T, sqrt.P)
+    # Assigning P factors it again
+    sqrt.P = sqrt.P * 0.01
+    np.testing.assert_allclose(sqrt.P_sqrt @ sqrt.P_sqrt.T, standard.P * 0.01, atol=1e-12)
+
+
+def test_unknown_update_mode():
+    with pytest.raises(ValueError):
+        SpaceKF12(dt=0.1, velocity_std=1., rot_vel_std=1., update_mode='qr')
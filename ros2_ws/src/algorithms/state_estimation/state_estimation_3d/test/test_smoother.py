@@ -0,0 +1,36 @@
+import numpy as np
+
+from state_estimation_3d.spacekf import SpaceKF12
+
+
+GRAVITY = np.array([0., 0, 9.8])
+
+
+def make_filter():
+    return SpaceKF12(dt=0.1, velocity_std=1., rot_vel_std=1., history_size=20, smoother_lag=5)
+
+
+def test_replayed_updates_reach_the_smoother():
+    rng = np.random.default_rng(0)
+    measurements = rng.normal(scale=0.3, size=(30, 3))
+    R = np.eye(3) * 0.01
+    in_order = make_filter()
+    delayed = make_filter()
+    for step, z in enumerate(measurements):
+        for f in [in_order, delayed]:
+            f.predict()
+            f.update_acc(GRAVITY, np.eye(3))
+        in_order.update_rot_vel(z, R)
+        # The delayed filter gets every measurement two steps later
+        if step >= 2:
+            delayed.update_at(delayed.stamp - 0.2, 'update_rot_vel', measurements[step - 2], R)
+    delayed.update_at(delayed.stamp - 0.1, 'update_rot_vel', measurements[-2], R)
+    delayed.update_rot_vel(measurements[-1], R)
+
+    np.testing.assert_allclose(delayed.x, in_order.x, atol=1e-9)
+    stamp, x, P, q = in_order.smooth()
+    stamp_delayed, x_delayed, P_delayed, q_delayed = delayed.smooth()
+    assert stamp_delayed == stamp
+    np.testing.assert_allclose(x_delayed, x, atol=1e-9)
+    np.testing.assert_allclose(P_delayed, P, atol=1e-9)
+    np.testing.assert_allclose(q_delayed, q, atol=1e-9)
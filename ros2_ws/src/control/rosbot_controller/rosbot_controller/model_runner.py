@@ -1,7 +1,7 @@
 from scipy.spatial.transform import Rotation
 import rclpy
 from geometry_msgs.msg import Twist, TransformStamped, Vector3, Quaternion
-import nnio
+from rosbot_controller.motion_model import get_motion_model
 from tf2_ros import TransformBroadcaster
 from rclpy.node import Node
 from rosbot_controller.rosbot_2D import Rosbot, RobotState, RobotControl
@@ -108,8 +108,8 @@ class ModelRunner(Node):
             self.get_logger().info("Start neural network  model")
             self.child_frame_id = "nn_model_link"
 
-            #  load NN model (.onnx) from given path, using nnio module
-            self.nn_model = nnio.ONNXModel(self.nn_model_path)
+            #  load NN model (.onnx) from given path, shared with other users in this process
+            self.nn_model = get_motion_model(self.nn_model_path)
             self.create_timer(self.dt, self._nn_model)
         else:
             self.get_logger().error("Error model type")
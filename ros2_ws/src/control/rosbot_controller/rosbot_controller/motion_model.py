@@ -0,0 +1,200 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+class MotionModel:
+    """
+    Shared inference service for the NN motion model of a robot
+
+    The model maps a batch of [v, w, u_v, u_w, dt] (current velocities, control and time step)
+    to the next velocities [v, w]. Requests are served in three ways:
+        - results for quantised inputs are memoised in an LRU cache;
+        - concurrent requests from several threads (filters, rollouts) are run as one batch:
+          a thread which finds the model idle runs every pending request, the others wait for it;
+        - the ONNX session is run on preallocated input/output buffers with io binding.
+
+    """
+
+    def __init__(self, model, max_batch=64, cache_size=4096, quantum=1e-3):
+        """
+        Args:
+            :model: - (str or nnio.ONNXModel) path / url of the .onnx model (taken from the model cache)
+                or the loaded model
+            :max_batch: maximal number of rows in one inference call
+            :cache_size: number of memoised results, 0 disables the cache
+            :quantum: inputs are rounded to this step before the inference and the cache lookup
+        """
+        if isinstance(model, str):
+            import nnio
+            from model_cache import resolve
+            model = nnio.ONNXModel(resolve(model))
+        self.model = model
+        self.max_batch = max_batch
+        self.cache_size = cache_size
+        self.quantum = quantum
+
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+        # Preallocated buffers. Rows [0, n) are used by a batch of n requests
+        self.inputs = np.zeros([max_batch, 5], dtype=np.float32)
+        self.outputs = np.zeros([max_batch, 2], dtype=np.float32)
+        self._binding = self._make_binding()
+
+        # Requests waiting for the next batch: key -> [key, result]
+        self.pending = OrderedDict()
+        self.running = False
+        self.condition = threading.Condition()
+
+    def _make_binding(self):
+        """
+        Returns io binding of the onnxruntime session, or None if the model does not expose it.
+        Then the model is called with a copy of the used rows of the input buffer.
+        """
+        session = getattr(self.model, 'sess', None)
+        if session is None or not hasattr(session, 'io_binding'):
+            return None
+        binding = session.io_binding()
+        self._input_name = session.get_inputs()[0].name
+        self._output_name = session.get_outputs()[0].name
+        return binding
+
+    def predict(self, v, w, u_v, u_w, dt):
+        """
+        Next velocities of the robot
+
+        Args:
+            :v, w: current linear and angular velocities
+            :u_v, u_w: control
+            :dt: time step in seconds
+
+        Returns:
+            (float, float): next linear and angular velocities
+        """
+        return self.predict_batch(((v, w, u_v, u_w, dt),))[0]
+
+    def __call__(self, model_input):
+        """
+        Same interface as `nnio.ONNXModel`: [N, 5] array -> [N, 2] array
+        """
+        return np.array(self.predict_batch(model_input), dtype=np.float32)
+
+    def predict_batch(self, model_input):
+        """
+        Args:
+            :model_input: [N, 5] array (or sequence of rows) of [v, w, u_v, u_w, dt]
+
+        Returns:
+            list of N (v, w) tuples
+        """
+        results = []
+        requests = []
+        with self.condition:
+            for row in model_input:
+                key = self._key(row)
+                result = self._cache_get(key)
+                if result is None:
+                    # Identical requests from other threads are run once
+                    request = self.pending.get(key)
+                    if request is None:
+                        request = [key, None]
+                        self.pending[key] = request
+                    requests.append((len(results), request))
+                results.append(result)
+
+            # Run the pending requests ourselves, or wait for the thread which runs them
+            while any(request[1] is None for _, request in requests):
+                if self.running:
+                    self.condition.wait()
+                    continue
+                batch = [self.pending.popitem(last=False)[1] for _ in range(min(len(self.pending), self.max_batch))]
+                self.running = True
+                self.condition.release()
+                try:
+                    outputs = self._run([request[0] for request in batch])
+                except Exception as error:
+                    outputs = [error] * len(batch)
+                finally:
+                    self.condition.acquire()
+                    self.running = False
+                for request, output in zip(batch, outputs):
+                    request[1] = output
+                    if not isinstance(output, Exception):
+                        self._cache_put(request[0], output)
+                self.condition.notify_all()
+
+        for i, request in requests:
+            if isinstance(request[1], Exception):
+                raise request[1]
+            results[i] = request[1]
+        return results
+
+    def _key(self, row):
+        """
+        Quantised inputs, used both as the cache key and as the model input
+        """
+        if self.quantum > 0:
+            q = self.quantum
+            return tuple(round(float(x) / q) * q for x in row)
+        return tuple(float(x) for x in row)
+
+    def _run(self, rows):
+        """
+        One inference call for at most `max_batch` rows
+        """
+        n = len(rows)
+        self.inputs[:n] = rows
+        if self._binding is not None:
+            binding = self._binding
+            binding.bind_input(
+                self._input_name, 'cpu', 0, np.float32, [n, 5], self.inputs.ctypes.data
+            )
+            binding.bind_output(
+                self._output_name, 'cpu', 0, np.float32, [n, 2], self.outputs.ctypes.data
+            )
+            self.model.sess.run_with_iobinding(binding)
+        else:
+            self.outputs[:n] = self.model(self.inputs[:n].copy())
+        return [(float(v), float(w)) for v, w in self.outputs[:n]]
+
+    def _cache_get(self, key):
+        if self.cache_size <= 0:
+            return None
+        result = self.cache.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.cache.move_to_end(key)
+        return result
+
+    def _cache_put(self, key, result):
+        if self.cache_size <= 0:
+            return
+        self.cache[key] = result
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+
+_models = {}
+_models_lock = threading.Lock()
+
+
+def get_motion_model(path, **kwargs):
+    """
+    Returns the MotionModel of the .onnx file shared by every user in this process
+
+    Args:
+        :path: path or url of the .onnx model
+        :kwargs: MotionModel parameters, used only when the model is loaded for the first time
+    """
+    with _models_lock:
+        model = _models.get(path)
+        if model is None:
+            model = MotionModel(path, **kwargs)
+            _models[path] = model
+        return model
@@ -167,18 +167,12 @@ class Rosbot:
         """
         Using a neural network model of a robot, it receives the next state
         Args:
-            :model: - (nnio.ONNXModel) robot NN model
+            :model: - (MotionModel) robot NN model
             :control_vector: control vector of RobotControl type
             :dt: time period in seconds
 
         """
-        control_vector.v
-        control_vector.w
-
-        model_input = np.array(
-            [[self.v, self.w, control_vector.v, control_vector.w, dt]], dtype=np.float32)
-        model_output = model(model_input)
-        self.v, self.w = float(model_output[0][0]), float(model_output[0][1])
+        self.v, self.w = model.predict(self.v, self.w, control_vector.v, control_vector.w, dt)
         vel_vector = RobotControl(self.v, self.w)
         new_state = self.update_state_by_model(vel_vector, dt)
         return new_state
@@ -0,0 +1,109 @@
+'''
+Benchmark of the OdoFlow measurement composition in FlowOdomNode
+
+For K = 30 to 2000 points compares the old path (N = 10K random pixels sorted by np.argsort,
+message fields filled by list comprehensions) with `compose_measurement` for every sampling
+strategy and `fill_message` (fields written as array.array). Inputs are synthetic 128x128 maps.
+
+The message is perception_msgs/OdoFlow if it can be imported (sourced ROS 2 environment),
+otherwise a plain object, which does not include the per-element checks of rclpy messages.
+
+Usage:
+    python3 benchmark/compose.py
+'''
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from optical_flow.measurement import compose_measurement, depth_error, fill_message
+
+try:
+    from perception_msgs.msg import OdoFlow
+except ImportError:
+    OdoFlow = SimpleNamespace
+
+
+def make_frames(rng, size=128):
+    flow = rng.normal(scale=2, size=(size, size, 2))
+    depth = rng.uniform(0.5, 5, size=(size, size))
+    depth_prev = depth + rng.normal(scale=0.01, size=(size, size))
+    mask = rng.random((size, size)) < 0.1
+    depth_std = depth**2 / (430 * 0.075**2)
+    return flow, depth, depth_std, mask, depth_prev, depth_std.copy()
+
+
+def old_compose(flow, depth, depth_std, mask, depth_prev, depth_std_prev, n_best, rng):
+    '''
+    Measurement and message as composed by FlowOdomNode before `compose_measurement`
+    '''
+    errors, penalty = depth_error(flow, depth_std, mask)
+    n_points = 10 * n_best
+    xs = rng.integers(0, flow.shape[1], size=n_points)
+    ys = rng.integers(0, flow.shape[0], size=n_points)
+    top_k = np.argsort(errors[ys, xs])[:n_best]
+    xs = xs[top_k]
+    ys = ys[top_k]
+    flows = flow[ys, xs]
+    depths = depth[ys, xs]
+    xs_source = (xs + np.round(flows[:, 0]).astype(int)).clip(0, flow.shape[1] - 1)
+    ys_source = (ys + np.round(flows[:, 1]).astype(int)).clip(0, flow.shape[0] - 1)
+    delta_depth = depth_prev[ys_source, xs_source] - depths
+    flow_std = 2
+    depth_variance = (
+        (depth_std[ys, xs] * flow_std)**2
+        +
+        (depth_std_prev[ys_source, xs_source] * flow_std)**2
+        +
+        (
+            (depth_prev[ys_source, xs_source] - depth_prev[ys_source - 1, xs_source])**2
+            +
+            (depth_prev[ys_source, xs_source] - depth_prev[ys_source, xs_source - 1])**2
+        ) * 0.5
+    )
+    variance = np.zeros([n_best * 3])
+    variance[::3] = flow_std**2 + penalty[ys, xs]
+    variance[1::3] = variance[::3]
+    variance[2::3] = depth_variance
+
+    msg = OdoFlow()
+    msg.delta_t = 0.033
+    msg.x = [int(x) for x in xs]
+    msg.y = [int(y) for y in ys]
+    msg.flow_x = [float(flow) for flow in flows[:, 0]]
+    msg.flow_y = [float(flow) for flow in flows[:, 1]]
+    msg.depth = [float(d) for d in depths]
+    msg.delta_depth = [float(dd) for dd in delta_depth]
+    msg.covariance_diag = [float(v) for v in variance]
+    return msg
+
+
+def new_compose(frames, n_best, strategy, rng):
+    measurement = compose_measurement(*frames, n_best=n_best, strategy=strategy, rng=rng)
+    return fill_message(OdoFlow(), 0.033, *measurement)
+
+
+def time_function(function, repeats):
+    function()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    return (time.perf_counter() - start) / repeats * 1e6
+
+
+def main():
+    rng = np.random.default_rng(0)
+    frames = make_frames(rng)
+    if OdoFlow is SimpleNamespace:
+        print('perception_msgs is not available, messages are plain objects')
+    strategies = ['random', 'grid', 'best']
+    print(f'{"K":>6} {"old us":>10} ' + ' '.join(f'{s + " us":>10}' for s in strategies))
+    for n_best in [30, 100, 300, 1000, 2000]:
+        repeats = max(20, 20000 // n_best)
+        old = time_function(lambda: old_compose(*frames, n_best, rng), repeats)
+        new = [time_function(lambda: new_compose(frames, n_best, s, rng), repeats) for s in strategies]
+        print(f'{n_best:6d} {old:10.1f} ' + ' '.join(f'{t:10.1f}' for t in new))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+'''
+Benchmark of StereoCamera.depth_from_flow
+
+Compares the closed-form numba solver with the previous implementation
+(np.einsum normal equations and np.linalg.solve over all pixels) at 128x128
+and at the full 640x400 resolution, with preallocated outputs and with a stride,
+and checks that both give the same depth and error.
+
+Usage:
+    python3 benchmark/depth_from_flow.py
+'''
+import time
+
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+from optical_flow.stereo_camera import StereoCamera
+
+
+def old_depth_from_flow(stereo, flow):
+    '''
+    depth_from_flow before the closed-form solver. The right-hand side of np.linalg.solve
+    has an explicit column dimension, which numpy 2 requires for stacked vectors
+    '''
+    m_t = stereo.hyper_map_1.reshape(-1, 2) # [N, 2]
+    m_s = stereo.pix2hyper(stereo.pixel_map + flow, 2).reshape(-1, 2) # [N, 2]
+    N = m_t.shape[0]
+    m_t = np.concatenate([m_t, np.ones([N, 1])], 1) # [N, 3]
+    m_s = np.concatenate([m_s, np.ones([N, 1])], 1) # [N, 3]
+    m_t_rot = (stereo.R @ m_t.T).T
+    A = np.zeros([N, 3, 2])
+    A[:, :, 0] = m_t_rot
+    A[:, :, 1] = m_s
+    B = -stereo.T[None].repeat(N, 0) # [N, 3]
+    ATA = np.einsum('nki, nkj -> nij', A, A) # [N, 2, 2]
+    ATB = np.einsum('nkj, nk -> nj', A, B) # [N, 2]
+    X = np.linalg.solve(ATA, ATB[:, :, None])[:, :, 0] # [N, 2]
+    depth = X[:, 0].reshape([stereo.image_h, stereo.image_w])
+    AX = np.einsum('nik, nk -> ni', A, X) # [N, 3]
+    err = ((AX - B)**2).sum(1).reshape([stereo.image_h, stereo.image_w])
+    return depth, err
+
+
+def make_camera(width, height):
+    f = 0.7 * width
+    M = np.array([
+        [f, 0, (width - 1) / 2],
+        [0, f, (height - 1) / 2],
+        [0, 0, 1],
+    ])
+    R = Rotation.from_euler('xyz', [0.01, -0.02, 0.005]).as_matrix()
+    return StereoCamera(M1=M, M2=M, R=R, T=[-0.075, 0.001, 0.002], image_h=height, image_w=width)
+
+
+def time_function(function, repeats):
+    function()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        function()
+    return (time.perf_counter() - start) / repeats * 1e3
+
+
+def main():
+    rng = np.random.default_rng(0)
+    print(f'{"size":>9} {"old ms":>8} {"new ms":>8} {"out ms":>8} {"stride 2":>9} {"speedup":>8} {"depth err":>10}')
+    for width, height in [(128, 128), (320, 200), (640, 400)]:
+        stereo = make_camera(width, height)
+        flow = np.stack([
+            -stereo.M1[0, 0] * 0.075 / rng.uniform(0.5, 5, size=(height, width)),
+            rng.normal(scale=0.2, size=(height, width)),
+        ], 2)
+        repeats = max(3, 300000 // (width * height))
+        depth_old, err_old = old_depth_from_flow(stereo, flow)
+        depth, err = stereo.depth_from_flow(flow)
+        error = max(np.abs(depth - depth_old).max(), np.abs(err - err_old).max())
+        out = (np.empty_like(depth), np.empty_like(err))
+        out_2 = (np.empty([-(-height // 2), -(-width // 2)]), np.empty([-(-height // 2), -(-width // 2)]))
+        ms_old = time_function(lambda: old_depth_from_flow(stereo, flow), repeats)
+        ms_new = time_function(lambda: stereo.depth_from_flow(flow), repeats)
+        ms_out = time_function(lambda: stereo.depth_from_flow(flow, out=out), repeats)
+        ms_stride = time_function(lambda: stereo.depth_from_flow(flow, stride=2, out=out_2), repeats)
+        print(
+            f'{width:4d}x{height:<4d} {ms_old:8.2f} {ms_new:8.2f} {ms_out:8.2f} {ms_stride:9.2f} '
+            f'{ms_old / ms_out:7.1f}x {error:10.1e}'
+        )
+
+
+if __name__ == '__main__':
+    main()
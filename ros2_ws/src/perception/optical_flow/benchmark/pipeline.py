@@ -0,0 +1,147 @@
+'''
+Benchmark of the FlowOdomNode pipeline against the synchronous image callback
+
+Frames come at `--fps` for `--duration` seconds. The stages are simulated with their real work
+on synthetic frames: decoding is a copy of a 720p image and depth, preprocessing is
+`preprocess_into`, the network sleeps `--network-ms` (OpenVINO inference releases the GIL)
+and publishing is `compose_measurement` + `fill_message`.
+
+Pairs are batched by `--batch-size` while behind, as in FlowOdomNode (the network sleeps
+the same time for any batch). 'sync' runs all stages in the callback, as FlowOdomNode did
+before the pipeline: frames which come while the callback is busy wait in a queue of
+`--queue-size` frames (the subscription depth), older ones are dropped. 'pipeline' runs FlowPipeline.
+Reports published pairs per second, the latency from the frame arrival to the published
+measurement and, for the pipeline, the stage latencies and drops.
+
+Usage:
+    python3 benchmark/pipeline.py [--fps 30] [--network-ms 25] [--batch-size 1] [--duration 5]
+'''
+import argparse
+import collections
+import threading
+import time
+from types import SimpleNamespace
+
+import numpy as np
+
+from optical_flow.batch import FlowBatcher
+from optical_flow.input_buffer import preprocess_into
+from optical_flow.measurement import compose_measurement, fill_message, prepare_depth
+from optical_flow.pipeline import FlowPipeline
+
+
+class SleepNetwork:
+    '''
+    [B, 6, H, W] -> zero flow [B, 2, H, W] after `seconds` per call
+    '''
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def __call__(self, x):
+        time.sleep(self.seconds)
+        return np.zeros((x.shape[0], 2) + x.shape[2:], np.float32)
+
+
+def make_stages(rng):
+    image = rng.integers(0, 255, size=(720, 1280), dtype=np.uint8)
+    depth = rng.integers(500, 5000, size=(720, 1280)).astype(np.uint16)
+    latencies = []
+
+    def decode(stamp, msgs):
+        arrived, = msgs
+        return image.copy(), (arrived,) + prepare_depth(depth.copy(), 0.075)
+
+    def publish(stamp, delta_t, flow, frame, frame_prev):
+        arrived, depth, depth_std, mask = frame
+        measurement = compose_measurement(
+            flow, depth, depth_std, mask, frame_prev[1], frame_prev[2], rng=rng,
+        )
+        fill_message(SimpleNamespace(), delta_t, *measurement)
+        latencies.append(time.perf_counter() - arrived)
+
+    return decode, publish, latencies
+
+
+def run_sync(args, source):
+    '''
+    All stages in the callback, frames waiting in a bounded queue
+    '''
+    decode, publish, latencies = make_stages(np.random.default_rng(0))
+    batcher = FlowBatcher(SleepNetwork(args.network_ms * 1e-3), batch_size=args.batch_size)
+    frames = collections.deque(maxlen=args.queue_size)
+    condition = threading.Condition()
+    done = []
+
+    def callback():
+        while True:
+            with condition:
+                condition.wait_for(lambda: frames or done)
+                if not frames:
+                    return
+                stamp, msgs = frames.popleft()
+            image, payload = decode(stamp, msgs)
+            preprocess_into(image, batcher.next_slot())
+            results = batcher.add(stamp, payload)
+            if batcher.pending and time.perf_counter() - stamp < args.batch_max_lag:
+                results += batcher.flush()
+            for result in results:
+                publish(*result)
+
+    thread = threading.Thread(target=callback)
+    thread.start()
+
+    def submit(stamp, msgs):
+        with condition:
+            frames.append((stamp, msgs))
+            condition.notify()
+
+    source(submit)
+    with condition:
+        done.append(True)
+        condition.notify()
+    thread.join()
+    return latencies, None
+
+
+def run_pipeline(args, source):
+    decode, publish, latencies = make_stages(np.random.default_rng(0))
+    batcher = FlowBatcher(SleepNetwork(args.network_ms * 1e-3), batch_size=args.batch_size)
+    pipeline = FlowPipeline(
+        batcher, decode, publish, clock=time.perf_counter, queue_size=1, batch_max_lag=args.batch_max_lag,
+    )
+    source(pipeline.submit)
+    time.sleep(args.batch_max_lag + 0.2)
+    pipeline.close()
+    return latencies, pipeline.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--fps', type=float, default=30.)
+    parser.add_argument('--network-ms', type=float, default=25.)
+    parser.add_argument('--batch-size', type=int, default=1)
+    parser.add_argument('--batch-max-lag', type=float, default=0.2)
+    parser.add_argument('--duration', type=float, default=5.)
+    parser.add_argument('--queue-size', type=int, default=10, help='subscription depth of the synchronous node')
+    args = parser.parse_args()
+
+    def source(submit):
+        start = time.perf_counter()
+        for i in range(int(args.duration * args.fps)):
+            time.sleep(max(start + i / args.fps - time.perf_counter(), 0))
+            now = time.perf_counter()
+            submit(now, (now,))
+
+    print(f'{args.fps:.0f} frames/s, network {args.network_ms:.0f} ms per batch of up to {args.batch_size} pairs')
+    print(f'{"mode":>9} {"pairs/s":>8} {"latency ms":>11} {"p95 ms":>7}')
+    for name, run in [('sync', run_sync), ('pipeline', run_pipeline)]:
+        latencies, stats = run(args, source)
+        latencies = np.array(latencies) * 1e3
+        print(f'{name:>9} {len(latencies) / args.duration:8.1f} {latencies.mean():11.1f} {np.percentile(latencies, 95):7.1f}')
+        if stats:
+            print('          ' + stats)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,137 @@
+import time
+
+from .input_buffer import FrameBuffer
+
+
+def load_network(network_path, device='GPU'):
+    '''
+    OpenVINO flow network from the local model cache, as in FlowOdomNode.
+    `network_path` is the path of the ONNX model, the fp16 IR is stored next to it.
+    Batches of more than one pair need a model with a dynamic batch dimension.
+    '''
+    import nnio
+    from model_cache import resolve
+
+    return nnio.OpenVINOModel(
+        resolve(network_path.replace('_op12.onnx', '_fp16.bin')),
+        resolve(network_path.replace('_op12.onnx', '_fp16.xml')),
+        device=device,
+    )
+
+
+def make_preprocessing():
+    '''
+    Image -> [1, 3, 256, 256] float32 input of the flow network
+    '''
+    import nnio
+
+    return nnio.Preprocessing(
+        resize=(256, 256),
+        dtype='float32',
+        divide_by_255=True,
+        channels_first=True,
+        batch_dimension=True,
+    )
+
+
+class FlowBatcher:
+    '''
+    Runs the flow network on batches of consecutive frame pairs
+
+    Frames are preprocessed directly into the slots of a FrameBuffer, so that every image
+    is preprocessed once and never copied: a frame is the current image of one pair and
+    the previous image of the next one. When `batch_size` pairs are collected (or on `flush`),
+    the network is called once on the [B, 6, H, W] input and the flows are returned in stamp order.
+
+    Frames must be added in stamp order, older frames are dropped and counted in `dropped`.
+
+    Every result is a tuple (stamp, delta_t, flow, payload, payload_prev):
+    flow [H, W, 2] from the frame to the previous one, payloads are the objects passed to `add`.
+
+    Usage:
+        preprocess_into(image, batcher.next_slot())
+        results = batcher.add(stamp, payload)
+    '''
+
+    def __init__(self, network, batch_size=1, height=256, width=256):
+        '''
+        network (callable): [B, 6, H, W] -> [B, 2, H, W]
+        batch_size (int): number of pairs per network call
+        height, width (int): network input size
+        '''
+        self.network = network
+        self.batch_size = batch_size
+        self.buffer = FrameBuffer(3, height, width, max_pairs=batch_size)
+        # Stamps and payloads of the frames in the buffer, oldest first.
+        # The first frame is the previous image of the first pending pair
+        self.stamps = []
+        self.payloads = []
+        self.dropped = 0
+        self.pairs = 0
+        self.batches = 0
+        self.inference_time = 0.
+
+    @property
+    def pending(self):
+        '''
+        Number of pairs waiting for the network
+        '''
+        return self.buffer.pending
+
+    def next_slot(self):
+        '''
+        [3, H, W] slot for the preprocessed image of the next frame, see `preprocess_into`
+        '''
+        return self.buffer.next_slot()
+
+    def add(self, stamp, payload=None):
+        '''
+        Add the frame written into `next_slot`.
+        Returns the results of the batch if it is full, otherwise an empty list
+
+        stamp (float): frame stamp, s
+        payload: anything needed to process the flow of the pair, e.g. depth and header
+        '''
+        if self.stamps and stamp <= self.stamps[-1]:
+            self.dropped += 1
+            return []
+        self.buffer.commit()
+        self.stamps.append(stamp)
+        self.payloads.append(payload)
+        if self.pending >= self.batch_size:
+            return self.flush()
+        return []
+
+    def flush(self):
+        '''
+        Run the network on all pending pairs and return their results
+        '''
+        n = self.pending
+        if n == 0:
+            return []
+        start = time.perf_counter()
+        flows = self.network(self.buffer.pairs(n)) # [B, 2, H, W], the newest pair first
+        self.inference_time += time.perf_counter() - start
+        self.batches += 1
+        self.pairs += n
+
+        results = []
+        for i in range(1, n + 1):
+            flow = flows[n - i]
+            stamp = self.stamps[i]
+            results.append((
+                stamp, stamp - self.stamps[i - 1], flow.transpose(1, 2, 0), self.payloads[i], self.payloads[i - 1],
+            ))
+        # The last frame is the previous image of the next pair
+        self.buffer.release()
+        self.stamps = self.stamps[-1:]
+        self.payloads = self.payloads[-1:]
+        return results
+
+    def stats(self):
+        '''
+        Human-readable statistics of the batcher
+        '''
+        return '{} pairs in {} batches, {:.1f} ms per pair, {} frames dropped'.format(
+            self.pairs, self.batches, self.inference_time / max(self.pairs, 1) * 1e3, self.dropped
+        )
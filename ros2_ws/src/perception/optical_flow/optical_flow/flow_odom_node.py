@@ -1,5 +1,3 @@
-import cv2
-import nnio
 import numpy as np
 
 import rclpy
@@ -11,7 +9,11 @@ import tf2_ros
 import message_filters
 
 from perception_msgs.msg import OdoFlow
+from .batch import FlowBatcher, load_network, make_preprocessing
+from .measurement import compose_measurement, fill_message, prepare_depth
+from .pipeline import FlowPipeline
 from .stereo_camera import StereoCamera
+from .synchronizer import TimeSynchronizer
 
 
 class FlowOdomNode(Node):
@@ -19,6 +21,27 @@ class FlowOdomNode(Node):
     This node subscribes to stereo camera images and depth and publishes optical flow measurement for Kalman Filter.
     Currently works only with OAK-D camera.
     Measurement is defined in perception_msgs.msg.OdoFlow
+
+    left_rect and depth frames are paired by TimeSynchronizer: frames whose stamps differ
+    by at most `sync_slop` seconds (0 - exact stamps) are matched from buffers of
+    `sync_queue_size` frames per topic. The match statistics are logged every 10 s.
+
+    Matched frames are processed by a FlowPipeline on worker threads, off the executor:
+    decode (cv_bridge, depth) -> preprocess -> flow network -> measurement and publishing.
+    Frames wait for decoding and preprocessing in queues of `pipeline_queue_size` frames and
+    for the network in a queue of at least `batch_size` frames, so that a batch can be collected
+    while the node is behind. When a queue is full, its oldest frame is dropped. Frames are dropped
+    only before inference, every computed flow is published. Stage latencies and drops are logged every 10 s.
+
+    The flow network runs on batches of `batch_size` consecutive pairs (see FlowBatcher).
+    Pairs are collected only while the node is behind: a pair whose stamp is less than
+    `batch_max_lag` seconds older than the node clock, or no new pair during `batch_max_lag`,
+    runs the collected pairs at once. batch_size = 1 processes every pair on arrival.
+    Images are preprocessed into preallocated network inputs, with resize,
+    scaling and channels-first fused into one pass unless `fused_preprocessing` is False.
+
+    Every measurement has `num_points` points chosen by the `sampling` strategy:
+    'random', 'grid' or 'best' (see optical_flow.measurement.sample_points).
     """
     def __init__(self):
         super().__init__('flow_odom')
@@ -27,6 +50,14 @@ class FlowOdomNode(Node):
 
         # Declare parameters
         self.declare_parameter('network_path', 'http://192.168.194.51:8345/flow/2021.09.28_flow_sv/flow_sv_op12.onnx')
+        self.declare_parameter('sync_slop', 0.01)
+        self.declare_parameter('sync_queue_size', 10)
+        self.declare_parameter('batch_size', 1)
+        self.declare_parameter('batch_max_lag', 0.2)
+        self.declare_parameter('fused_preprocessing', True)
+        self.declare_parameter('sampling', 'random')
+        self.declare_parameter('num_points', 30)
+        self.declare_parameter('pipeline_queue_size', 1)
 
         # Get camera parameters
         self.stereo = None
@@ -61,163 +92,96 @@ class FlowOdomNode(Node):
         # Flow neural network
         network_path = self.get_parameter('network_path').get_parameter_value().string_value
         # self.network = nnio.ONNXModel(network_path)
-        self.network = nnio.OpenVINOModel(
-            network_path.replace('_op12.onnx', '_fp16.bin'),
-            network_path.replace('_op12.onnx', '_fp16.xml'),
-            device='GPU'
+        # Files are taken from the local model cache, the network is used only on a cache miss
+        self.network = load_network(network_path, device='GPU')
+        self.preprocess = None
+        if not self.get_parameter('fused_preprocessing').get_parameter_value().bool_value:
+            self.preprocess = make_preprocessing()
+        self.batcher = FlowBatcher(
+            self.network,
+            batch_size=self.get_parameter('batch_size').get_parameter_value().integer_value,
         )
-        self.preprocess = nnio.Preprocessing(
-            resize=(256, 256),
-            dtype='float32',
-            divide_by_255=True,
-            channels_first=True,
-            batch_dimension=True,
+
+        # Measurement points
+        self.sampling = self.get_parameter('sampling').get_parameter_value().string_value
+        self.num_points = self.get_parameter('num_points').get_parameter_value().integer_value
+        self.rng = np.random.default_rng()
+
+        # Worker threads of decoding, preprocessing, inference and publishing
+        self.pipeline = FlowPipeline(
+            self.batcher, self.decode_pair, self.publish_flow, clock=self.get_time,
+            queue_size=self.get_parameter('pipeline_queue_size').get_parameter_value().integer_value,
+            batch_max_lag=self.get_parameter('batch_max_lag').get_parameter_value().double_value,
+            preprocess=self.preprocess,
         )
 
         # Buffer for images
-        self.left_msg = None
-        self.depth_msg = None
-        self.last_pair = None
-        self.img_prev = None
-        self.depth_prev = None
-        self.depth_std_prev = None
-        self.sec_prev = None
+        self.sync = TimeSynchronizer(
+            2, self.check_pair,
+            slop=self.get_parameter('sync_slop').get_parameter_value().double_value,
+            queue_size=self.get_parameter('sync_queue_size').get_parameter_value().integer_value,
+        )
+        self.create_timer(10.0, self.log_sync_stats)
 
     def left_rect_callback(self, msg):
-        self.left_msg = msg
-        self.check_pair()
+        self.sync.add(0, msg)
 
     def depth_callback(self, msg):
-        self.depth_msg = msg
-        self.check_pair()
-
-    def check_pair(self):
-        if self.left_msg is None or self.depth_msg is None:
-            return
-        time_left = self.left_msg.header.stamp.sec + self.left_msg.header.stamp.nanosec * 1e-9
-        time_depth = self.depth_msg.header.stamp.sec + self.depth_msg.header.stamp.nanosec * 1e-9
-        threshold = 0.01
-        if abs(time_left - time_depth) < threshold:
-            self.last_pair = self.left_msg, self.depth_msg, time_left
-            self.publish_odometry()
-
-    def publish_odometry(self):
-        if self.last_pair is None or self.stereo is None:
-            return
+        self.sync.add(1, msg)
 
-        # Prepare inputs
-        img_left = self.bridge.imgmsg_to_cv2(self.last_pair[0])
-        img_left = cv2.cvtColor(img_left, cv2.COLOR_GRAY2RGB)
-        img_left = self.preprocess(img_left)
-        depth = self.bridge.imgmsg_to_cv2(self.last_pair[1])
-        sec = self.last_pair[2]
-
-        # Get depth
-        depth = cv2.resize(depth, (128, 128)) / 1000
-        mask = depth < 0.5
-        depth = depth.clip(0.5)
-        baseline = np.linalg.norm(self.stereo.T)
-        depth_std = depth**2 / (430 * baseline**2)
-
-        # Remember previous values
-        if self.sec_prev is None:
-            self.img_prev = img_left
-            self.depth_prev = depth
-            self.depth_std_prev = depth_std
-            self.sec_prev = sec
+    def check_pair(self, stamp, msgs):
+        if self.stereo is None:
             return
-
-        delta_t = sec - self.sec_prev
+        self.pipeline.submit(stamp * 1e-9, msgs)
+
+    def log_sync_stats(self):
+        self.get_logger().info('left_rect/depth sync: ' + self.sync.stats())
+        self.get_logger().info('flow batches: ' + self.batcher.stats())
+        self.get_logger().info('flow pipeline: ' + self.pipeline.stats())
+
+    def get_time(self):
+        '''
+        Returns current ROS time in seconds
+        '''
+        ros_stamp = self.get_clock().now().seconds_nanoseconds()
+        return ros_stamp[0] + ros_stamp[1] * 1e-9
+
+    def decode_pair(self, sec, msgs):
+        '''
+        Decode stage of the pipeline: image and (header, depth, depth_std, mask) of a frame
+        '''
+        left_msg, depth_msg = msgs
+        img_left = self.bridge.imgmsg_to_cv2(left_msg)
+        depth = self.bridge.imgmsg_to_cv2(depth_msg)
+        depth, depth_std, mask = prepare_depth(depth, np.linalg.norm(self.stereo.T))
+        return img_left, (left_msg.header, depth, depth_std, mask)
+
+    def publish_flow(self, sec, delta_t, flow, frame, frame_prev):
+        '''
+        Publish stage of the pipeline: compose and publish the measurement of one pair
+
+        sec (float): stamp of the current frame
+        delta_t (float): time since the previous frame
+        flow (np.array): [H, W, 2] flow from the current frame to the previous one
+        frame, frame_prev (tuple): header, depth, depth_std, mask of the frames
+        '''
+        header, depth, depth_std, mask = frame
+        _, depth_prev, depth_std_prev, _ = frame_prev
         print('Pair:', delta_t)
 
-        # Get optical flow
-        pair_preprocessed = np.concatenate([
-            img_left, # [1, 3, H, W]
-            self.img_prev, # [1, 3, H, W]
-        ], 1) # [1, 6, H, W]
-        flow = self.network(pair_preprocessed)
-        flow = flow[0].transpose(1, 2, 0)
-
-        # Get depth error
-        mask = mask * 100
-        max_flow = np.sqrt((flow**2).sum(2)).max()
-        side = max(int(max_flow), 1) + 1
-        mask[:side] = 10
-        mask[-side:] = 10
-        mask[:, :side] = 10
-        mask[:, -side:] = 10
-        depth_sum_err = depth_std + mask
-
-        if self.depth_prev is None:
-            self.depth_prev = depth
-            self.depth_std_prev = depth_std
-
-        # Shoot random points
-        N = 300
-        K = 30
-        xs = np.random.randint(0, flow.shape[1], size=N)
-        ys = np.random.randint(0, flow.shape[0], size=N)
-        errors = depth_sum_err[ys, xs]
-        top_k = np.argsort(errors)[:K]
-        xs = xs[top_k]
-        ys = ys[top_k]
-
-        # Compose measurement
-        flows = flow[ys, xs] # [N, 2]
-        depths = depth[ys, xs] # [N]
-        xs_source = (xs + np.round(flows[:, 0]).astype(int)).clip(0, flow.shape[1] - 1)
-        ys_source = (ys + np.round(flows[:, 1]).astype(int)).clip(0, flow.shape[0] - 1)
-        delta_depth = self.depth_prev[ys_source, xs_source] - depths # [N]
-
-        # Compose covariance
-        flow_std = 2
-        depth_variance = (
-            (depth_std[ys, xs] * flow_std)**2
-            +
-            (self.depth_std_prev[ys_source, xs_source] * flow_std)**2
-            +
-            (
-                (self.depth_prev[ys_source, xs_source] - self.depth_prev[ys_source - 1, xs_source])**2
-                +
-                (self.depth_prev[ys_source, xs_source] - self.depth_prev[ys_source, xs_source - 1])**2
-            ) * 0.5
+        measurement = compose_measurement(
+            flow, depth, depth_std, mask, depth_prev, depth_std_prev,
+            n_best=self.num_points, strategy=self.sampling, rng=self.rng,
         )
-        variance = np.zeros([K * 3])
-        variance[::3] = flow_std**2 + mask[ys, xs]
-        variance[1::3] = variance[::3]
-        variance[2::3] = depth_variance
-        
-        # Generate not random points (debug)
-        # K = 2
-        # xs = np.array([depth.shape[1] // 4, 3 * depth.shape[1] // 4])
-        # ys = np.array([depth.shape[0] // 2, depth.shape[0] // 2])
-        # flows = np.array([[1, 0], [-1, 0]])
-        # depths = np.ones([K])
-        # delta_depth = np.zeros([K])
-        # variance = np.ones([K * 3]) * flow_std
-        # delta_t = 0.1
-
-        # Make odometry message
+
+        # Make odometry message. Arrays are written as array.array, without per-element conversion
         msg = OdoFlow()
-        msg.header.stamp = self.last_pair[0].header.stamp
-        msg.header.frame_id = self.last_pair[0].header.frame_id
-        msg.child_frame_id = self.last_pair[0].header.frame_id
-        msg.delta_t = delta_t
-        msg.x = [int(x) for x in xs]
-        msg.y = [int(y) for y in ys]
-        msg.flow_x = [float(flow) for flow in flows[:, 0]]
-        msg.flow_y = [float(flow) for flow in flows[:, 1]]
-        msg.depth = [float(d) for d in depths]
-        msg.delta_depth = [float(dd) for dd in delta_depth]
-        msg.covariance_diag = [float(v) for v in variance]
+        msg.header.stamp = header.stamp
+        msg.header.frame_id = header.frame_id
+        msg.child_frame_id = header.frame_id
+        fill_message(msg, delta_t, *measurement)
         self.odom_publisher.publish(msg)
 
-        # Remember previous values
-        self.img_prev = img_left
-        self.depth_prev = depth
-        self.depth_std_prev = depth_std
-        self.sec_prev = sec
-
     def calibration_callback(self, msg):
         if self.stereo is None:
             M1 = np.array(msg.k).reshape([3, 3])
@@ -240,6 +204,7 @@ def main(args=None):
 
     rclpy.spin(node)
 
+    node.pipeline.close()
     # Destroy the node explicitly
     # (optional - otherwise it will be done automatically
     # when the garbage collector destroys the node object)
@@ -0,0 +1,124 @@
+import cv2
+import numpy as np
+
+
+def preprocess_into(image, out, preprocess=None):
+    '''
+    Write the network input of an image into `out` without intermediate frames
+
+    By default resize, scaling to [0, 1] and channels-first are fused: the resized image
+    is written into `out` by one numpy pass. A gray image is broadcast to the three channels,
+    which is the same as GRAY2RGB before preprocessing, but without the RGB copy.
+
+    image (np.array): [h, w] gray or [h, w, 3] image
+    out (np.array): [3, H, W] float32 slot, e.g. `FrameBuffer.next_slot()[:3]`
+    preprocess (nnio.Preprocessing or None): if given, used instead of the fused pass
+        and its [1, 3, H, W] output is copied into `out`
+    '''
+    if preprocess is not None:
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2RGB)
+        out[...] = preprocess(image)[0]
+        return out
+    height, width = out.shape[1:]
+    resized = cv2.resize(image, (width, height))
+    if resized.ndim == 2:
+        resized = resized[None] # [1, H, W]
+    else:
+        resized = resized.transpose(2, 0, 1) # [3, H, W]
+    np.multiply(resized, np.float32(1 / 255), out=out)
+    return out
+
+
+class FrameBuffer:
+    '''
+    Preallocated network input of consecutive frame pairs
+
+    Frames of `channels` channels are written in place into slots of one
+    [1, slots * channels, H, W] array, from its end to its beginning, so every frame is followed
+    in memory by the previous one. The input of the newest pair [1, 2 * channels, H, W]
+    (current frame, previous frame) is then a view of the storage: the halves of the pair
+    change places by moving an index, no frame is copied. When the beginning of the storage
+    is reached, the frames still needed are copied to its end, once per `slots - max_pairs` frames.
+
+    Up to `max_pairs` pairs are kept for batches. A batch of more pairs than one overlaps
+    in memory, so it is copied into a preallocated [max_pairs, 2 * channels, H, W] array.
+
+    Usage:
+        preprocess_into(image, buffer.next_slot())
+        buffer.commit()
+        network(buffer.pairs())
+    '''
+
+    def __init__(self, channels, height, width, max_pairs=1, slots=None, dtype=np.float32):
+        '''
+        channels (int): channels of one frame, e.g. 3 for an image, 6 for a stereo pair
+        height, width (int): network input size
+        max_pairs (int): maximal number of pairs in a batch
+        slots (int): number of frames in the storage. Default: max(8, 2 * (max_pairs + 1))
+        '''
+        self.channels = channels
+        self.max_pairs = max_pairs
+        self.slots = slots or max(8, 2 * (max_pairs + 1))
+        if self.slots < max_pairs + 2:
+            raise ValueError('FrameBuffer needs at least max_pairs + 2 slots')
+        self.storage = np.zeros([1, self.slots * channels, height, width], dtype)
+        self.batch = np.empty([max_pairs, 2 * channels, height, width], dtype) if max_pairs > 1 else None
+        # Slot of the newest frame and the number of kept frames (newest and the previous ones of the pairs)
+        self.position = self.slots
+        self.count = 0
+        self.copies = 0
+
+    @property
+    def pending(self):
+        '''
+        Number of complete pairs
+        '''
+        return max(self.count - 1, 0)
+
+    def next_slot(self):
+        '''
+        [C, H, W] view for the next frame. It becomes the newest frame after `commit`
+        '''
+        if self.position == 0:
+            # Move the kept frames to the end of the storage
+            kept = self.count * self.channels
+            self.storage[0, -kept:] = self.storage[0, :kept]
+            self.position = self.slots - self.count
+            self.copies += 1
+        start = (self.position - 1) * self.channels
+        return self.storage[0, start:start + self.channels]
+
+    def commit(self):
+        '''
+        Make the frame written into `next_slot` the newest one.
+        Pairs older than `max_pairs` are forgotten
+        '''
+        self.position -= 1
+        self.count = min(self.count + 1, self.max_pairs + 1)
+
+    def release(self):
+        '''
+        Forget all pairs. The newest frame is kept as the previous frame of the next pair
+        '''
+        self.count = min(self.count, 1)
+
+    def pairs(self, n=None):
+        '''
+        Input of the `n` newest pairs [n, 2 * C, H, W], the newest pair first. Default: all pairs.
+        Valid until the next `commit`
+        '''
+        n = self.pending if n is None else n
+        C = self.channels
+        start = self.position * C
+        if n == 1:
+            return self.storage[:, start:start + 2 * C]
+        storage = self.storage[0, start:]
+        view = np.lib.stride_tricks.as_strided(
+            storage,
+            shape=(n, 2 * C) + storage.shape[1:],
+            strides=(C * storage.strides[0],) + storage.strides,
+            writeable=False,
+        )
+        np.copyto(self.batch[:n], view)
+        return self.batch[:n]
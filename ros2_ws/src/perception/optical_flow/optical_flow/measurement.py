@@ -0,0 +1,173 @@
+import array
+
+import cv2
+import numpy as np
+
+
+# numpy types of array.array typecodes of OdoFlow fields
+ARRAY_DTYPES = {'f': np.float32, 'q': np.int64}
+
+
+def prepare_depth(depth, baseline, size=(128, 128)):
+    '''
+    Depth image in mm -> depth in m at the flow resolution with its standard deviation
+
+    Returns:
+    depth (np.array): [H, W] depth clipped to 0.5 m
+    depth_std (np.array): [H, W] standard deviation of the stereo depth
+    mask (np.array): [H, W] bool, pixels closer than 0.5 m (usually no depth)
+    '''
+    depth = cv2.resize(depth, size) / 1000
+    mask = depth < 0.5
+    depth = depth.clip(0.5)
+    depth_std = depth**2 / (430 * baseline**2)
+    return depth, depth_std, mask
+
+
+def depth_error(flow, depth_std, mask):
+    '''
+    Error map used to choose the measurement points
+
+    Pixels without depth get 100, pixels near the image border (closer than the largest flow) get 10.
+
+    Returns:
+    errors (np.array): [H, W] depth std plus the penalties
+    penalty (np.array): [H, W] the penalties alone, added to the flow variance
+    '''
+    penalty = mask * 100
+    # sqrt of the largest squared norm, without the [H, W, 2] temporaries
+    max_flow = np.sqrt(np.einsum('ijk,ijk->ij', flow, flow).max())
+    side = max(int(max_flow), 1) + 1
+    penalty[:side] = 10
+    penalty[-side:] = 10
+    penalty[:, :side] = 10
+    penalty[:, -side:] = 10
+    return depth_std + penalty, penalty
+
+
+def sample_points(errors, n_best=30, strategy='random', n_points=None, rng=None):
+    '''
+    Choose `n_best` measurement pixels on the [H, W] error map
+
+    Strategies:
+    'random': `n_points` uniformly random pixels (default 10 * n_best), the `n_best` of them
+        with the smallest error are kept
+    'grid': the image is split into a grid of at least `n_best` cells, the pixel with
+        the smallest error is taken from every cell and the best `n_best` cells are kept.
+        Points are spread over the whole image
+    'best': the `n_best` pixels with the smallest error in the whole map (np.argpartition)
+
+    'grid' and 'best' are deterministic, 'random' is deterministic for a seeded `rng`.
+
+    Returns:
+    xs, ys (np.array): [n_best] pixels
+    '''
+    height, width = errors.shape
+    if strategy == 'random':
+        rng = np.random.default_rng() if rng is None else rng
+        n_points = 10 * n_best if n_points is None else n_points
+        xs = rng.integers(0, width, size=n_points)
+        ys = rng.integers(0, height, size=n_points)
+        if n_best < n_points:
+            top_k = np.argpartition(errors[ys, xs], n_best - 1)[:n_best]
+            xs = xs[top_k]
+            ys = ys[top_k]
+        return xs, ys
+    if strategy == 'grid':
+        rows = max(int(round(np.sqrt(n_best * height / width))), 1)
+        cols = -(-n_best // rows)
+        cell_h = height // rows
+        cell_w = width // cols
+        cells = errors[:rows * cell_h, :cols * cell_w].reshape(rows, cell_h, cols, cell_w)
+        cells = cells.transpose(0, 2, 1, 3).reshape(rows * cols, cell_h * cell_w)
+        best = cells.argmin(1) # [rows * cols] index inside a cell
+        cell_errors = cells[np.arange(len(best)), best]
+        index = np.arange(len(best))
+        if n_best < len(index):
+            index = np.argpartition(cell_errors, n_best - 1)[:n_best]
+        row, col = np.divmod(index, cols)
+        dy, dx = np.divmod(best[index], cell_w)
+        return col * cell_w + dx, row * cell_h + dy
+    if strategy == 'best':
+        n_best = min(n_best, errors.size)
+        index = np.argpartition(errors.ravel(), n_best - 1)[:n_best]
+        ys, xs = np.divmod(index, width)
+        return xs, ys
+    raise ValueError('unknown sampling strategy: {}'.format(strategy))
+
+
+def compose_measurement(flow, depth, depth_std, mask, depth_prev, depth_std_prev,
+                        n_best=30, strategy='random', n_points=None, rng=None):
+    '''
+    Sample flow points and compose the OdoFlow measurement with its covariance
+
+    Parameters:
+    flow (np.array): [H, W, 2] flow from the current frame to the previous one
+    depth, depth_std, mask (np.array): current frame, see `prepare_depth`
+    depth_prev, depth_std_prev (np.array): previous frame
+    n_best, strategy, n_points, rng: point sampling, see `sample_points`
+
+    Returns:
+    xs, ys (np.array): [K] pixels
+    flows (np.array): [K, 2] flow at the pixels
+    depths (np.array): [K] depth at the pixels
+    delta_depth (np.array): [K] depth change to the previous frame
+    variance (np.array): [3K] diagonal of the measurement covariance
+    '''
+    # Get depth error and choose points
+    errors, penalty = depth_error(flow, depth_std, mask)
+    xs, ys = sample_points(errors, n_best=n_best, strategy=strategy, n_points=n_points, rng=rng)
+
+    # Compose measurement
+    flows = flow[ys, xs] # [N, 2]
+    depths = depth[ys, xs] # [N]
+    xs_source = (xs + np.round(flows[:, 0]).astype(int)).clip(0, flow.shape[1] - 1)
+    ys_source = (ys + np.round(flows[:, 1]).astype(int)).clip(0, flow.shape[0] - 1)
+    depth_source = depth_prev[ys_source, xs_source] # [N]
+    delta_depth = depth_source - depths # [N]
+
+    # Compose covariance
+    flow_std = 2
+    depth_variance = (
+        (depth_std[ys, xs] * flow_std)**2
+        +
+        (depth_std_prev[ys_source, xs_source] * flow_std)**2
+        +
+        (
+            (depth_source - depth_prev[ys_source - 1, xs_source])**2
+            +
+            (depth_source - depth_prev[ys_source, xs_source - 1])**2
+        ) * 0.5
+    )
+    variance = np.empty([len(xs), 3])
+    variance[:, 0] = flow_std**2 + penalty[ys, xs]
+    variance[:, 1] = variance[:, 0]
+    variance[:, 2] = depth_variance
+
+    return xs, ys, flows, depths, delta_depth, variance.ravel()
+
+
+def to_array(values, typecode):
+    '''
+    numpy array -> array.array of `typecode` ('f' float32, 'q' int64) by one memory copy.
+    rclpy takes array.array for float32[] and int64[] fields as is,
+    without the per-element checks done for lists
+    '''
+    out = array.array(typecode)
+    out.frombytes(np.ascontiguousarray(values, dtype=ARRAY_DTYPES[typecode]).tobytes())
+    return out
+
+
+def fill_message(msg, delta_t, xs, ys, flows, depths, delta_depth, variance):
+    '''
+    Write the output of `compose_measurement` into a perception_msgs/OdoFlow message
+    '''
+    msg.delta_t = float(delta_t)
+    msg.x = to_array(xs, 'q')
+    msg.y = to_array(ys, 'q')
+    msg.flow_x = to_array(flows[:, 0], 'f')
+    msg.flow_y = to_array(flows[:, 1], 'f')
+    msg.depth = to_array(depths, 'f')
+    msg.delta_depth = to_array(delta_depth, 'f')
+    msg.covariance_diag = to_array(variance, 'f')
+    return msg
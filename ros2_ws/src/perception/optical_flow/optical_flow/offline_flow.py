@@ -0,0 +1,114 @@
+'''
+Offline flow odometry over HDF5 files written by `rosbag_to_hdf5`
+
+Reads synchronized images and depth (`oakd_data_recorder`, `realsense_data_recorder`),
+runs the flow network on batches of consecutive frame pairs (see FlowBatcher) and writes
+the OdoFlow measurements in the layout of `ekf_data_recorder` (flow_stamp, flow_lengths,
+flow_x, ...), so that the output can be replayed by `state_estimation_3d replay` after
+adding IMU data. Ground truth poses are copied if present.
+
+Frames are read from the file chunk by chunk and every image is preprocessed once,
+directly into the preallocated network input: it is reused as the previous image of the next pair.
+
+Usage:
+    ros2 run optical_flow offline_flow oakd.hdf5 flow.hdf5 --batch-size 16
+'''
+import argparse
+import time
+
+import h5py
+import numpy as np
+
+from .batch import FlowBatcher, load_network, make_preprocessing
+from .input_buffer import preprocess_into
+from .measurement import compose_measurement, prepare_depth
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Batched flow odometry over rosbag_to_hdf5 outputs')
+    parser.add_argument('input', help='HDF5 file with images, depth and stamps')
+    parser.add_argument('output', help='HDF5 file for the OdoFlow measurements')
+    parser.add_argument(
+        '--network-path', default='http://192.168.194.51:8345/flow/2021.09.28_flow_sv/flow_sv_op12.onnx',
+    )
+    parser.add_argument('--device', default='GPU')
+    parser.add_argument('--batch-size', type=int, default=16, help='number of pairs per network call')
+    parser.add_argument('--image-key', default='rgb')
+    parser.add_argument('--depth-key', default='depth')
+    parser.add_argument('--baseline', type=float, default=0.075, help='stereo baseline, m')
+    parser.add_argument('--sampling', default='random', choices=['random', 'grid', 'best'])
+    parser.add_argument('--num-points', type=int, default=30, help='number of points per measurement')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random point sampling')
+    parser.add_argument(
+        '--no-fused-preprocessing', action='store_true', help='preprocess images by nnio.Preprocessing',
+    )
+    args = parser.parse_args(args)
+
+    rng = np.random.default_rng(args.seed)
+    preprocess = make_preprocessing() if args.no_fused_preprocessing else None
+    batcher = FlowBatcher(load_network(args.network_path, device=args.device), batch_size=args.batch_size)
+
+    flow_stamps = []
+    flow_delta_t = []
+    columns = {key: [] for key in ['x', 'y', 'depth', 'flow_x', 'flow_y', 'delta_depth', 'covariance_diag']}
+
+    def process(results):
+        for stamp, delta_t, flow, frame, frame_prev in results:
+            depth, depth_std, mask = frame
+            depth_prev, depth_std_prev, _ = frame_prev
+            measurement = compose_measurement(
+                flow, depth, depth_std, mask, depth_prev, depth_std_prev,
+                n_best=args.num_points, strategy=args.sampling, rng=rng,
+            )
+            xs, ys, flows, depths, delta_depth, variance = measurement
+            flow_stamps.append(stamp)
+            flow_delta_t.append(delta_t)
+            for key, value in zip(columns, [xs, ys, depths, flows[:, 0], flows[:, 1], delta_depth, variance]):
+                columns[key].append(value)
+
+    start = time.perf_counter()
+    preprocess_time = 0.
+    with h5py.File(args.input, 'r') as f:
+        images = f[args.image_key]
+        depths = f[args.depth_key]
+        stamps = f['stamp'][()]
+        for i in range(0, len(stamps), args.batch_size):
+            chunk = slice(i, i + args.batch_size)
+            for stamp, image, depth in zip(stamps[chunk], images[chunk], depths[chunk]):
+                t = time.perf_counter()
+                preprocess_into(image, batcher.next_slot(), preprocess)
+                frame = prepare_depth(depth, args.baseline)
+                preprocess_time += time.perf_counter() - t
+                process(batcher.add(float(stamp), frame))
+        process(batcher.flush())
+        ground_truth = {key: f[key][()] for key in ['position', 'rotation', 'pose_stamp'] if key in f}
+    run_time = time.perf_counter() - start
+    if not flow_stamps:
+        print('No frame pairs in {}'.format(args.input))
+        return
+
+    with h5py.File(args.output, 'w') as f:
+        # Flow messages have different number of points,
+        # so they are concatenated and split back by 'flow_lengths'
+        f.create_dataset('flow_stamp', data=np.array(flow_stamps))
+        f.create_dataset('flow_delta_t', data=np.array(flow_delta_t))
+        f.create_dataset('flow_lengths', data=np.array([len(x) for x in columns['x']], dtype=np.int64))
+        f.create_dataset('flow_pixel_x', data=np.concatenate(columns['x']).astype(np.int64))
+        f.create_dataset('flow_pixel_y', data=np.concatenate(columns['y']).astype(np.int64))
+        f.create_dataset('flow_depth', data=np.concatenate(columns['depth']))
+        f.create_dataset('flow_x', data=np.concatenate(columns['flow_x']))
+        f.create_dataset('flow_y', data=np.concatenate(columns['flow_y']))
+        f.create_dataset('flow_delta_depth', data=np.concatenate(columns['delta_depth']))
+        f.create_dataset('flow_covariance_diag', data=np.concatenate(columns['covariance_diag']))
+        for key, value in ground_truth.items():
+            f.create_dataset(key, data=value)
+
+    print(batcher.stats())
+    print('{} frames in {:.1f} s ({:.1f} frames/s), preprocessing {:.1f} ms per frame'.format(
+        len(stamps), run_time, len(stamps) / run_time, preprocess_time / max(len(stamps), 1) * 1e3,
+    ))
+    print('Measurements saved to file {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,252 @@
+import collections
+import queue
+import threading
+import time
+import traceback
+
+import numpy as np
+
+from .input_buffer import preprocess_into
+
+
+class LatestQueue:
+    '''
+    Queue between two pipeline stages with a latest-item-wins policy
+
+    `put` never blocks: when `size` items are waiting, the oldest one is dropped and returned,
+    so a slow consumer always gets the newest items and the producer is never held up.
+    The number of dropped items is counted in `dropped`. size = None never drops.
+    '''
+
+    def __init__(self, size=1):
+        self.size = size
+        self.items = collections.deque()
+        self.condition = threading.Condition()
+        self.closed = False
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item):
+        '''
+        Add an item. Returns the dropped oldest item, or None
+        '''
+        with self.condition:
+            dropped = None
+            if self.size is not None and len(self.items) >= self.size:
+                dropped = self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.condition.notify()
+            return dropped
+
+    def get(self, timeout=None):
+        '''
+        Oldest item. Raises queue.Empty after `timeout` seconds (None - wait forever)
+        or when the queue is closed and empty
+        '''
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.items or self.closed, timeout):
+                raise queue.Empty
+            if not self.items:
+                raise queue.Empty
+            return self.items.popleft()
+
+    def close(self):
+        '''
+        Wake up the consumer. Items already in the queue can still be taken
+        '''
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class LatencyCounter:
+    '''
+    Number, mean and maximum of the durations of one pipeline stage
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def __str__(self):
+        return '{} x {:.1f} ms (max {:.1f})'.format(
+            self.count, self.total / max(self.count, 1) * 1e3, self.max * 1e3
+        )
+
+
+class FlowPipeline:
+    '''
+    Flow odometry of synchronized frames on worker threads, off the rclpy executor
+
+    Stages, each on its own thread, connected by LatestQueues:
+        decode: ROS messages -> image and depth payload (`decode`, e.g. cv_bridge and `prepare_depth`)
+        preprocess: image -> [3, H, W] network input (`preprocess_into`)
+        infer: flow of the consecutive pairs (FlowBatcher), batching as in FlowOdomNode
+        publish: measurement of every pair (`publish`)
+    `submit` only puts the messages into the first queue, so the executor is never blocked.
+
+    Frames are dropped only before inference. The decode and preprocess queues keep
+    `queue_size` frames, the infer queue at least `batch_size` frames of the batcher, so that
+    a backlog of a full batch can build up while the network is busy and is then processed
+    by one call. When more frames wait, the oldest are dropped, the flow is then computed between
+    the remaining frames (`delta_t` is longer). All results of a network call go to the publish
+    stage as one item and are never dropped. The throughput is bounded by the slowest stage,
+    normally the network.
+
+    The FrameBuffer of the batcher is used by the infer thread only: preprocessed images are written
+    into a free list of preallocated inputs and copied into the batcher slot (one copy per frame),
+    so that preprocessing can run while the network is busy.
+
+    Latencies of every stage (the publish one per pair) and of the whole pipeline (from `submit`
+    to the end of `publish`) are counted in `latency`, dropped frames in the queues, see `stats`.
+    An exception in a stage is printed and drops the frame, the thread goes on with the next one.
+    '''
+
+    STAGES = ['decode', 'preprocess', 'infer', 'publish']
+
+    def __init__(
+        self, batcher, decode, publish, clock=time.time, queue_size=1, batch_max_lag=0.2, preprocess=None,
+    ):
+        '''
+        batcher (FlowBatcher): flow network and its input buffer
+        decode (callable): (stamp, msgs) -> (image, payload) or None to skip the frame.
+            The payload is passed to FlowBatcher.add
+        publish (callable): called with every FlowBatcher result
+            (stamp, delta_t, flow, payload, payload_prev)
+        clock (callable): current time in seconds, the clock of the frame stamps
+        queue_size (int): number of waiting frames before the decode and preprocess stages
+        batch_max_lag (float): pairs are collected into a batch only while the newest one
+            is older than this, and for at most this time, s
+        preprocess (nnio.Preprocessing or None): see `preprocess_into`
+        '''
+        self.batcher = batcher
+        self.decode = decode
+        self.publish = publish
+        self.clock = clock
+        self.batch_max_lag = batch_max_lag
+        self.preprocess = preprocess
+        infer_size = max(queue_size, batcher.batch_size)
+        self.queues = {
+            'decode': LatestQueue(queue_size),
+            'preprocess': LatestQueue(queue_size),
+            'infer': LatestQueue(infer_size),
+            'publish': LatestQueue(None),
+        }
+        self.latency = {stage: LatencyCounter() for stage in self.STAGES + ['total']}
+        # Inputs of the preprocessed images: the infer queue, one written, one copied
+        slot_shape = batcher.next_slot().shape
+        self.free_inputs = queue.SimpleQueue()
+        for _ in range(infer_size + 2):
+            self.free_inputs.put(np.empty(slot_shape, np.float32))
+        self.stopped = False
+        self.threads = [
+            threading.Thread(target=self._run, args=(stage,), name='flow_' + stage, daemon=True)
+            for stage in self.STAGES
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, stamp, msgs):
+        '''
+        Queue a synchronized set of messages. Never blocks
+
+        stamp (float): stamp of the frame, s
+        msgs: anything `decode` takes, e.g. (left_msg, depth_msg)
+        '''
+        self.queues['decode'].put((time.perf_counter(), stamp, msgs))
+
+    def close(self):
+        '''
+        Stop the worker threads. Frames still in the pipeline are dropped
+        '''
+        self.stopped = True
+        for q in self.queues.values():
+            q.close()
+        for thread in self.threads:
+            thread.join()
+
+    def stats(self):
+        '''
+        Human-readable latencies and drop counters of the stages
+        '''
+        return ', '.join(
+            '{}: {}, {} dropped'.format(stage, self.latency[stage], self.queues[stage].dropped)
+            for stage in self.STAGES
+        ) + ', total: {}'.format(self.latency['total'])
+
+    def _run(self, stage):
+        step = getattr(self, '_' + stage)
+        timeout = self.batch_max_lag if stage == 'infer' else None
+        while not self.stopped:
+            try:
+                item = self.queues[stage].get(timeout)
+            except queue.Empty:
+                if self.stopped:
+                    return
+                # No new frame during batch_max_lag: process the collected pairs
+                if stage == 'infer' and self.batcher.pending:
+                    self._timed('infer', self._flush)
+                continue
+            # A publish item is the list of results of one network call
+            for element in item if stage == 'publish' else [item]:
+                try:
+                    self._timed(stage, step, element)
+                except Exception:
+                    traceback.print_exc()
+
+    def _timed(self, stage, function, *args):
+        start = time.perf_counter()
+        function(*args)
+        self.latency[stage].add(time.perf_counter() - start)
+
+    def _forward(self, stage, item):
+        dropped = self.queues[stage].put(item)
+        # A dropped preprocessed image gives its input back
+        if dropped is not None and stage == 'infer':
+            self.free_inputs.put(dropped[2])
+
+    def _decode(self, item):
+        submitted, stamp, msgs = item
+        decoded = self.decode(stamp, msgs)
+        if decoded is not None:
+            image, payload = decoded
+            self._forward('preprocess', (submitted, stamp, image, payload))
+
+    def _preprocess(self, item):
+        submitted, stamp, image, payload = item
+        network_input = self.free_inputs.get()
+        try:
+            preprocess_into(image, network_input, self.preprocess)
+        except Exception:
+            self.free_inputs.put(network_input)
+            raise
+        self._forward('infer', (submitted, stamp, network_input, payload))
+
+    def _infer(self, item):
+        submitted, stamp, network_input, payload = item
+        np.copyto(self.batcher.next_slot(), network_input)
+        self.free_inputs.put(network_input)
+        # The submit time of a frame is kept with its payload for the total latency
+        results = self.batcher.add(stamp, (submitted, payload))
+        # Collect a batch only while the pipeline is behind: frames are waiting or the frame is old
+        if self.batcher.pending and not self.queues['infer'] and self.clock() - stamp < self.batch_max_lag:
+            results += self.batcher.flush()
+        if results:
+            self._forward('publish', results)
+
+    def _flush(self):
+        self._forward('publish', self.batcher.flush())
+
+    def _publish(self, result):
+        stamp, delta_t, flow, (submitted, payload), (_, payload_prev) = result
+        self.publish(stamp, delta_t, flow, payload, payload_prev)
+        self.latency['total'].add(time.perf_counter() - submitted)
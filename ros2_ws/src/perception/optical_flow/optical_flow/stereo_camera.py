@@ -1,5 +1,6 @@
 import numpy as np
 import time
+from numba import njit
 
 
 class StereoCamera:
@@ -101,37 +102,85 @@ class StereoCamera:
         '''
         ...
 
-    def depth_from_flow(self, flow):
-        # Compute hyperbolic maps
-        m_t = self.hyper_map_1.reshape(-1, 2) # [N, 2]
-        m_s = self.pix2hyper(self.pixel_map + flow, 2).reshape(-1, 2) # [N, 2]
-        N = m_t.shape[0]
-
-        # Add identity row
-        m_t = np.concatenate([m_t, np.ones([N, 1])], 1) # [N, 3]
-        m_s = np.concatenate([m_s, np.ones([N, 1])], 1) # [N, 3]
-
-        # Rotate hyperbolic coordinates
-        m_t_rot = (self.R @ m_t.T).T
+    def depth_from_flow(self, flow, roi=None, stride=1, out=None):
+        '''
+        Depth of every pixel from the stereo flow to the second camera
 
-        # Make linear equation parameters
-        A = np.zeros([N, 3, 2])
-        A[:, :, 0] = m_t_rot
-        A[:, :, 1] = m_s
-        B = -self.T[None].repeat(N, 0) # [N, 3]
+        For every pixel the hyperbolic coordinates in both cameras give the linear system
+        z_t * R m_t + z_s * m_s = -T, which is solved by least squares in closed form:
+        the 2x2 normal equations are inverted explicitly in one numba pass over the pixels,
+        without [N, 3] temporaries.
 
-        # Solve equation using least squares
-        ATA = np.einsum('nki, nkj -> nij', A, A) # [N, 2, 2]
-        ATB = np.einsum('nkj, nk -> nj', A, B) # [N, 2]
-        X = np.linalg.solve(ATA, ATB) # [N, 2]
+        Parameters:
+        flow (np.array): [H, W, 2] flow from the first camera to the second one
+        roi (tuple or None): (x, y, width, height) region of the image. Default: the whole image
+        stride (int): step between the computed pixels of the region
+        out (tuple or None): preallocated (depth, err) arrays of the output shape,
+            float64 [ceil(height / stride), ceil(width / stride)]. Allocated if None
 
-        # Get depth
-        depth = X[:, 0] # z_t
-        depth = depth.reshape([self.image_h, self.image_w])
+        Returns:
+        depth (np.array): z_t, depth in the first camera. nan where the rays are parallel
+        err (np.array): squared residual of the system
+        '''
+        x, y, width, height = (0, 0, self.image_w, self.image_h) if roi is None else roi
+        if x < 0 or y < 0 or x + width > self.image_w or y + height > self.image_h or stride < 1:
+            raise ValueError('depth_from_flow: roi {} with stride {} is outside of the image'.format(roi, stride))
+        shape = (-(-height // stride), -(-width // stride))
+        if out is None:
+            out = (np.empty(shape), np.empty(shape))
+        depth, err = out
+        if depth.shape != shape or err.shape != shape:
+            raise ValueError('depth_from_flow: output shape must be {}'.format(shape))
+        _depth_from_flow(
+            self.hyper_map_1, self.pixel_map, flow, self.M2_inv, self.R, self.T,
+            x, y, stride, depth, err,
+        )
+        return depth, err
 
-        # Compute error
-        AX = np.einsum('nik, nk -> ni', A, X) # [N, 3]
-        err = ((AX - B)**2).sum(1)
-        err = err.reshape([self.image_h, self.image_w])
 
-        return depth, err
+@njit(cache=True)
+def _depth_from_flow(hyper_map, pixel_map, flow, M_inv, R, T, x0, y0, stride, depth, err):
+    '''
+    Closed-form least squares of StereoCamera.depth_from_flow for the pixels
+    (y0 + i * stride, x0 + j * stride), written into depth[i, j] and err[i, j]
+    '''
+    b0 = -T[0]
+    b1 = -T[1]
+    b2 = -T[2]
+    for i in range(depth.shape[0]):
+        y = y0 + i * stride
+        for j in range(depth.shape[1]):
+            x = x0 + j * stride
+            # Rotated hyperbolic coordinates in the first camera
+            m0 = hyper_map[y, x, 0]
+            m1 = hyper_map[y, x, 1]
+            t0 = R[0, 0] * m0 + R[0, 1] * m1 + R[0, 2]
+            t1 = R[1, 0] * m0 + R[1, 1] * m1 + R[1, 2]
+            t2 = R[2, 0] * m0 + R[2, 1] * m1 + R[2, 2]
+            # Hyperbolic coordinates in the second camera
+            p0 = pixel_map[y, x, 0] + flow[y, x, 0]
+            p1 = pixel_map[y, x, 1] + flow[y, x, 1]
+            s0 = M_inv[0, 0] * p0 + M_inv[0, 1] * p1 + M_inv[0, 2]
+            s1 = M_inv[1, 0] * p0 + M_inv[1, 1] * p1 + M_inv[1, 2]
+            s2 = 1.
+
+            # Normal equations [[tt, ts], [ts, ss]] X = [tb, sb]
+            tt = t0 * t0 + t1 * t1 + t2 * t2
+            ts = t0 * s0 + t1 * s1 + t2 * s2
+            ss = s0 * s0 + s1 * s1 + s2 * s2
+            tb = t0 * b0 + t1 * b1 + t2 * b2
+            sb = s0 * b0 + s1 * b1 + s2 * b2
+            det = tt * ss - ts * ts
+            if det == 0.:
+                depth[i, j] = np.nan
+                err[i, j] = np.nan
+                continue
+            z_t = (ss * tb - ts * sb) / det
+            z_s = (tt * sb - ts * tb) / det
+
+            # Residual
+            r0 = z_t * t0 + z_s * s0 - b0
+            r1 = z_t * t1 + z_s * s1 - b1
+            r2 = z_t * t2 + z_s * s2 - b2
+            depth[i, j] = z_t
+            err[i, j] = r0 * r0 + r1 * r1 + r2 * r2
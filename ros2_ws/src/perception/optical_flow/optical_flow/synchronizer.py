@@ -0,0 +1,167 @@
+from bisect import bisect_left
+
+
+def stamp_to_ns(stamp):
+    '''
+    builtin_interfaces/Time -> integer nanoseconds, so that equal stamps compare exactly
+    '''
+    return stamp.sec * 1000000000 + stamp.nanosec
+
+
+class StampBuffer:
+    '''
+    Messages of one topic sorted by stamp, at most `size` of them
+
+    Messages normally arrive in stamp order and are appended. Late ones are inserted
+    at their place. `nearest` is a binary search, O(log size).
+    '''
+
+    def __init__(self, size):
+        self.size = size
+        self.stamps = []
+        self.msgs = []
+
+    def __len__(self):
+        return len(self.stamps)
+
+    def add(self, stamp, msg):
+        '''
+        Insert a message. Returns the number of the oldest messages dropped to keep `size`
+        '''
+        if not self.stamps or stamp >= self.stamps[-1]:
+            self.stamps.append(stamp)
+            self.msgs.append(msg)
+        else:
+            i = bisect_left(self.stamps, stamp)
+            self.stamps.insert(i, stamp)
+            self.msgs.insert(i, msg)
+        dropped = max(len(self.stamps) - self.size, 0)
+        if dropped:
+            self.pop_until(dropped)
+        return dropped
+
+    def nearest(self, stamp):
+        '''
+        Index of the message nearest to `stamp`, None if the buffer is empty
+        '''
+        stamps = self.stamps
+        if not stamps:
+            return None
+        i = bisect_left(stamps, stamp)
+        if i == len(stamps):
+            return i - 1
+        if i > 0 and stamp - stamps[i - 1] <= stamps[i] - stamp:
+            return i - 1
+        return i
+
+    def pop_until(self, count):
+        '''
+        Remove the `count` oldest messages
+        '''
+        del self.stamps[:count]
+        del self.msgs[:count]
+
+
+class TimeSynchronizer:
+    '''
+    Exact-time or approximate-time synchronizer of several message streams
+
+    Every topic has a StampBuffer of `queue_size` messages. A message of the first
+    (reference) topic, e.g. a left image, is matched with the nearest message
+    of every other topic. The match is accepted if all stamps are within `slop` seconds
+    of the reference stamp (slop = 0 is the exact-time policy), and if no message that
+    arrives later can be nearer: the other buffer already holds a message at least
+    as new as the reference stamp plus the found difference.
+    Matched messages and everything older are removed from the buffers.
+    A reference message which can not be matched anymore is dropped.
+
+    `callback(stamp, msgs)` is called with the reference stamp (integer ns)
+    and the list of matched messages in topic order.
+
+    Counters:
+    received, dropped: per topic numbers of added and discarded messages
+    matched: number of emitted sets
+    max_delta: largest stamp difference in emitted sets, s
+    '''
+
+    def __init__(self, num_topics, callback, slop=0.01, queue_size=30):
+        '''
+        num_topics (int): number of synchronized topics, the first one is the reference
+        callback (callable): called with (stamp, msgs) for every matched set
+        slop (float): maximal stamp difference of matched messages, s. 0 means exact stamps
+        queue_size (int): number of buffered messages per topic
+        '''
+        self.callback = callback
+        self.slop = int(round(slop * 1e9))
+        self.buffers = [StampBuffer(queue_size) for _ in range(num_topics)]
+        self.received = [0] * num_topics
+        self.dropped = [0] * num_topics
+        self.matched = 0
+        self.max_delta = 0.
+
+    def add(self, topic, msg, stamp=None):
+        '''
+        Add a message of the topic number `topic` and emit all sets which are complete now
+
+        stamp (int): stamp in ns. Default: `msg.header.stamp`
+        '''
+        if stamp is None:
+            stamp = stamp_to_ns(msg.header.stamp)
+        self.received[topic] += 1
+        self.dropped[topic] += self.buffers[topic].add(stamp, msg)
+        self._match()
+
+    def _match(self):
+        reference = self.buffers[0]
+        others = self.buffers[1:]
+        while len(reference):
+            stamp = reference.stamps[0]
+            indices = []
+            for buffer in others:
+                j = buffer.nearest(stamp)
+                if j is None:
+                    # Wait for the first message of this topic
+                    return
+                delta = abs(buffer.stamps[j] - stamp)
+                newest = buffer.stamps[-1]
+                if delta <= self.slop and newest >= stamp + delta:
+                    indices.append(j)
+                elif newest < stamp + min(delta, self.slop):
+                    # A later message of this topic may still match
+                    return
+                else:
+                    # Nothing in the future is near enough
+                    break
+            else:
+                self._emit(stamp, indices)
+                continue
+            reference.pop_until(1)
+            self.dropped[0] += 1
+
+    def _emit(self, stamp, indices):
+        reference = self.buffers[0]
+        msgs = [reference.msgs[0]]
+        reference.pop_until(1)
+        for k, (buffer, j) in enumerate(zip(self.buffers[1:], indices)):
+            msgs.append(buffer.msgs[j])
+            self.max_delta = max(self.max_delta, abs(buffer.stamps[j] - stamp) * 1e-9)
+            # Older messages of this topic can not match a newer reference
+            self.dropped[k + 1] += j
+            buffer.pop_until(j + 1)
+        self.matched += 1
+        self.callback(stamp, msgs)
+
+    @property
+    def match_rate(self):
+        '''
+        Share of the reference messages which were matched
+        '''
+        return self.matched / self.received[0] if self.received[0] else 0.
+
+    def stats(self):
+        '''
+        Human-readable statistics of the synchronizer
+        '''
+        return 'matched {} of {} ({:.1%}), dropped per topic {}, max stamp delta {:.1f} ms'.format(
+            self.matched, self.received[0], self.match_rate, self.dropped, self.max_delta * 1e3
+        )
@@ -21,6 +21,7 @@ setup(
     entry_points={
         'console_scripts': [
             'flow_odom_node = optical_flow.flow_odom_node:main',
+            'offline_flow = optical_flow.offline_flow:main',
         ],
     },
 )
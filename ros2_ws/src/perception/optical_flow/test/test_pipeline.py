@@ -0,0 +1,74 @@
+import time
+
+import numpy as np
+
+from optical_flow.batch import FlowBatcher
+from optical_flow.pipeline import FlowPipeline, LatestQueue
+
+
+SIZE = 16
+
+
+def sleep_network(seconds):
+    def network(x):
+        time.sleep(seconds)
+        return np.zeros((x.shape[0], 2, SIZE, SIZE), np.float32)
+    return network
+
+
+def run(batch_size, network_seconds, frames=45, fps=30.):
+    batcher = FlowBatcher(sleep_network(network_seconds), batch_size=batch_size, height=SIZE, width=SIZE)
+    published = []
+    image = np.zeros((3, SIZE, SIZE), np.float32)
+    pipeline = FlowPipeline(
+        batcher,
+        decode=lambda stamp, msgs: (image, msgs),
+        publish=lambda *result: published.append(result),
+        clock=time.perf_counter,
+        batch_max_lag=0.1,
+        # [3, H, W] -> [1, 3, H, W], instead of nnio.Preprocessing
+        preprocess=lambda image: image[None],
+    )
+    start = time.perf_counter()
+    for i in range(frames):
+        time.sleep(max(start + i / fps - time.perf_counter(), 0))
+        pipeline.submit(time.perf_counter(), i)
+    time.sleep(0.5)
+    pipeline.close()
+    return batcher, pipeline, published
+
+
+def test_latest_queue_drops_oldest():
+    q = LatestQueue(2)
+    assert q.put(1) is None
+    assert q.put(2) is None
+    assert q.put(3) == 1
+    assert q.dropped == 1
+    assert [q.get(0), q.get(0)] == [2, 3]
+
+    unbounded = LatestQueue(None)
+    for i in range(100):
+        assert unbounded.put(i) is None
+    assert len(unbounded) == 100
+
+
+def test_batched_results_are_all_published():
+    # The network is slower than the frames: pairs are collected into batches
+    batcher, pipeline, published = run(batch_size=8, network_seconds=0.05)
+    assert batcher.batches < batcher.pairs
+    assert len(published) == batcher.pairs
+    assert pipeline.queues['publish'].dropped == 0
+    # A batch of 8 pairs keeps up with the frames, so nothing is dropped before inference either
+    assert pipeline.queues['infer'].dropped == 0
+    assert batcher.pairs == 44
+    frames = [payload for _, _, _, payload, _ in published]
+    assert frames == sorted(frames)
+
+
+def test_frames_are_dropped_before_inference_only():
+    batcher, pipeline, published = run(batch_size=1, network_seconds=0.05)
+    assert pipeline.queues['infer'].dropped > 0
+    assert pipeline.queues['publish'].dropped == 0
+    assert len(published) == batcher.pairs
+    # The flow is computed between the remaining frames
+    assert max(delta_t for _, delta_t, _, _, _ in published) > 1.5 / 30
@@ -0,0 +1,75 @@
+from optical_flow.synchronizer import StampBuffer, TimeSynchronizer
+
+
+MS = 1000000
+
+
+def make_synchronizer(slop, queue_size=10):
+    matches = []
+    sync = TimeSynchronizer(2, lambda stamp, msgs: matches.append((stamp, msgs)), slop=slop, queue_size=queue_size)
+    return sync, matches
+
+
+def test_exact_match():
+    sync, matches = make_synchronizer(slop=0)
+    sync.add(0, 'left0', stamp=0)
+    sync.add(1, 'depth0', stamp=0)
+    sync.add(0, 'left1', stamp=50 * MS)
+    sync.add(1, 'depth1', stamp=60 * MS)
+    sync.add(0, 'left2', stamp=100 * MS)
+    sync.add(1, 'depth2', stamp=100 * MS)
+    assert matches == [(0, ['left0', 'depth0']), (100 * MS, ['left2', 'depth2'])]
+    # left1 has no depth with the same stamp, depth1 is older than the matched depth2
+    assert sync.dropped == [1, 1]
+    assert sync.matched == 2
+    assert sync.max_delta == 0
+
+
+def test_approximate_match_waits_for_a_nearer_message():
+    sync, matches = make_synchronizer(slop=0.01)
+    sync.add(0, 'left0', stamp=200 * MS)
+    sync.add(1, 'depth0', stamp=195 * MS)
+    # A depth message between 195 and 205 ms may still come
+    assert matches == []
+    sync.add(1, 'depth1', stamp=201 * MS)
+    assert matches == [(200 * MS, ['left0', 'depth1'])]
+    assert sync.dropped == [0, 1]
+    assert abs(sync.max_delta - 1e-3) < 1e-12
+
+    # Nearest depth is out of the slop
+    sync.add(0, 'left1', stamp=300 * MS)
+    sync.add(1, 'depth2', stamp=320 * MS)
+    assert len(matches) == 1
+    assert sync.dropped == [1, 1]
+    assert sync.match_rate == 0.5
+
+
+def test_out_of_order_messages_are_sorted():
+    buffer = StampBuffer(3)
+    for stamp in [10, 30, 20, 5]:
+        buffer.add(stamp, stamp)
+    assert buffer.stamps == [10, 20, 30]
+    assert buffer.msgs == [10, 20, 30]
+    assert buffer.nearest(24) == 1
+    assert buffer.nearest(26) == 2
+
+    # A late depth message is inserted before the newer one and matched in stamp order
+    sync, matches = make_synchronizer(slop=0)
+    sync.add(1, 'depth1', stamp=100 * MS)
+    sync.add(1, 'depth0', stamp=50 * MS)
+    sync.add(0, 'left0', stamp=50 * MS)
+    sync.add(0, 'left1', stamp=100 * MS)
+    assert matches == [(50 * MS, ['left0', 'depth0']), (100 * MS, ['left1', 'depth1'])]
+    assert sync.dropped == [0, 0]
+
+
+def test_full_buffers_drop_the_oldest_messages():
+    sync, matches = make_synchronizer(slop=0.01, queue_size=2)
+    for i in range(5):
+        sync.add(0, i, stamp=i * 100 * MS)
+    assert sync.received == [5, 0]
+    assert sync.dropped == [3, 0]
+    sync.add(1, 'depth', stamp=300 * MS)
+    assert matches == [(300 * MS, [3, 'depth'])]
+    # The reference at 400 ms waits for a later depth message
+    assert len(sync.buffers[0]) == 1
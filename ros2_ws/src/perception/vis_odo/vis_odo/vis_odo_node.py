@@ -1,5 +1,5 @@
-import cv2
 import nnio
+from model_cache import resolve
 import numpy as np
 
 import rclpy
@@ -9,6 +9,9 @@ from nav_msgs.msg import Odometry
 from cv_bridge import CvBridge
 import tf2_ros
 
+from optical_flow.input_buffer import FrameBuffer, preprocess_into
+from optical_flow.synchronizer import TimeSynchronizer
+
 
 class OdometryNode(Node):
     def __init__(self):
@@ -19,6 +22,11 @@ class OdometryNode(Node):
         # Declare parameters
         self.declare_parameter('network_path', 'http://192.168.194.51:8345/odometry/oakd/2021.07.20_odometry/odometry_op11.onnx')
         self.declare_parameter('period', 0.03)
+        # Stereo pairing: maximal stamp difference (0 - exact stamps), s, and buffered frames per camera
+        self.declare_parameter('sync_slop', 0.01)
+        self.declare_parameter('sync_queue_size', 10)
+        # Resize, scaling and channels-first in one pass instead of nnio.Preprocessing
+        self.declare_parameter('fused_preprocessing', True)
 
         # Subscribe to camera topics
         self.create_subscription(
@@ -43,20 +51,28 @@ class OdometryNode(Node):
 
         # Odometry neural network
         network_path = self.get_parameter('network_path').get_parameter_value().string_value
-        self.network = nnio.ONNXModel(network_path)
-        self.preprocess = nnio.Preprocessing(
-            resize=(256, 192),
-            dtype='float32',
-            divide_by_255=True,
-            channels_first=True,
-            batch_dimension=True,
-        )
+        self.network = nnio.ONNXModel(resolve(network_path))
+        self.preprocess = None
+        if not self.get_parameter('fused_preprocessing').get_parameter_value().bool_value:
+            self.preprocess = nnio.Preprocessing(
+                resize=(256, 192),
+                dtype='float32',
+                divide_by_255=True,
+                channels_first=True,
+                batch_dimension=True,
+            )
+        # Network input [1, 12, H, W]: left and right images of the current and of the previous pair.
+        # Images are preprocessed directly into it, the previous pair is not copied
+        self.frames = FrameBuffer(6, 192, 256)
 
         # Buffer for images
-        self.left_msg = None
-        self.right_msg = None
+        self.sync = TimeSynchronizer(
+            2, self.check_pair,
+            slop=self.get_parameter('sync_slop').get_parameter_value().double_value,
+            queue_size=self.get_parameter('sync_queue_size').get_parameter_value().integer_value,
+        )
+        self.create_timer(10.0, self.log_sync_stats)
         self.last_pair = None
-        self.last_pair_preprocessed = None
 
         # Create timer for odometry
         self.period = self.get_parameter('period').get_parameter_value().double_value
@@ -74,44 +90,32 @@ class OdometryNode(Node):
         self.covariance = list(covariance.flatten())
 
     def left_rect_callback(self, msg):
-        self.left_msg = msg
-        self.check_pair()
+        self.sync.add(0, msg)
 
     def right_rect_callback(self, msg):
-        self.right_msg = msg
-        self.check_pair()
+        self.sync.add(1, msg)
 
-    def check_pair(self):
-        if self.left_msg is None or self.right_msg is None:
-            return
-        time_left = self.left_msg.header.stamp.sec + self.left_msg.header.stamp.nanosec * 1e-9
-        time_right = self.right_msg.header.stamp.sec + self.right_msg.header.stamp.nanosec * 1e-9
-        if abs(time_left - time_right) < 0.01:
-            self.last_pair = self.left_msg, self.right_msg
+    def check_pair(self, stamp, msgs):
+        self.last_pair = tuple(msgs)
+
+    def log_sync_stats(self):
+        self.get_logger().info('stereo sync: ' + self.sync.stats())
 
     def publish_odometry(self):
         if self.last_pair is None:
             return
         # Prepare inputs
         img_left = self.bridge.imgmsg_to_cv2(self.last_pair[0])
-        img_left = cv2.cvtColor(img_left, cv2.COLOR_GRAY2RGB)
         img_right = self.bridge.imgmsg_to_cv2(self.last_pair[1])
-        img_right = cv2.cvtColor(img_right, cv2.COLOR_GRAY2RGB)
-        pair_preprocessed = np.concatenate([
-            self.preprocess(img_left),  # [1, 3, H, W]
-            self.preprocess(img_right), # [1, 3, H, W]
-        ], 1) # [1, 6, H, W]
-        # Get previuosly prepared inputs
-        if self.last_pair_preprocessed is None:
-            self.last_pair_preprocessed = pair_preprocessed
+        slot = self.frames.next_slot() # [6, H, W]
+        preprocess_into(img_left, slot[:3], self.preprocess)
+        preprocess_into(img_right, slot[3:], self.preprocess)
+        self.frames.commit()
+        # Wait for the previous pair
+        if self.frames.pending == 0:
             return
-        nn_inp = np.concatenate([
-            pair_preprocessed,           # [1, 6, H, W]
-            self.last_pair_preprocessed, # [1, 6, H, W]
-        ], 1) # [1, 12, H, W]
-        self.last_pair_preprocessed = pair_preprocessed
         # Compute odometry
-        odom = self.network(nn_inp) # [1, 6]
+        odom = self.network(self.frames.pairs(1)) # [1, 6]
         spd = odom / self.period
         spd = [float(val) for val in spd[0]]
         # Make odometry message
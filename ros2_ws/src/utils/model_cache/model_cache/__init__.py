@@ -0,0 +1 @@
+from .cache import ModelCache, ModelCacheError, resolve
@@ -0,0 +1,184 @@
+import hashlib
+import json
+import os
+import random
+import shutil
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+
+
+# Environment variables
+CACHE_DIR_ENV = 'MODEL_CACHE_DIR'
+OFFLINE_ENV = 'MODEL_CACHE_OFFLINE'
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'model_cache')
+
+# Networks used by the nodes of this workspace
+DEFAULT_MODELS = [
+    'http://192.168.194.51:8345/ml-control/gz-rosbot/new_model_dynamic_batch.onnx',
+    'http://192.168.194.51:8345/ml-control/gz-rosbot/rosbot_sim_gazebo11.onnx',
+    'http://192.168.194.51:8345/flow/2021.09.28_flow_sv/flow_sv_op12.onnx',
+    'http://192.168.194.51:8345/flow/2021.09.28_flow_sv/flow_sv_fp16.bin',
+    'http://192.168.194.51:8345/flow/2021.09.28_flow_sv/flow_sv_fp16.xml',
+    'http://192.168.194.51:8345/odometry/oakd/2021.07.20_odometry/odometry_op11.onnx',
+]
+
+
+class ModelCacheError(Exception):
+    pass
+
+
+class ModelCache:
+    '''
+    Content-addressed on-disk cache of model files
+
+    Files are stored as `<root>/blobs/<sha256>/<file name>` and `<root>/index.json`
+    maps every downloaded url to the sha256 of its content.
+    Lookups are cache-first: the network is used only for urls which are not in the index,
+    so nodes start offline and at the same speed once the cache is populated (see `prefetch`).
+    '''
+
+    def __init__(self, root=None, offline=None, retries=3, timeout=60.):
+        '''
+        Parameters:
+        root (str): cache directory. Default: $MODEL_CACHE_DIR or ~/.cache/model_cache
+        offline (bool): never use the network. Default: $MODEL_CACHE_OFFLINE
+        retries (int): number of download attempts
+        timeout (float): socket timeout of a download, s
+        '''
+        self.root = root or os.environ.get(CACHE_DIR_ENV) or DEFAULT_CACHE_DIR
+        if offline is None:
+            offline = os.environ.get(OFFLINE_ENV, '') not in ['', '0', 'false', 'False']
+        self.offline = offline
+        self.retries = retries
+        self.timeout = timeout
+
+    @property
+    def index_path(self):
+        return os.path.join(self.root, 'index.json')
+
+    def resolve(self, url, sha256=None, verify=False):
+        '''
+        Returns a local path of the model file
+
+        Parameters:
+        url (str): http(s) url, file:// url or local path
+        sha256 (str): expected checksum. If given, the file is always verified
+        verify (bool): verify a cached file against the checksum stored in the index
+
+        Local paths and file:// urls are returned as is.
+        '''
+        parsed = urllib.parse.urlparse(url)
+        if parsed.scheme in ['', 'file']:
+            path = urllib.request.url2pathname(parsed.path) if parsed.scheme == 'file' else url
+            if sha256 is not None and file_sha256(path) != sha256:
+                raise ModelCacheError(f'checksum mismatch: {path}')
+            return path
+
+        digest = self.read_index().get(url)
+        if sha256 is not None and digest is not None and digest != sha256:
+            digest = None
+        if digest is not None:
+            path = self.blob_path(digest, url)
+            if os.path.isfile(path) and (not (verify or sha256) or file_sha256(path) == digest):
+                return path
+
+        if self.offline:
+            raise ModelCacheError(f'{url} is not in the model cache {self.root} and the network is disabled')
+        return self.download(url, sha256)
+
+    def download(self, url, sha256=None):
+        '''
+        Download `url` into the cache and returns the local path
+        '''
+        os.makedirs(self.root, exist_ok=True)
+        for attempt in range(self.retries):
+            try:
+                tmp_path, digest = self._fetch(url)
+                break
+            except OSError as error:
+                if attempt == self.retries - 1:
+                    raise ModelCacheError(f'failed to download {url}: {error}') from error
+                # Exponential backoff with jitter, so that robots do not retry at the same time
+                time.sleep(random.uniform(0, 2 ** attempt))
+
+        if sha256 is not None and digest != sha256:
+            os.remove(tmp_path)
+            raise ModelCacheError(f'checksum mismatch: {url}')
+
+        path = self.blob_path(digest, url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(tmp_path, path)
+        self.update_index(url, digest)
+        return path
+
+    def _fetch(self, url):
+        '''
+        Download into a temporary file inside the cache, computing the checksum on the fly
+        '''
+        h = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f, urllib.request.urlopen(url, timeout=self.timeout) as response:
+                while True:
+                    chunk = response.read(1 << 20)
+                    if not chunk:
+                        break
+                    h.update(chunk)
+                    f.write(chunk)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return tmp_path, h.hexdigest()
+
+    def add(self, url, path):
+        '''
+        Put a local file into the cache under `url` (e.g. when building an image without network access)
+        '''
+        os.makedirs(self.root, exist_ok=True)
+        digest = file_sha256(path)
+        blob = self.blob_path(digest, url)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.part')
+        os.close(fd)
+        shutil.copyfile(path, tmp_path)
+        os.replace(tmp_path, blob)
+        self.update_index(url, digest)
+        return blob
+
+    def blob_path(self, digest, url):
+        # The file name is kept, because loaders choose the format by the extension
+        name = os.path.basename(urllib.parse.urlparse(url).path) or 'model'
+        return os.path.join(self.root, 'blobs', digest, name)
+
+    def read_index(self):
+        try:
+            with open(self.index_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def update_index(self, url, digest):
+        # Written to a temporary file and renamed, so that readers never see a partial index
+        index = self.read_index()
+        index[url] = digest
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix='.json')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(index, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.index_path)
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def resolve(url, sha256=None, verify=False):
+    '''
+    Local path of a model file from the default cache. See `ModelCache.resolve`
+    '''
+    return ModelCache().resolve(url, sha256=sha256, verify=verify)
@@ -0,0 +1,45 @@
+'''
+Populate the model cache, e.g. at image build time
+
+Usage:
+    ros2 run model_cache prefetch                      # all networks used by the workspace
+    ros2 run model_cache prefetch URL [URL ...]
+    ros2 run model_cache prefetch URL --file model.onnx  # add a local copy under URL
+'''
+import argparse
+import sys
+
+from .cache import ModelCache, ModelCacheError, DEFAULT_MODELS
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Download model files into the local model cache')
+    parser.add_argument('urls', nargs='*', help='model urls. Default: all networks used by the workspace')
+    parser.add_argument('--cache-dir', default=None, help='cache directory. Default: $MODEL_CACHE_DIR')
+    parser.add_argument('--sha256', default=None, help='expected checksum (only with a single url)')
+    parser.add_argument('--file', default=None, help='add this local file under the url instead of downloading')
+    parser.add_argument('--verify', action='store_true', help='verify files which are already cached')
+    args = parser.parse_args(args)
+
+    urls = args.urls or DEFAULT_MODELS
+    if (args.sha256 or args.file) and len(urls) != 1:
+        parser.error('--sha256 and --file require a single url')
+
+    cache = ModelCache(args.cache_dir, offline=False)
+    failed = 0
+    for url in urls:
+        try:
+            if args.file:
+                path = cache.add(url, args.file)
+            else:
+                path = cache.resolve(url, sha256=args.sha256, verify=args.verify)
+            print(f'{url} -> {path}')
+        except ModelCacheError as error:
+            print(error, file=sys.stderr)
+            failed += 1
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+import rclpy
+from rclpy.node import Node
+import tf2_ros
+
+from sensor_msgs.msg import Imu, CameraInfo
+from geometry_msgs.msg import PoseStamped
+from perception_msgs.msg import OdoFlow
+from scipy.spatial.transform import Rotation
+import h5py
+import numpy as np
+import signal
+
+path_to_save_hdf5 = None
+
+imu_stamps = []
+imu_gyro = []
+imu_acc = []
+imu_gyro_cov = []
+imu_acc_cov = []
+imu_frame = None
+flow_stamps = []
+flow_delta_t = []
+flow_lengths = []
+flow_pixels_x = []
+flow_pixels_y = []
+flow_depth = []
+flow_x = []
+flow_y = []
+flow_delta_depth = []
+flow_covariance_diag = []
+flow_frame = None
+positions = []
+rotations = []
+pose_stamps = []
+camera_info = None
+
+class TopicDataRecorder(Node):
+
+    def __init__(self):
+        global path_to_save_hdf5
+        super().__init__('ekf_data_recorder')
+
+        # Get parameters for topics and HDF5 file destination
+        self.declare_parameter('path_to_save_hdf5', 'default.hdf5')
+        self.declare_parameter('imu_topic', 'imu')
+        self.declare_parameter('odom_flow_topic', 'odom_flow')
+        self.declare_parameter('camera_info_topic', 'rectified_camera_info')
+        self.declare_parameter('pose_topic', 'pose')
+        self.declare_parameter('verbose', False)
+        path_to_save_hdf5 = self.get_parameter('path_to_save_hdf5').value
+        imu_topic = self.get_parameter('imu_topic').value
+        odom_flow_topic = self.get_parameter('odom_flow_topic').value
+        camera_info_topic = self.get_parameter('camera_info_topic').value
+        pose_topic = self.get_parameter('pose_topic').value
+        self.verbose = self.get_parameter('verbose').value
+        print('Path to save hdf5:', path_to_save_hdf5)
+        print('IMU topic:', imu_topic)
+        print('OdoFlow topic:', odom_flow_topic)
+        print('Camera info topic:', camera_info_topic)
+        print('Pose topic:', pose_topic)
+        print('Verbose:', self.verbose)
+
+        # Static extrinsics are looked up once, on shutdown
+        self.tf_buffer = tf2_ros.Buffer()
+        self.tf_listener = tf2_ros.TransformListener(self.tf_buffer, self)
+
+        # Initialize subscriptions for IMU, flow odometry, camera info and pose
+        self.imu_subscription = self.create_subscription(
+            Imu,
+            imu_topic,
+            self.imu_callback,
+            100
+        )
+        self.flow_subscription = self.create_subscription(
+            OdoFlow,
+            odom_flow_topic,
+            self.flow_callback,
+            10
+        )
+        self.camera_info_subscription = self.create_subscription(
+            CameraInfo,
+            camera_info_topic,
+            self.camera_info_callback,
+            10
+        )
+        self.pose_subscription = self.create_subscription(
+            PoseStamped,
+            pose_topic,
+            self.pose_callback,
+            10
+        )
+
+        # Touch subscriptions to avoid unused variable warnings
+        _ = self.imu_subscription
+        _ = self.flow_subscription
+        _ = self.camera_info_subscription
+        _ = self.pose_subscription
+
+    def imu_callback(self, msg):
+        global imu_frame
+        imu_frame = msg.header.frame_id
+        imu_stamps.append(msg.header.stamp.sec + 1e-9 * msg.header.stamp.nanosec)
+        imu_gyro.append([msg.angular_velocity.x, msg.angular_velocity.y, msg.angular_velocity.z])
+        imu_acc.append([msg.linear_acceleration.x, msg.linear_acceleration.y, msg.linear_acceleration.z])
+        imu_gyro_cov.append(np.array(msg.angular_velocity_covariance).reshape([3, 3]))
+        imu_acc_cov.append(np.array(msg.linear_acceleration_covariance).reshape([3, 3]))
+        if self.verbose:
+            print('Received imu at time {}'.format(imu_stamps[-1]))
+
+    def flow_callback(self, msg):
+        global flow_frame
+        flow_frame = msg.header.frame_id
+        flow_stamps.append(msg.header.stamp.sec + 1e-9 * msg.header.stamp.nanosec)
+        flow_delta_t.append(msg.delta_t)
+        flow_lengths.append(len(msg.x))
+        flow_pixels_x.append(np.array(msg.x))
+        flow_pixels_y.append(np.array(msg.y))
+        flow_depth.append(np.array(msg.depth))
+        flow_x.append(np.array(msg.flow_x))
+        flow_y.append(np.array(msg.flow_y))
+        flow_delta_depth.append(np.array(msg.delta_depth))
+        flow_covariance_diag.append(np.array(msg.covariance_diag))
+        if self.verbose:
+            print('Received flow odometry at time {}'.format(flow_stamps[-1]))
+
+    def camera_info_callback(self, msg):
+        global camera_info
+        camera_info = msg
+
+    def pose_callback(self, msg):
+        position = msg.pose.position
+        rotation = msg.pose.orientation
+        positions.append([position.x, position.y, position.z])
+        rotations.append([rotation.x, rotation.y, rotation.z, rotation.w])
+        pose_stamps.append(msg.header.stamp.sec + 1e-9 * msg.header.stamp.nanosec)
+        if self.verbose:
+            print('Received pose at time {}'.format(pose_stamps[-1]))
+
+    def get_extrinsic(self, frame1, frame2):
+        '''
+        Returns [3, 4] rotation-translation matrix between two tf frames
+        or None if the transform is not available
+        '''
+        if frame1 is None:
+            return None
+        try:
+            trans = self.tf_buffer.lookup_transform(frame1, frame2, rclpy.time.Time())
+        except (tf2_ros.LookupException, tf2_ros.ConnectivityException, tf2_ros.ExtrapolationException):
+            print('Transform {} -> {} is not available'.format(frame1, frame2))
+            return None
+        tr = trans.transform.translation
+        rot = trans.transform.rotation
+        rot = Rotation.from_quat([rot.x, rot.y, rot.z, rot.w]).as_matrix()
+        return np.concatenate([rot, [[tr.x], [tr.y], [tr.z]]], 1)
+
+
+def concatenate(arrays, dtype=float):
+    if len(arrays) == 0:
+        return np.zeros([0], dtype=dtype)
+    return np.concatenate(arrays).astype(dtype)
+
+
+def signal_handler(signal, frame):
+    rclpy.shutdown()
+
+
+def main(args=None):
+    rclpy.init(args=args)
+    data_recorder = TopicDataRecorder()
+
+    signal.signal(signal.SIGINT, signal_handler)
+
+    while rclpy.ok():
+        rclpy.spin_once(data_recorder)
+
+    print('On shutdown')
+    imu_extrinsic = data_recorder.get_extrinsic(imu_frame, 'base_link')
+    flow_extrinsic = data_recorder.get_extrinsic(flow_frame, 'base_link')
+    data_recorder.destroy_node()
+    with h5py.File(path_to_save_hdf5, 'w') as f:
+        f.create_dataset('imu_stamp', data=np.array(imu_stamps))
+        f.create_dataset('imu_gyro', data=np.array(imu_gyro).reshape([-1, 3]))
+        f.create_dataset('imu_acc', data=np.array(imu_acc).reshape([-1, 3]))
+        f.create_dataset('imu_gyro_cov', data=np.array(imu_gyro_cov).reshape([-1, 3, 3]))
+        f.create_dataset('imu_acc_cov', data=np.array(imu_acc_cov).reshape([-1, 3, 3]))
+        # Flow messages have different number of points,
+        # so they are concatenated and split back by 'flow_lengths'
+        f.create_dataset('flow_stamp', data=np.array(flow_stamps))
+        f.create_dataset('flow_delta_t', data=np.array(flow_delta_t))
+        f.create_dataset('flow_lengths', data=np.array(flow_lengths, dtype=np.int64))
+        f.create_dataset('flow_pixel_x', data=concatenate(flow_pixels_x, np.int64))
+        f.create_dataset('flow_pixel_y', data=concatenate(flow_pixels_y, np.int64))
+        f.create_dataset('flow_depth', data=concatenate(flow_depth))
+        f.create_dataset('flow_x', data=concatenate(flow_x))
+        f.create_dataset('flow_y', data=concatenate(flow_y))
+        f.create_dataset('flow_delta_depth', data=concatenate(flow_delta_depth))
+        f.create_dataset('flow_covariance_diag', data=concatenate(flow_covariance_diag))
+        f.create_dataset('position', data=np.array(positions).reshape([-1, 3]))
+        f.create_dataset('rotation', data=np.array(rotations).reshape([-1, 4]))
+        f.create_dataset('pose_stamp', data=np.array(pose_stamps))
+        if camera_info is not None:
+            f.create_dataset('camera_k', data=np.array(camera_info.k))
+            f.create_dataset('camera_p', data=np.array(camera_info.p))
+            f.create_dataset('camera_r', data=np.array(camera_info.r))
+            f.create_dataset('camera_size', data=np.array([camera_info.height, camera_info.width]))
+        if imu_extrinsic is not None:
+            f.create_dataset('imu_extrinsic', data=imu_extrinsic)
+        if flow_extrinsic is not None:
+            f.create_dataset('flow_extrinsic', data=flow_extrinsic)
+    print('Dataset saved to file {}'.format(path_to_save_hdf5))
+
+
+if __name__ == '__main__':
+    main()
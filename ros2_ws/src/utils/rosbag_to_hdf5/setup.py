@@ -25,7 +25,8 @@ setup(
             'realsense_data_recorder = rosbag_to_hdf5.realsense_data_recorder:main',
             'realsense_data_recorder_pcd_rgb = rosbag_to_hdf5.realsense_data_recorder_pcd_rgb:main',
             'realsense_data_recorder_pcd_only = rosbag_to_hdf5.realsense_data_recorder_pcd_only:main',
-            'rosbot_gazebo_data_recorder = rosbag_to_hdf5.rosbot_gazebo_data_recorder:main'
+            'rosbot_gazebo_data_recorder = rosbag_to_hdf5.rosbot_gazebo_data_recorder:main',
+            'ekf_data_recorder = rosbag_to_hdf5.ekf_data_recorder:main'
         ],
     },
 )